@@ -0,0 +1,216 @@
+"""
+负载基准测试：启动模拟的OpenAI兼容服务，在进程内运行XingHe，通过REST接口 /activate_task 按设定比例发送
+普通对话和字谜委托(元任务调用solve_riddles子任务)，从 /stream 接收回复，输出端到端延迟分位数、吞吐和调度开销(JSON)
+
+每个客户端独占一个元任务模板(ChatWithUser的副本)，发出请求后等到回复再发下一个(闭环)，
+因此模拟服务上的每次推理都落在某个请求的关键路径上，调度开销 = 端到端耗时之和 - 模拟服务耗时之和
+默认去掉摘要任务，避免后台推理干扰开销的计算
+
+运行方式(在仓库根目录): python Benchmarks/bench_load.py --clients 4 --requests 200 --mix chat=0.7,riddle=0.3
+"""
+import os, sys, json, time, copy, random, socket, argparse, tempfile, statistics
+from threading import Thread, Lock, Barrier
+from queue import Queue, Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT) # 工具目录和日志文件都按仓库根目录的相对路径查找
+
+import yaml, requests
+from mock_openai import MockConfig, start_mock_server
+from XHmetrics import metrics
+
+RIDDLE_TRIGGER = '猜谜'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def build_config(base_url: str, clients: int, max_concurrency: int, stream: bool, summarize: bool) -> str:
+    """
+    以仓库的tasks.yaml为基础生成基准用的配置：后端换成模拟服务，把ChatWithUser复制成clients个元任务模板
+    :return: 临时配置文件路径
+    """
+    with open(os.path.join(ROOT, 'tasks.yaml'), 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config['backends'] = [{'name': 'mock', 'base_url': base_url, 'api_key': 'mock', 'max_concurrency': max_concurrency, 'stream': stream}]
+    config.pop('health_check_interval', None)
+    config.pop('trace_path', None)
+    config.pop('persistence', None)
+    chat = next(template for template in config['tasks'] if template['name'] == 'ChatWithUser')
+    templates = [template for template in config['tasks'] if template['name'] != 'ChatWithUser']
+    for i in range(clients):
+        clone = copy.deepcopy(chat)
+        clone['name'] = 'ChatWithUser_%d' % i
+        clone['backend'] = 'mock'
+        if not summarize:
+            clone.pop('summarizer', None)
+        templates.append(clone)
+    config['tasks'] = templates
+    fd, path = tempfile.mkstemp(suffix='.yaml', prefix='bench_load_')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+    return path
+
+
+def parse_mix(text: str) -> list:
+    # "chat=0.7,riddle=0.3" -> [('chat', 0.7), ('riddle', 0.3)]
+    mix = []
+    for part in text.split(','):
+        kind, weight = part.split('=')
+        if kind not in ('chat', 'riddle'):
+            raise ValueError('未知的请求类型: %s' % kind)
+        mix.append((kind, float(weight)))
+    return mix
+
+
+def subscribe(base: str, task_name: str, replies: Queue):
+    # 把某个元任务的reply事件转进队列
+    response = requests.get('%s/stream/%s' % (base, task_name), stream=True)
+    for line in response.iter_lines():
+        if line and line.startswith(b'data: '):
+            event = json.loads(line[6:])
+            if event['type'] == 'reply':
+                replies.put(time.perf_counter())
+
+
+def client(base: str, index: int, next_request, results: list, results_lock: Lock, warmup: int, barrier: Barrier, timeout: float):
+    task_name = 'ChatWithUser_%d' % index
+    replies = Queue()
+    Thread(target=subscribe, args=(base, task_name, replies), daemon=True).start()
+    time.sleep(0.2) # 等订阅建立
+    session = requests.Session()
+
+    def send(text):
+        start = time.perf_counter()
+        session.post('%s/activate_task' % base, json={'name': task_name, 'input': text, 'parent_uuid': ''})
+        try:
+            return replies.get(timeout=timeout) - start
+        except Empty:
+            return None
+
+    for i in range(warmup):
+        send('预热%d' % i)
+    barrier.wait() # 所有客户端预热完才开始计量，预热中的推理不会混进统计
+    while True:
+        item = next_request()
+        if item is None:
+            return
+        kind, text = item
+        latency = send(text)
+        with results_lock:
+            results.append((kind, latency))
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    rank = lambda q: values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+    return {'mean_ms': round(statistics.mean(values) * 1000, 2), 'p50_ms': round(rank(0.50) * 1000, 2),
+            'p95_ms': round(rank(0.95) * 1000, 2), 'p99_ms': round(rank(0.99) * 1000, 2), 'max_ms': round(values[-1] * 1000, 2)}
+
+
+def histogram_total(name: str):
+    # 某个直方图所有序列的 (总和, 次数)
+    with metrics.lock:
+        series = metrics.histograms.get(name, {}).values()
+        return sum(values[-2] for values in series), sum(values[-1] for values in series)
+
+
+def run(args):
+    mock_server, mock_stats = start_mock_server(0, MockConfig(args.latency, args.token_rate, args.reply_tokens, RIDDLE_TRIGGER))
+    config_path = build_config('http://127.0.0.1:%d/v1' % mock_server.server_port, args.clients, args.max_concurrency,
+                               not args.no_stream, args.summarize)
+    from XHserver import XingHe
+    port = free_port()
+    xinghe = XingHe(async_mode=args.async_mode, config_path=config_path)
+    xinghe.run(port=port)
+    base = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            requests.get(base + '/status', timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*parse_mix(args.mix))
+    lock = Lock()
+    counter = {'issued': 0}
+
+    def start_measuring():
+        # 预热结束后清零统计，之后的数据才计入结果
+        mock_stats.reset()
+        counter['queue_wait'] = histogram_total('xh_queue_wait_seconds')
+        counter['measured_start'] = time.perf_counter()
+
+    def next_request():
+        with lock:
+            if counter['issued'] >= args.requests:
+                return None
+            counter['issued'] += 1
+            n = counter['issued']
+            kind = rng.choices(kinds, weights)[0]
+            # 谜面默认各不相同，避免结果缓存命中掩盖真实开销
+            number = 0 if args.repeat_riddles else n
+            return kind, ('%s：第%d题' % (RIDDLE_TRIGGER, number) if kind == 'riddle' else '你好，这是第%d句' % n)
+
+    results = []
+    barrier = Barrier(args.clients, action=start_measuring)
+    threads = [Thread(target=client, args=(base, i, next_request, results, lock, args.warmup, barrier, args.timeout), daemon=True)
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - counter['measured_start']
+
+    completed = [latency for _, latency in results if latency is not None]
+    wait_sum, wait_count = histogram_total('xh_queue_wait_seconds')
+    wait_sum -= counter['queue_wait'][0]
+    wait_count -= counter['queue_wait'][1]
+    server = mock_stats.to_dict()
+    os.remove(config_path)
+    return {
+        'config': {'clients': args.clients, 'requests': args.requests, 'mix': args.mix, 'async': args.async_mode,
+                   'stream': not args.no_stream, 'max_concurrency': args.max_concurrency, 'latency_s': args.latency,
+                   'token_rate': args.token_rate, 'reply_tokens': args.reply_tokens},
+        'completed': len(completed),
+        'timeouts': len(results) - len(completed),
+        'duration_s': round(elapsed, 3),
+        'tasks_per_s': round(len(completed) / elapsed, 2) if elapsed else None,
+        'latency': percentiles(completed),
+        'latency_by_kind': {kind: percentiles([latency for k, latency in results if k == kind and latency is not None]) for kind in kinds},
+        'scheduler_overhead_ms': round((sum(completed) - server['service_seconds']) / len(completed) * 1000, 2) if completed else None,
+        'queue_wait_mean_ms': round(wait_sum / wait_count * 1000, 3) if wait_count else None,
+        'backend': server,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=4, help='并发客户端数，每个客户端一个元任务')
+    parser.add_argument('--requests', type=int, default=100, help='计入结果的请求总数')
+    parser.add_argument('--warmup', type=int, default=1, help='每个客户端的预热请求数')
+    parser.add_argument('--mix', default='chat=0.7,riddle=0.3', help='请求类型比例')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='使用asyncio调度器')
+    parser.add_argument('--no-stream', action='store_true', help='后端不使用流式输出')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='模拟后端的并发槽位数')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟服务首字延迟(秒)')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='模拟服务每秒输出token数，0表示一次性输出')
+    parser.add_argument('--reply-tokens', type=int, default=16)
+    parser.add_argument('--repeat-riddles', action='store_true', help='重复同一谜面，测量缓存命中时的表现')
+    parser.add_argument('--summarize', action='store_true', help='保留对话摘要任务')
+    parser.add_argument('--timeout', type=float, default=30.0, help='单个请求等待回复的超时(秒)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    sys.stdout.flush()
+    os._exit(0) # 服务器和调度器线程不是守护线程
@@ -0,0 +1,62 @@
+"""
+内存基准测试：创建大量空闲会话(每个会话是一个聊过几轮、回到Free状态的元任务)，测量每个会话占用的字节数
+推理结果使用openai库真实的ChatCompletion对象，工具集由所有会话共享，和XingHe中同一模板的任务一致
+
+运行方式(在仓库根目录): python Benchmarks/bench_memory.py --sessions 10000 --rounds 3
+"""
+import os, sys, gc, io, json, argparse, tracemalloc, contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai.types.chat import ChatCompletion
+from XingHeFarmworkNew import LLMTask, LLMTools
+from Tools.solve_riddles import solve_riddles
+
+
+def completion(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': 'qwen2.5:7b',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120},
+    })
+
+
+def make_session(tools: LLMTools, rounds: int, length: int) -> LLMTask:
+    task = LLMTask('ChatWithUser', 3, '你是星绘，是一个擅长调用函数的AI助手', tools)
+    for i in range(rounds):
+        task.set_input(('问题%d' % i).ljust(length, '。'))
+        task.forward()
+        task.set_response(completion(('回答%d' % i).ljust(length, '。')))
+        task.forward()
+        task.get_reply()
+    return task
+
+
+def measure(sessions: int, rounds: int, length: int) -> dict:
+    tools = LLMTools()
+    tools.add_tools([solve_riddles])
+    with contextlib.redirect_stdout(io.StringIO()):
+        make_session(tools, rounds, length) # 预热，让导入和类型缓存不计入结果
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    with contextlib.redirect_stdout(io.StringIO()): # LLMTask会打印收到的输入
+        kept = [make_session(tools, rounds, length) for _ in range(sessions)]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # 对话文本本身的大小，作为下限参考
+    text = sum(sys.getsizeof(('问题%d' % i).ljust(length, '。')) + sys.getsizeof(('回答%d' % i).ljust(length, '。')) for i in range(rounds))
+    del kept
+    return {'sessions': sessions, 'rounds': rounds, 'message_chars': length,
+            'bytes_per_session': round(total / sessions), 'text_bytes_per_session': text}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=3, help='每个会话聊过的轮数')
+    parser.add_argument('--length', type=int, default=20, help='每条消息的字符数')
+    args = parser.parse_args()
+    print(json.dumps(measure(args.sessions, args.rounds, args.length), indent=2, ensure_ascii=False))
@@ -0,0 +1,154 @@
+"""
+前缀缓存基准测试：启动模拟的OpenAI兼容服务并记录每次推理请求，在进程内运行XingHe，
+让default和prefix_stable两种上下文模式的元任务各自跑同一组多轮对话(普通对话和触发工具调用的字谜按比例混合)，
+统计同一会话相邻两次请求的公共前缀，输出后端可以复用KV缓存的token数和需要重新预填充的token数(JSON)
+
+公共前缀按消息逐条比较，工具列表序列化结果不同时视为没有可复用的前缀；token数用mock_openai.count_tokens估计
+默认去掉摘要任务，摘要压缩必然改写前缀，这里只比较对话窗口和工具历史的布局
+
+运行方式(在仓库根目录): python Benchmarks/bench_prefix_cache.py --clients 2 --turns 20 --budget 400
+"""
+import os, sys, json, time, copy, random, argparse, tempfile
+from threading import Thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT) # 工具目录和日志文件都按仓库根目录的相对路径查找
+
+import yaml, requests
+from mock_openai import MockConfig, start_mock_server, count_tokens
+from bench_load import free_port, RIDDLE_TRIGGER
+
+MODES = ['default', 'prefix_stable']
+
+
+def build_config(base_url: str, clients: int, budget: int) -> str:
+    """
+    以仓库的tasks.yaml为基础生成配置：后端换成模拟服务，每种上下文模式各复制clients个ChatWithUser
+    系统提示末尾加上模板名，用来把记录下的请求归到各自的会话
+    :return: 临时配置文件路径
+    """
+    with open(os.path.join(ROOT, 'tasks.yaml'), 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config['backends'] = [{'name': 'mock', 'base_url': base_url, 'api_key': 'mock', 'max_concurrency': 2 * clients}]
+    for key in ('health_check_interval', 'trace_path', 'persistence'):
+        config.pop(key, None)
+    chat = next(template for template in config['tasks'] if template['name'] == 'ChatWithUser')
+    templates = [template for template in config['tasks'] if template['name'] != 'ChatWithUser']
+    for mode in MODES:
+        for i in range(clients):
+            clone = copy.deepcopy(chat)
+            clone['name'] = 'Chat_%s_%d' % (mode, i)
+            clone['sysprompt'] += '#' + clone['name']
+            clone['backend'] = 'mock'
+            clone['context_mode'] = mode
+            clone['context_budget'] = budget
+            clone.pop('summarizer', None)
+            templates.append(clone)
+    config['tasks'] = templates
+    fd, path = tempfile.mkstemp(suffix='.yaml', prefix='bench_prefix_')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+    return path
+
+
+def script(seed: int, turns: int, riddle_ratio: float, length: int) -> list:
+    # 一个会话的输入序列，两种模式使用同一个种子，看到的对话完全相同
+    rng = random.Random(seed)
+    return [('%s：第%d题' % (RIDDLE_TRIGGER, i) if rng.random() < riddle_ratio else '你好，这是第%d句' % i).ljust(length, '。')
+            for i in range(turns)]
+
+
+def converse(base: str, task_name: str, inputs: list, timeout: float):
+    session = requests.Session()
+    for text in inputs:
+        request_id = session.post('%s/activate_task' % base, json={'name': task_name, 'input': text}).json()['request_id']
+        session.get('%s/result/%s' % (base, request_id), params={'timeout': timeout})
+
+
+def common_prefix(previous: list, current: list) -> int:
+    # 两次请求从头开始逐条相同的消息数
+    count = 0
+    for old, new in zip(previous, current):
+        if old != new:
+            break
+        count += 1
+    return count
+
+
+def analyze(prompts: list) -> dict:
+    # 按系统提示把请求归到会话，会话内按到达顺序两两比较
+    sessions = {}
+    for body in prompts:
+        sysprompt = body['messages'][0]['content']
+        if '#Chat_' in sysprompt:
+            sessions.setdefault(sysprompt.rsplit('#', 1)[1], []).append(body)
+    result = {mode: {'requests': 0, 'prompt_tokens': 0, 'reused_tokens': 0} for mode in MODES}
+    for name, bodies in sessions.items():
+        stats = result[name.split('_', 1)[1].rsplit('_', 1)[0]]
+        previous = None
+        for body in bodies:
+            messages = body['messages']
+            stats['requests'] += 1
+            stats['prompt_tokens'] += count_tokens(messages)
+            if previous is not None and json.dumps(previous.get('tools')) == json.dumps(body.get('tools')):
+                stats['reused_tokens'] += count_tokens(messages[:common_prefix(previous['messages'], messages)])
+            previous = body
+    for stats in result.values():
+        stats['prefill_tokens'] = stats['prompt_tokens'] - stats['reused_tokens']
+        stats['reuse_ratio'] = round(stats['reused_tokens'] / stats['prompt_tokens'], 4) if stats['prompt_tokens'] else None
+    return result
+
+
+def run(args):
+    mock_server, mock_stats = start_mock_server(0, MockConfig(tool_trigger=RIDDLE_TRIGGER))
+    mock_stats.record_prompts = True
+    config_path = build_config('http://127.0.0.1:%d/v1' % mock_server.server_port, args.clients, args.budget)
+    from XHserver import XingHe
+    port = free_port()
+    xinghe = XingHe(async_mode=args.async_mode, config_path=config_path)
+    xinghe.run(port=port)
+    base = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            requests.get(base + '/status', timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+    threads = []
+    for mode in MODES:
+        for i in range(args.clients):
+            inputs = script(args.seed + i, args.turns, args.riddle_ratio, args.length)
+            threads.append(Thread(target=converse, args=(base, 'Chat_%s_%d' % (mode, i), inputs, args.timeout), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    os.remove(config_path)
+    with mock_stats.lock:
+        prompts = list(mock_stats.prompts)
+    return {
+        'config': {'clients': args.clients, 'turns': args.turns, 'budget': args.budget, 'riddle_ratio': args.riddle_ratio,
+                   'message_chars': args.length, 'async': args.async_mode},
+        'modes': analyze(prompts),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=2, help='每种模式的并发会话数')
+    parser.add_argument('--turns', type=int, default=20, help='每个会话的对话轮数')
+    parser.add_argument('--budget', type=int, default=400, help='元任务的上下文预算(token)，足够小时窗口会滑动')
+    parser.add_argument('--riddle-ratio', type=float, default=0.3, help='触发工具调用的输入比例')
+    parser.add_argument('--length', type=int, default=20, help='每条输入的字符数')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='使用asyncio调度器')
+    parser.add_argument('--timeout', type=float, default=30.0, help='单轮等待回复的超时(秒)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    sys.stdout.flush()
+    os._exit(0) # 服务器和调度器线程不是守护线程
@@ -0,0 +1,98 @@
+"""
+调度延迟基准测试：对比旧版0.5秒轮询调度与事件驱动调度
+使用桩推理器替换真实的ollama，只测量调度本身带来的延迟
+
+运行方式(在仓库根目录): python Benchmarks/bench_scheduler_latency.py --rounds 10
+"""
+import os, sys, json, time, asyncio, argparse, statistics
+from threading import Thread, Lock
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from XHserver import XingHe
+from XingHeFarmworkNew import LLMTask, LLMTools, Inference, InferenceRouter
+from Tools.subtract_two_numbers import subtract_two_numbers
+
+
+class StubInference(Inference):
+    """
+    桩推理器：第一次推理返回一次工具调用，拿到工具结果后返回最终回复
+    """
+    def __init__(self, delay=0.0, max_concurrency=1):
+        super().__init__(base_url='http://127.0.0.1:1/v1', api_key='stub', max_concurrency=max_concurrency, name='stub')
+        self.delay = delay
+
+    def infer(self, model: str, messages: list, tools: list = [], on_token=None, cancel=None):
+        time.sleep(self.delay)
+        return self._reply(messages)
+
+    async def ainfer(self, model: str, messages: list, tools: list = [], on_token=None):
+        await asyncio.sleep(self.delay)
+        return self._reply(messages)
+
+    def _reply(self, messages: list):
+        if messages[-1]['role'] == 'tool':
+            message = SimpleNamespace(content='结果是 %s' % messages[-1]['content'], tool_calls=None)
+        else:
+            function = SimpleNamespace(name='subtract_two_numbers', arguments=json.dumps({'a': 3, 'b': 1}))
+            message = SimpleNamespace(content='', tool_calls=[SimpleNamespace(id='call_0', function=function)])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class PollingScheduler(XingHe.Scheduler):
+    """
+    复现旧版行为：每0.5秒醒来扫描一次
+    """
+    def _wait_for_work(self):
+        time.sleep(0.5)
+
+
+def measure(scheduler_class, rounds: int, infer_delay: float):
+    """
+    跑若干轮 Free->ReUser->ToolCall->ReTool->Ready 的完整流程，返回每轮耗时(秒)
+    :param scheduler_class: 调度器类
+    :param rounds: 轮数
+    :param infer_delay: 桩推理器每次推理耗时(秒)
+    """
+    router = InferenceRouter([StubInference(infer_delay)])
+    scheduler = scheduler_class([], {}, Lock(), Lock(), router=router)
+    if not isinstance(scheduler, XingHe.AsyncScheduler):
+        for _ in range(router.capacity):
+            Thread(target=scheduler.infer, daemon=True).start()
+    Thread(target=scheduler.run, daemon=True).start()
+
+    durations = []
+    for i in range(rounds):
+        llmtools = LLMTools()
+        llmtools.add_tools([subtract_two_numbers])
+        task = LLMTask('bench', 3, 'bench', llmtools)
+        task.set_input('3减1等于几')
+        start = time.perf_counter()
+        task.forward()
+        scheduler.add_task(task)
+        task.events['end'].wait()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations: list):
+    return {
+        'mean_ms': round(statistics.mean(durations) * 1000, 2),
+        'p50_ms': round(statistics.median(durations) * 1000, 2),
+        'max_ms': round(max(durations) * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--infer-delay', type=float, default=0.0, help='桩推理器每次推理耗时(秒)')
+    args = parser.parse_args()
+
+    result = {
+        'polling': summarize(measure(PollingScheduler, args.rounds, args.infer_delay)),
+        'event_driven': summarize(measure(XingHe.Scheduler, args.rounds, args.infer_delay)),
+        'asyncio': summarize(measure(XingHe.AsyncScheduler, args.rounds, args.infer_delay)),
+    }
+    print(json.dumps(result, indent=2))
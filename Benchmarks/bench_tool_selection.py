@@ -0,0 +1,115 @@
+"""
+工具筛选基准测试：合成许多工具(英文描述、中文keywords)，让元任务按多轮对话逐轮接收输入，
+比较发送全部工具和按输入筛选工具时每次推理的工具列表token数，并统计所需工具的召回率和相邻两轮工具列表变化的比例(JSON)
+对话中有寒暄，也有连续几轮围绕同一类工具的追问，和真实会话一样
+
+运行方式(在仓库根目录): python Benchmarks/bench_tool_selection.py --tools 60 --top-k 4 --sessions 200 --turns 8
+"""
+import os, sys, io, json, random, argparse, contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from XingHeFarmworkNew import LLMTask, LLMTools, ToolSelector, estimate_tokens
+from bench_memory import completion
+
+# (英文名词, 中文关键词)
+DOMAINS = [('weather', ['天气', '气温', '下雨']), ('calendar event', ['日程', '会议', '日历']), ('email', ['邮件', '邮箱']),
+           ('exchange rate', ['汇率', '换算', '外币']), ('translation', ['翻译', '译文']), ('flight', ['航班', '机票', '飞机']),
+           ('hotel booking', ['酒店', '住宿']), ('stock quote', ['股票', '股价']), ('news article', ['新闻', '头条']),
+           ('reminder', ['提醒', '闹钟']), ('contact', ['联系人', '通讯录']), ('note', ['笔记', '备忘录']),
+           ('music track', ['音乐', '歌曲']), ('map route', ['路线', '导航', '地图']), ('recipe', ['菜谱', '做菜']),
+           ('package delivery', ['快递', '包裹']), ('movie showtime', ['电影', '影院']), ('train ticket', ['火车', '高铁', '车票']),
+           ('expense record', ['账单', '记账', '花销']), ('smart light', ['灯', '灯光'])]
+# (函数名后缀, 英文动作, 中文关键词)
+ACTIONS = [('get', 'Look up the', ['查询', '查看', '查一下']), ('create', 'Create a new', ['创建', '新建', '添加']),
+           ('delete', 'Delete the', ['删除', '取消'])]
+VERBS = {keyword for action in ACTIONS for keyword in action[2]}
+SMALL_TALK = ['你好', '谢谢你', '好的，明白了', '你是谁', '今天心情不错', '再见']
+
+
+def make_tool(domain, action):
+    noun, noun_keywords = domain
+    suffix, verb, verb_keywords = action
+    name = '%s_%s' % (noun.replace(' ', '_'), suffix)
+    description = {'type': 'function', 'function': {
+        'name': name,
+        'description': '%s %s for the user' % (verb, noun),
+        'parameters': {'type': 'object', 'required': ['query'],
+                       'properties': {'query': {'type': 'string', 'description': 'Details of the %s' % noun},
+                                      'date': {'type': 'string', 'description': 'Optional date, YYYY-MM-DD'}}},
+    }, 'is_meta': False}
+    return type(name, (), {'description': description, 'prompt': ['稍等，我处理一下'], 'keywords': noun_keywords + verb_keywords,
+                           'function': staticmethod(lambda query, date=None: query)})
+
+
+def make_tools(count: int) -> LLMTools:
+    tools = LLMTools()
+    tools.add_tools([make_tool(domain, action) for action in ACTIONS for domain in DOMAINS][:count])
+    return tools
+
+
+def make_conversation(rng: random.Random, tools: LLMTools, turns: int, follow: float) -> list:
+    """
+    :return: [(输入, 需要的工具名或None)]，follow为下一轮继续使用同一类工具的概率
+    """
+    names = list(tools.available_functions)
+    conversation, current = [], None
+    for _ in range(turns):
+        if rng.random() < 0.25:
+            conversation.append((rng.choice(SMALL_TALK), None))
+            continue
+        if current is None or rng.random() >= follow:
+            current = tools.tool_classes[rng.choice(names)]
+        noun = rng.choice([keyword for keyword in current.keywords if keyword not in VERBS])
+        verb = rng.choice([keyword for keyword in current.keywords if keyword in VERBS])
+        conversation.append((rng.choice(['帮我%s%s', '麻烦%s一下明天的%s', '我想%s%s，谢谢']) % (verb, noun), current.description['function']['name']))
+    return conversation
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    tools = make_tools(args.tools)
+    selector = ToolSelector(tools, top_k=args.top_k, min_ratio=args.min_ratio)
+    full_tokens = estimate_tokens(json.dumps(tools.schema(), ensure_ascii=False))
+    sent, needed, hits, changes, follow_turns = [], 0, 0, 0, 0
+    for session in range(args.sessions):
+        task = LLMTask('ChatWithUser', 3, '你是星绘，是一个擅长调用函数的AI助手', tools, tool_selector=selector)
+        previous = None
+        for turn, (text, tool_name) in enumerate(make_conversation(rng, tools, args.turns, args.follow)):
+            with contextlib.redirect_stdout(io.StringIO()): # LLMTask会打印收到的输入
+                task.set_input(text)
+                task.forward()
+            schema = task.tool_schema()
+            sent.append(estimate_tokens(json.dumps(schema, ensure_ascii=False)))
+            if tool_name is not None:
+                needed += 1
+                hits += any(tool['function']['name'] == tool_name for tool in schema)
+            if previous is not None:
+                follow_turns += 1
+                changes += schema is not previous
+            previous = schema
+            with contextlib.redirect_stdout(io.StringIO()):
+                task.set_response(completion('好的'))
+                task.forward()
+                task.get_reply()
+    selected_tokens = sum(sent) / len(sent)
+    return {'tools': len(tools.tools), 'top_k': args.top_k, 'min_ratio': args.min_ratio, 'turns': len(sent),
+            'schema_tokens_full': full_tokens, 'schema_tokens_selected': round(selected_tokens, 1),
+            'saved_ratio': round(1 - selected_tokens / full_tokens, 3),
+            'recall': round(hits / needed, 3) if needed else None,
+            'tool_list_change_ratio': round(changes / follow_turns, 3) if follow_turns else None,
+            'cached_subsets': len(selector.subsets)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tools', type=int, default=60, help='合成的工具数，最多%d' % (len(DOMAINS) * len(ACTIONS)))
+    parser.add_argument('--top-k', type=int, default=4, help='每轮最多选中的工具数')
+    parser.add_argument('--min-ratio', type=float, default=0.5, help='选中工具的分数至少是最高分的这么多倍')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--turns', type=int, default=8, help='每个会话的轮数')
+    parser.add_argument('--follow', type=float, default=0.6, help='下一轮继续使用同一个工具的概率')
+    parser.add_argument('--seed', type=int, default=0)
+    print(json.dumps(run(parser.parse_args()), indent=2, ensure_ascii=False))
@@ -0,0 +1,120 @@
+"""
+传输层基准测试：启动两个模拟的OpenAI兼容服务，按比例注入卡顿和503错误，
+多个客户端像调度器的推理工作者一样先占用槽位再经InferenceRouter推理，
+依次比较不重试、重试、重试加对冲三种配置下的推理延迟分位数和失败数(JSON)
+
+运行方式(在仓库根目录): python Benchmarks/bench_transport.py --requests 400 --stall-ratio 0.02 --error-ratio 0.01
+"""
+import os, sys, json, time, argparse
+from threading import Thread, Lock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from XingHeFarmworkNew import InferenceRouter
+from XHmetrics import metrics
+from mock_openai import MockConfig, start_mock_server
+from bench_load import percentiles
+
+MODES = {
+    'no_retry': {'max_retries': 0, 'hedge': None},
+    'retry': {'max_retries': 2, 'hedge': None},
+    'retry_hedge': {'max_retries': 2, 'hedge': {'quantile': 0.95, 'min_samples': 20}},
+}
+
+
+def build_router(base_urls: list, args, max_retries: int, hedge) -> InferenceRouter:
+    backends = [{'name': 'mock%d' % i, 'base_url': base_url, 'api_key': 'mock', 'max_concurrency': args.max_concurrency,
+                 'stream': args.stream, 'timeout': args.timeout, 'max_retries': max_retries, 'retry_backoff': 0.05}
+                for i, base_url in enumerate(base_urls)]
+    return InferenceRouter.from_config(backends, hedge=hedge)
+
+
+def infer_once(router: InferenceRouter, index: int) -> float:
+    """
+    像推理工作者一样：等到有空闲槽位的后端，再交给路由器推理
+    :return: 推理耗时(秒)，失败时抛出异常
+    """
+    while True:
+        backend = router.acquire()
+        if backend is not None:
+            break
+        time.sleep(0.001)
+    start = time.perf_counter()
+    router.infer(backend, 'mock', [{'role': 'user', 'content': '你好%d' % index}])
+    return time.perf_counter() - start
+
+
+def run_mode(base_urls: list, args, mode: str) -> dict:
+    router = build_router(base_urls, args, **MODES[mode])
+    # 预热：让对冲有足够的耗时样本算出分位数
+    for i in range(args.warmup):
+        try:
+            infer_once(router, i)
+        except Exception:
+            pass
+    hedges_before = metric_total('xh_inference_hedges_total')
+    retries_before = metric_total('xh_inference_retries_total')
+    lock = Lock()
+    counter = {'issued': 0}
+    latencies, failures = [], []
+
+    def client():
+        while True:
+            with lock:
+                counter['issued'] += 1
+                index = counter['issued']
+            if index > args.requests:
+                return
+            try:
+                latency = infer_once(router, index)
+            except Exception as e:
+                with lock:
+                    failures.append(type(e).__name__)
+                continue
+            with lock:
+                latencies.append(latency)
+
+    start = time.perf_counter()
+    threads = [Thread(target=client, daemon=True) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'mode': mode, 'completed': len(latencies), 'failed': len(failures), 'duration_s': round(elapsed, 3),
+            'hedges': metric_total('xh_inference_hedges_total') - hedges_before,
+            'retries': metric_total('xh_inference_retries_total') - retries_before,
+            'latency': percentiles(latencies)}
+
+
+def metric_total(name: str) -> float:
+    # 累加某个计数器所有标签组合的值
+    with metrics.lock:
+        return sum(metrics.counters.get(name, {}).values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default=','.join(MODES), help='依次测试的配置')
+    parser.add_argument('--clients', type=int, default=8, help='并发客户端数')
+    parser.add_argument('--requests', type=int, default=400, help='每种配置计入结果的请求数')
+    parser.add_argument('--warmup', type=int, default=64, help='每种配置预热的请求数')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='每个后端的并发槽位数')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟服务首字延迟(秒)')
+    parser.add_argument('--stall-ratio', type=float, default=0.02, help='卡顿的请求比例')
+    parser.add_argument('--stall-seconds', type=float, default=2.0, help='卡顿时长(秒)')
+    parser.add_argument('--error-ratio', type=float, default=0.01, help='返回503的请求比例')
+    parser.add_argument('--timeout', type=float, default=30.0, help='单次推理的截止时间(秒)')
+    parser.add_argument('--stream', action='store_true', help='以流式请求推理')
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, stall_ratio=args.stall_ratio, stall_seconds=args.stall_seconds, error_ratio=args.error_ratio)
+    servers = [start_mock_server(0, config)[0] for _ in range(2)]
+    base_urls = ['http://127.0.0.1:%d/v1' % server.server_port for server in servers]
+    runs = [run_mode(base_urls, args, mode) for mode in args.modes.split(',')]
+    print(json.dumps({'config': {'clients': args.clients, 'requests': args.requests, 'latency_s': args.latency,
+                                 'stall_ratio': args.stall_ratio, 'stall_seconds': args.stall_seconds,
+                                 'error_ratio': args.error_ratio, 'stream': args.stream},
+                      'runs': runs}, indent=2, ensure_ascii=False))
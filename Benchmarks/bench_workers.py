@@ -0,0 +1,112 @@
+"""
+多进程基准测试：启动模拟的OpenAI兼容服务，用sqlite任务存储启动一个只做REST前端的XingHe进程和N个调度工作进程
+(python XHserver.py --frontend-only --workers N)，许多客户端各用一个会话闭环发送对话，从 /result 长轮询取回复，
+输出不同工作进程数下的吞吐和端到端延迟分位数(JSON)，用于观察调度和推理派发能否随进程数扩展
+
+每个工作进程有自己的推理槽位，模拟后端的总并发是 工作进程数 * max_concurrency；
+模拟服务和客户端都在本进程里，前端和它们的开销不随工作进程数减少，结果反映的是调度和推理派发部分的扩展
+
+运行方式(在仓库根目录): python Benchmarks/bench_workers.py --workers 1,2,4 --clients 32 --requests 400
+"""
+import os, sys, json, time, shutil, signal, argparse, tempfile, subprocess
+from threading import Thread, Lock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+import yaml, requests
+from mock_openai import MockConfig, start_mock_server
+from bench_load import build_config, free_port, percentiles
+
+
+def write_config(base_url: str, max_concurrency: int, store_path: str) -> str:
+    """
+    在bench_load的配置上加sqlite任务存储，所有客户端共用一个元任务模板，各自一个会话
+    :return: 临时配置文件路径
+    """
+    path = build_config(base_url, 1, max_concurrency, True, False)
+    with open(path, 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config['task_store'] = {'type': 'sqlite', 'path': store_path}
+    config['workers'] = {'poll_interval': 0.01}
+    config['sessions'] = {'max_sessions': 100000, 'idle_timeout': 0}
+    with open(path, 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+    return path
+
+
+def client(base: str, index: int, next_request, results: list, lock: Lock, timeout: float):
+    session = requests.Session()
+    while next_request():
+        start = time.perf_counter()
+        accepted = session.post('%s/activate_task' % base, json={'name': 'ChatWithUser_0', 'input': '你好',
+                                                                  'session_id': 'client%d' % index}).json()
+        result = session.get('%s/result/%s' % (base, accepted['request_id']), params={'timeout': timeout}).json()
+        with lock:
+            results.append(time.perf_counter() - start if result['state'] == 'done' else None)
+
+
+def run_once(args, workers: int, base_url: str) -> dict:
+    store_dir = tempfile.mkdtemp(prefix='bench_workers_')
+    config_path = write_config(base_url, args.max_concurrency, os.path.join(store_dir, 'tasks.sqlite'))
+    port = free_port()
+    base = 'http://127.0.0.1:%d' % port
+    server = subprocess.Popen([sys.executable, 'XHserver.py', '--config', config_path, '--port', str(port),
+                               '--workers', str(workers), '--frontend-only'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        for _ in range(300):
+            try:
+                requests.get(base + '/status', timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        # 预热：每个客户端一轮，等工作进程都启动好
+        warm = [requests.post('%s/activate_task' % base, json={'name': 'ChatWithUser_0', 'input': '预热', 'session_id': 'client%d' % i}).json()
+                for i in range(args.clients)]
+        for accepted in warm:
+            requests.get('%s/result/%s' % (base, accepted['request_id']), params={'timeout': 60})
+
+        lock = Lock()
+        counter = {'issued': 0}
+
+        def next_request():
+            with lock:
+                counter['issued'] += 1
+                return counter['issued'] <= args.requests
+
+        results = []
+        start = time.perf_counter()
+        threads = [Thread(target=client, args=(base, i, next_request, results, lock, args.timeout), daemon=True) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+        os.remove(config_path)
+        shutil.rmtree(store_dir, ignore_errors=True)
+    completed = [latency for latency in results if latency is not None]
+    return {'workers': workers, 'completed': len(completed), 'failed': len(results) - len(completed), 'duration_s': round(elapsed, 3),
+            'tasks_per_s': round(len(completed) / elapsed, 2) if elapsed else None, 'latency': percentiles(completed)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help='依次测试的工作进程数')
+    parser.add_argument('--clients', type=int, default=32, help='并发客户端数，每个客户端一个会话')
+    parser.add_argument('--requests', type=int, default=400, help='每种工作进程数下计入结果的请求总数')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='每个工作进程的推理槽位数')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟服务首字延迟(秒)')
+    parser.add_argument('--timeout', type=float, default=60.0, help='单个请求等待回复的超时(秒)')
+    args = parser.parse_args()
+
+    mock_server, _ = start_mock_server(0, MockConfig(args.latency))
+    base_url = 'http://127.0.0.1:%d/v1' % mock_server.server_port
+    runs = [run_once(args, int(workers), base_url) for workers in args.workers.split(',')]
+    print(json.dumps({'config': {'clients': args.clients, 'requests': args.requests, 'max_concurrency': args.max_concurrency,
+                                 'latency_s': args.latency}, 'runs': runs}, indent=2, ensure_ascii=False))
@@ -0,0 +1,217 @@
+"""
+模拟的OpenAI兼容推理服务，用于在没有真实模型的情况下测量框架本身的吞吐和延迟
+支持 /v1/chat/completions (流式和非流式) 和 /v1/models，
+可配置首字延迟、出字速率、回复长度，以及在用户消息包含触发词时发起工具调用；
+还可以按比例注入卡顿(长时间不输出)和503错误，用于测试超时、重试和对冲
+
+单独运行(在仓库根目录): python Benchmarks/mock_openai.py --port 18080 --latency 0.05 --token-rate 200
+"""
+import json, time, uuid, random, argparse
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockConfig:
+    """
+    模拟服务的行为参数
+    :param latency: 收到请求到开始输出的延迟(秒)，模拟预填充
+    :param token_rate: 每秒输出的token数，0表示一次性输出
+    :param reply_tokens: 普通回复的token数
+    :param tool_trigger: 最后一条用户消息包含该字符串且请求带了工具时，调用第一个工具
+    :param stall_ratio: 以这个比例在输出前额外卡住stall_seconds秒
+    :param stall_seconds: 卡顿时长(秒)
+    :param error_ratio: 以这个比例直接返回503
+    """
+    def __init__(self, latency=0.0, token_rate=0.0, reply_tokens=16, tool_trigger='猜谜', stall_ratio=0.0, stall_seconds=5.0, error_ratio=0.0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.tool_trigger = tool_trigger
+        self.stall_ratio = stall_ratio
+        self.stall_seconds = stall_seconds
+        self.error_ratio = error_ratio
+
+
+class MockStats:
+    """
+    服务端统计：请求数、token数和服务耗时，基准测试用它扣除模型本身的耗时
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.tool_calls = 0
+        self.stalls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.service_seconds = 0.0
+        self.prompts = [] # 开启record_prompts时记录每次请求的消息，供前缀复用等分析使用
+        self.record_prompts = False
+
+    def reset(self):
+        with self.lock:
+            self.requests = self.tool_calls = self.stalls = self.errors = self.prompt_tokens = self.completion_tokens = 0
+            self.service_seconds = 0.0
+            self.prompts = []
+
+    def add(self, body, prompt_tokens, completion_tokens, tool_call, seconds):
+        with self.lock:
+            self.requests += 1
+            self.tool_calls += int(tool_call)
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.service_seconds += seconds
+            if self.record_prompts:
+                self.prompts.append(body)
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'tool_calls': self.tool_calls, 'stalls': self.stalls, 'errors': self.errors, 'prompt_tokens': self.prompt_tokens,
+                    'completion_tokens': self.completion_tokens, 'service_seconds': round(self.service_seconds, 4)}
+
+
+def count_tokens(messages: list) -> int:
+    # 粗略估计，和真实分词器无关，只需要在多次运行之间保持一致
+    return sum(len(str(message.get('content') or '')) // 4 + 4 for message in messages)
+
+
+def fill_arguments(tool: dict) -> dict:
+    # 按工具参数表的必填项生成参数
+    parameters = tool.get('function', {}).get('parameters', {})
+    properties = parameters.get('properties', {})
+    arguments = {}
+    for name in parameters.get('required', []):
+        kind = properties.get(name, {}).get('type')
+        arguments[name] = 1 if kind in ('integer', 'number') else 'mock-%s' % uuid.uuid4().hex[:8]
+    return arguments
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # 小块写出时避免Nagle和延迟确认叠加出40ms级的假延迟
+    config = MockConfig()
+    stats = MockStats()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json({'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'owned_by': 'mock'}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        start = time.perf_counter()
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if random.random() < self.config.error_ratio:
+            with self.stats.lock:
+                self.stats.errors += 1
+            self._send_json({'error': {'message': 'mock overloaded', 'type': 'server_error'}}, 503)
+            return
+        messages = body.get('messages', [])
+        tools = body.get('tools') or []
+        last = messages[-1] if messages else {}
+        tool_call = None
+        if tools and last.get('role') == 'user' and self.config.tool_trigger in str(last.get('content')):
+            tool = tools[0]
+            tool_call = {'id': 'call_%s' % uuid.uuid4().hex[:12], 'type': 'function',
+                         'function': {'name': tool['function']['name'], 'arguments': json.dumps(fill_arguments(tool))}}
+            pieces = []
+        elif last.get('role') == 'tool':
+            pieces = ['答案是', str(last.get('content'))]
+        else:
+            pieces = ['嗯'] * self.config.reply_tokens
+        prompt_tokens = count_tokens(messages)
+        completion_tokens = len(pieces) if tool_call is None else 8
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+        time.sleep(self.config.latency)
+        if random.random() < self.config.stall_ratio:
+            with self.stats.lock:
+                self.stats.stalls += 1
+            time.sleep(self.config.stall_seconds)
+        if body.get('stream'):
+            self._stream(body, pieces, tool_call, usage)
+        else:
+            if self.config.token_rate:
+                time.sleep(completion_tokens / self.config.token_rate)
+            message = {'role': 'assistant', 'content': ''.join(pieces)}
+            if tool_call:
+                message['tool_calls'] = [tool_call]
+            self._send_json({'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                             'choices': [{'index': 0, 'message': message, 'finish_reason': 'tool_calls' if tool_call else 'stop'}],
+                             'usage': usage})
+        self.stats.add(body, prompt_tokens, completion_tokens, tool_call is not None, time.perf_counter() - start)
+
+    def _stream(self, body, pieces, tool_call, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        base = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model')}
+
+        def send(choices, **extra):
+            self.wfile.write(b'data: ' + json.dumps(dict(base, choices=choices, **extra), ensure_ascii=False).encode() + b'\n\n')
+            self.wfile.flush()
+
+        send([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+        for piece in pieces:
+            if self.config.token_rate:
+                time.sleep(1 / self.config.token_rate)
+            send([{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+        if tool_call:
+            send([{'index': 0, 'delta': {'tool_calls': [dict(tool_call, index=0)]}, 'finish_reason': None}])
+        send([{'index': 0, 'delta': {}, 'finish_reason': 'tool_calls' if tool_call else 'stop'}])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            send([], usage=usage)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_mock_server(port=0, config: MockConfig = None):
+    """
+    在后台线程启动模拟服务
+    :param port: 端口号，0表示随机空闲端口
+    :param config: 行为参数
+    :return: (服务器实例, 统计实例)，base_url为 http://127.0.0.1:<server.server_port>/v1
+    """
+    handler = type('BoundMockHandler', (MockHandler,), {'config': config or MockConfig(), 'stats': MockStats()})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.0, help='首字延迟(秒)')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='每秒输出token数，0表示一次性输出')
+    parser.add_argument('--reply-tokens', type=int, default=16)
+    parser.add_argument('--tool-trigger', default='猜谜')
+    parser.add_argument('--stall-ratio', type=float, default=0.0, help='卡顿的请求比例')
+    parser.add_argument('--stall-seconds', type=float, default=5.0)
+    parser.add_argument('--error-ratio', type=float, default=0.0, help='返回503的请求比例')
+    args = parser.parse_args()
+    server, _ = start_mock_server(args.port, MockConfig(args.latency, args.token_rate, args.reply_tokens, args.tool_trigger,
+                                                        args.stall_ratio, args.stall_seconds, args.error_ratio))
+    print('mock OpenAI server on http://127.0.0.1:%d/v1' % server.server_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,5 +1,3 @@
-import requests
-
 class solve_riddles:
     description = {
             'type': 'function',
@@ -19,8 +17,10 @@ class solve_riddles:
 
     prompt = ["我问问专业人士"]
 
-    def function(question: str, uuid: str):
-        url = 'http://127.0.0.1:5000/activate_task'
-        message_dict = {"name": "solve_riddles", "input": question, "parent_uuid": uuid}
-        response = requests.post(url, json=message_dict)
-        #print("接收到响应: %s",response)
+    keywords = ["字谜", "谜语", "猜谜", "谜面", "谜底"] # 供模板开启tool_selection时检索
+
+    execution = {'mode': 'inline'} # 只是创建子任务，立即返回
+
+    def function(question: str, uuid: str, spawn_subtask):
+        # spawn_subtask由框架注入，在进程内创建子任务，结果会在子任务完成后写回
+        return spawn_subtask("solve_riddles", question, uuid)
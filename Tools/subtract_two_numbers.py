@@ -18,6 +18,12 @@ class subtract_two_numbers:
 
     prompt = ["我用计算器算一下"]
 
+    keywords = ["计算", "减法", "减去", "相减", "差"] # 供模板开启tool_selection时检索
+
+    cache = {'max_entries': 1024} # 纯函数，相同参数直接返回缓存结果
+
+    execution = {'mode': 'inline'} # 瞬间完成，不必交给线程池
+
     def function(a: int, b: int) -> int:
         """
         Subtract two numbers
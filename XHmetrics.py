@@ -0,0 +1,127 @@
+from threading import Lock, Thread
+from queue import Queue
+import json, time, bisect
+
+# 调度器内置的指标收集：计数器、瞬时值和直方图，按Prometheus文本格式导出，可选地把事件追加写入JSONL轨迹文件
+# 模块级的metrics实例由框架各处直接使用，和logger一样不需要传来传去
+
+# 延迟直方图默认的桶边界(秒)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.meta = {} # 指标名 -> (类型, 说明)
+        self.counters = {} # 指标名 -> {标签元组: 值}
+        self.gauges = {}
+        self.histograms = {} # 指标名 -> {标签元组: [各桶计数..., 总和, 次数]}
+        self.buckets = {} # 指标名 -> 桶边界
+        self.trace_queue = None
+
+    def describe(self, name: str, kind: str, help: str, buckets=LATENCY_BUCKETS):
+        # 登记指标的类型(counter/gauge/histogram)和说明
+        self.meta[name] = (kind, help)
+        if kind == 'histogram':
+            self.buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def add_gauge(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets.get(name, LATENCY_BUCKETS)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * (len(buckets) + 2)
+            values[bisect.bisect_left(buckets, value)] += 1 # 只记落入的那个桶，导出时再累加
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self) -> str:
+        # 导出Prometheus文本格式
+        lines = []
+        with self.lock:
+            for kind, store in (('counter', self.counters), ('gauge', self.gauges)):
+                for name, series in sorted(store.items()):
+                    self._header(lines, name, kind)
+                    for key, value in series.items():
+                        lines.append(f'{name}{self._labels(key)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                self._header(lines, name, 'histogram')
+                buckets = self.buckets.get(name, LATENCY_BUCKETS)
+                for key, values in series.items():
+                    cumulative = 0
+                    for bound, count in zip(buckets, values):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self._labels(key, le=bound)} {cumulative}')
+                    lines.append(f'{name}_bucket{self._labels(key, le="+Inf")} {values[-1]}')
+                    lines.append(f'{name}_sum{self._labels(key)} {values[-2]}')
+                    lines.append(f'{name}_count{self._labels(key)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        kind, help = self.meta.get(name, (kind, name))
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    @staticmethod
+    def _labels(key, **extra):
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def enable_trace(self, path: str):
+        # 开启JSONL轨迹，由后台线程写文件，热路径上只做一次入队
+        if self.trace_queue is not None:
+            return
+        self.trace_queue = Queue()
+        Thread(target=self._trace_writer, args=(path,), daemon=True, name='metrics-trace').start()
+
+    def trace(self, event: str, **fields):
+        if self.trace_queue is not None:
+            fields['event'] = event
+            fields['ts'] = time.time()
+            self.trace_queue.put(fields)
+
+    def _trace_writer(self, path):
+        with open(path, 'a', encoding='utf-8') as file:
+            while True:
+                record = self.trace_queue.get()
+                file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                if self.trace_queue.empty():
+                    file.flush()
+
+
+metrics = Metrics()
+metrics.describe('xh_task_state_seconds', 'histogram', 'Time a task spent in each LLMTask state')
+metrics.describe('xh_queue_wait_seconds', 'histogram', 'Time a ready task waited before inference dispatch')
+metrics.describe('xh_inference_seconds', 'histogram', 'Inference request latency')
+metrics.describe('xh_tool_seconds', 'histogram', 'Tool call latency')
+metrics.describe('xh_tool_errors_total', 'counter', 'Failed tool calls by error kind')
+metrics.describe('xh_inference_tokens_total', 'counter', 'Tokens reported in response usage')
+metrics.describe('xh_inference_errors_total', 'counter', 'Failed inference requests')
+metrics.describe('xh_tasks_in_flight', 'gauge', 'Tasks currently held by the scheduler')
+metrics.describe('xh_inference_in_flight', 'gauge', 'Inference requests currently running')
+metrics.describe('xh_inference_retries_total', 'counter', 'Inference retries after transient errors')
+metrics.describe('xh_inference_hedges_total', 'counter', 'Hedged inference requests by outcome')
+metrics.describe('xh_inference_failed_total', 'counter', 'Task turns ended with an error reply because inference kept failing')
+metrics.describe('xh_admission_rejected_total', 'counter', 'Activations rejected by admission control')
+metrics.describe('xh_cancelled_total', 'counter', 'Work dropped because its task was cancelled, by kind (task, inference, tool)')
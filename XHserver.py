@@ -1,45 +1,1242 @@
-from XingHeFarmworkNew import LLMTask, LLMTools, Inference
-from threading import Thread, Lock
-from queue import Queue
-import os, yaml, importlib, time, logging
-from flask import Flask, request, jsonify
-import pickle
+from XingHeFarmworkNew import LLMTask, LLMTools, ToolSelector, Inference, InferenceRouter, InferenceCancelled, CancelToken, SubtaskHandle, ResponseCache, ToolPolicy, ToolError, INJECTED_ARGUMENTS, call_tool
+from XHmetrics import metrics
+from threading import Thread, Lock, Event, Timer
+from queue import Queue, Empty, Full
+from collections import deque, OrderedDict
+from concurrent.futures import Future, BrokenExecutor, CancelledError, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+import os, abc, yaml, uuid, importlib, time, math, zlib, heapq, itertools, inspect, asyncio, hashlib, contextlib, socket, sqlite3, argparse, multiprocessing, logging, logging.handlers
+from flask import Flask, request, jsonify, Response
+import json
 
 # 设置日志记录
 log_file = 'server_log.log'
-with open(log_file, 'w') as file:
-        file.truncate(0)
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
-                    handlers=[logging.FileHandler(log_file,
-                    encoding='utf-8')])
+log_listener = None
+
+def setup_logging():
+    """
+    清空日志文件并启动日志监听线程，由XingHe初始化时调用一次
+    工具进程池的工作进程也会导入本模块，所以不在导入时做，避免子进程清空日志
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+    with open(log_file, 'w') as file:
+            file.truncate(0)
+    # 调度和推理线程只把日志记录放进队列，由监听线程写文件，避免磁盘IO卡住热路径
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'))
+    log_queue = Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s')) # 入队时只合并消息参数，完整格式由文件处理器负责
+    logging.basicConfig(level=logging.DEBUG, handlers=[queue_handler])
+
 # 创建独立的日志记录器
 logger = logging.getLogger('server_log')
 
-# 初始化推理器
-ollama = Inference(base_url='http://localhost:11434/v1', api_key='ollama')
+# 默认推理后端和模型，tasks.yaml中没有配置backends或模板没有指定model时使用
+DEFAULT_BACKENDS = [{'name': 'ollama', 'base_url': 'http://localhost:11434/v1', 'api_key': 'ollama', 'max_concurrency': 4, 'stream': True}]
+DEFAULT_MODEL = 'qwen2.5:7b'
+# 激活元任务时没有指定session_id的请求共用这个会话
+DEFAULT_SESSION = 'default'
 
 class XingHe:
-    def __init__(self):
+    def __init__(self, async_mode=False, config_path='tasks.yaml', tools_watch_interval=None):
         """
         初始化XingHe类，设置任务模板和任务列表
+        :param async_mode: 为True时使用asyncio调度器，推理和工具调用不再占用独立线程
+        :param config_path: 任务配置文件路径
+        :param tools_watch_interval: 工具文件热重载的检查间隔(秒)，为None时不监视
         """
-        self.meta_tasks = []
-        self.tasks_list = []
-        self.task_templates = self.TaskTemplate()
+        setup_logging()
+        self.async_mode = async_mode
+        self.tasks = {} # uuid -> 任务实例
+        self.task_templates = self.TaskTemplate(config_path, watch_interval=tools_watch_interval)
         self.meta_tasks_lock = Lock()
-        self.tasks_list_lock = Lock()
+        self.tasks_lock = Lock()
+        self.stream_hub = self.StreamHub()
+        self.status_board = self.StatusBoard()
+        requests_config = self.task_templates.config.get("requests") or {}
+        self.request_tracker = self.RequestTracker(**requests_config)
+        # 配置了task_store时REST前端只把输入写进任务存储，由本进程或其他进程的工作者租取执行
+        self.task_store = self._make_task_store(self.task_templates.config.get("task_store"), requests_config)
+        self.store_worker = self.StoreWorker(self.task_store, **(self.task_templates.config.get("workers") or {})) if self.task_store else None
+        self.router = InferenceRouter.from_config(self.task_templates.config.get("backends") or DEFAULT_BACKENDS,
+                                                  policy=self.task_templates.config.get("routing_policy", "least_outstanding"),
+                                                  hedge=self.task_templates.config.get("hedging"))
+        self.admission = self.AdmissionControl(self.router, **(self.task_templates.config.get("admission") or {}))
         self.scheduler = None
+        persistence = self.task_templates.config.get("persistence")
+        self.meta_log = self.MetaTaskLog(**persistence) if persistence else None
+        if self.meta_log is not None and self.store_worker is not None:
+            logger.warning("配置了task_store，元任务的对话保存在任务存储中，persistence不再生效")
+        # 元任务会话表，(模板名, session_id) -> 会话；使用任务存储时会话从存储恢复
+        self.meta_tasks = self.MetaSessions(self.task_templates, self.meta_tasks_lock, self.store_worker or self.meta_log,
+                                            status_board=self.status_board, **(self.task_templates.config.get("sessions") or {}))
+        if self.task_templates.config.get("trace_path"):
+            metrics.enable_trace(self.task_templates.config["trace_path"])
         logger.info("XingHe 初始化完成")
 
-    class TaskTemplate:
+    def _make_task_store(self, config, requests_config):
+        """
+        按tasks.yaml的task_store配置创建任务存储
+        :param config: 例如 {"type": "sqlite", "path": "state/tasks.sqlite"}，为None时不使用任务存储
+        :param requests_config: requests配置，结果的保留时间和数量沿用它
+        :return: 任务存储实例或None
+        """
+        if not config:
+            return None
+        config = dict(config)
+        kind = config.pop("type", "sqlite")
+        stores = {"memory": self.MemoryTaskStore, "sqlite": self.SQLiteTaskStore}
+        if kind not in stores:
+            raise ValueError(f"未知的task_store类型 {kind}，可选 {list(stores)}")
+        logger.info(f"使用 {kind} 任务存储: {config}")
+        return stores[kind](**dict(requests_config, **config))
+
+    class StreamHub:
+        def __init__(self, max_queue=1000):
+            """
+            顶层任务输出的广播中心，REST客户端按任务名订阅逐段输出和最终回复
+            :param max_queue: 每个订阅者缓存的最大事件数，消费太慢的订阅者会丢事件而不是拖慢推理
+            """
+            self.subscribers = {} # 任务名 -> 订阅队列列表
+            self.lock = Lock()
+            self.max_queue = max_queue
+
+        def subscribe(self, task_name: str) -> Queue:
+            """
+            订阅任务的输出
+            :param task_name: 任务名称
+            :return: 接收事件的队列
+            """
+            queue = Queue(maxsize=self.max_queue)
+            with self.lock:
+                self.subscribers.setdefault(task_name, []).append(queue)
+            return queue
+
+        def unsubscribe(self, task_name: str, queue: Queue):
+            with self.lock:
+                queues = self.subscribers.get(task_name, [])
+                if queue in queues:
+                    queues.remove(queue)
+                if not queues:
+                    self.subscribers.pop(task_name, None)
+
+        @staticmethod
+        def topic(task_name: str, session_id=None) -> str:
+            """
+            订阅主题：元任务按会话区分，其他顶层任务按任务名
+            """
+            return task_name if session_id is None else f"{task_name}/{session_id}"
+
+        def publish(self, task_name: str, event: dict):
+            """
+            向任务的所有订阅者发送事件
+            :param task_name: 任务名称
+            :param event: 事件字典
+            """
+            with self.lock:
+                queues = list(self.subscribers.get(task_name, ()))
+            for queue in queues:
+                try:
+                    queue.put_nowait(event)
+                except Full:
+                    logger.warning("任务 %s 的订阅者消费过慢，丢弃事件", task_name)
+
+    class StatusBoard:
+        GROUPS = ("meta_tasks", "tasks_list")
+
+        def __init__(self, min_interval=0.05, max_removed=10000):
+            """
+            状态公告板：调度器和会话表在状态变化时写入条目，后台线程把条目合并成带版本号的不可变快照，
+            状态查询只读取当前快照的引用，不获取调度器和会话表的锁
+            :param min_interval: 两次发布快照的最小间隔(秒)，这段时间内的变化合并成一次发布
+            :param max_removed: 保留的删除记录数，更早的版本无法给出增量，只能返回完整状态
+            """
+            self.lock = Lock() # 只在写者之间互斥
+            self.version = 0
+            self.entries = {group: {} for group in self.GROUPS} # 分组 -> 键 -> (版本, 条目)
+            self.removed = deque() # (版本, 分组, 键)，按版本递增
+            self.floor = 0 # 已丢弃的删除记录中最大的版本，比它旧的版本只能取完整状态
+            self.max_removed = max_removed
+            self.min_interval = min_interval
+            self.dirty = Event()
+            self.snapshot = {"version": 0, "floor": 0, "entries": {group: {} for group in self.GROUPS}, "removed": ()}
+            Thread(target=self._publisher, daemon=True, name='status-board').start()
+
+        def put(self, group: str, key, entry: dict):
+            """
+            写入或替换一个条目，条目写入后不再修改
+            """
+            with self.lock:
+                self.version += 1
+                self.entries[group][key] = (self.version, entry)
+            self.dirty.set()
+
+        def remove(self, group: str, key):
+            with self.lock:
+                if self.entries[group].pop(key, None) is None:
+                    return
+                self.version += 1
+                self.removed.append((self.version, group, key))
+                if len(self.removed) > self.max_removed:
+                    self.floor = self.removed.popleft()[0]
+            self.dirty.set()
+
+        def task_changed(self, task):
+            """
+            任务状态变化时由调度器调用，只更新已登记的条目；状态在锁内读取，并发的更新以最后一次为准
+            """
+            with self.lock:
+                task_uuid = task.info["uuid"]
+                changed = False
+                current = self.entries["tasks_list"].get(task_uuid)
+                if current is not None and current[1]["status"] != task.status:
+                    self.version += 1
+                    self.entries["tasks_list"][task_uuid] = (self.version, dict(current[1], status=task.status))
+                    changed = True
+                if task.info["session_id"] is not None and not task.info["parent_uuid"]:
+                    key = (task.info["task_name"], task.info["session_id"])
+                    current = self.entries["meta_tasks"].get(key)
+                    if current is not None and current[1]["uuid"] == task_uuid and current[1]["status"] != task.status:
+                        self.version += 1
+                        self.entries["meta_tasks"][key] = (self.version, dict(current[1], status=task.status))
+                        changed = True
+            if changed:
+                self.dirty.set()
+
+        def _publisher(self):
+            while True:
+                self.dirty.wait()
+                time.sleep(self.min_interval)
+                self.dirty.clear()
+                with self.lock:
+                    snapshot = {"version": self.version, "floor": self.floor,
+                                "entries": {group: dict(entries) for group, entries in self.entries.items()},
+                                "removed": tuple(self.removed)}
+                self.snapshot = snapshot
+
+        @staticmethod
+        def view(snapshot: dict, since=None) -> dict:
+            """
+            从快照生成状态，调用方先取 board.snapshot 的引用，不加锁
+            :param since: 客户端已有的版本，给出时只返回之后变化的条目和被删除的键；版本太旧时返回完整状态
+            :return: 包含version的状态字典，增量时full为False；客户端先按removed删除再按条目更新
+            """
+            if since is None or since < snapshot["floor"] or since > snapshot["version"]:
+                return dict({group: [entry for _, entry in entries.values()] for group, entries in snapshot["entries"].items()},
+                            version=snapshot["version"], full=True)
+            status = {group: [entry for version, entry in entries.values() if version > since]
+                      for group, entries in snapshot["entries"].items()}
+            removed = {group: [] for group in XingHe.StatusBoard.GROUPS}
+            for version, group, key in snapshot["removed"]:
+                if version > since:
+                    removed[group].append(key)
+            return dict(status, removed=removed, version=snapshot["version"], since=since, full=False)
+
+    class RequestTracker:
+        def __init__(self, result_ttl=300.0, max_results=10000):
+            """
+            请求结果表：激活任务时登记请求id，任务回复后写入结果，客户端按id长轮询取回
+            :param result_ttl: 已完成的结果保留多少秒
+            :param max_results: 最多保留的已完成结果数，超过时先清理最早完成的
+            """
+            self.records = {} # request_id -> {"state", "reply", ...}
+            self.finished = OrderedDict() # request_id -> 完成时间，最早完成的在前
+            self.waiters = {} # request_id -> Event，有客户端在等时才创建
+            self.in_flight = {} # 任务名 -> 进行中的请求数，准入控制按它统计负载
+            self.lock = Lock()
+            self.result_ttl = result_ttl
+            self.max_results = max_results
+
+        def create(self, **fields) -> str:
+            """
+            登记一个进行中的请求
+            :param fields: 随结果一起返回的信息，如任务名、会话
+            :return: 请求id
+            """
+            request_id = uuid.uuid4().hex
+            with self.lock:
+                self.records[request_id] = dict(fields, state="pending", reply=None)
+                self._count(fields.get("name"), 1)
+            return request_id
+
+        def discard(self, request_id: str):
+            # 请求没有被接受，删掉登记
+            with self.lock:
+                record = self.records.pop(request_id, None)
+                if record is not None and record["state"] == "pending":
+                    self._count(record.get("name"), -1)
+
+        def _count(self, name, delta):
+            # 调整某个任务名进行中的请求数，调用方需持有lock
+            count = self.in_flight.get(name, 0) + delta
+            if count > 0:
+                self.in_flight[name] = count
+            else:
+                self.in_flight.pop(name, None)
+
+        def outstanding(self) -> dict:
+            """
+            :return: 任务名 -> 进行中(未完成)的请求数
+            """
+            with self.lock:
+                return dict(self.in_flight)
+
+        def finish(self, request_id, reply=None, state="done", **fields):
+            """
+            写入请求结果并唤醒等待的客户端，重复写入时保留第一次的结果
+            :param request_id: 请求id，为None时忽略
+            :param reply: 任务的回复
+            :param state: done(已回复)、failed(推理失败，回复是错误信息)、interrupted(被同一会话的新输入打断，回复属于新请求)或cancelled(任务被删除)
+            """
+            if request_id is None:
+                return
+            with self.lock:
+                record = self.records.get(request_id)
+                if record is None or record["state"] != "pending":
+                    return
+                self._count(record.get("name"), -1)
+                record.update(fields, state=state, reply=reply)
+                now = time.monotonic()
+                self.finished[request_id] = now
+                self._expire(now)
+                waiter = self.waiters.pop(request_id, None)
+            if waiter is not None:
+                waiter.set()
+
+        def get(self, request_id: str, timeout=0.0):
+            """
+            取请求结果，请求未完成时最多等待timeout秒
+            :return: 结果字典，请求不存在或已过期时返回None
+            """
+            with self.lock:
+                record = self.records.get(request_id)
+                if record is None or record["state"] != "pending" or timeout <= 0:
+                    return dict(record, request_id=request_id) if record is not None else None
+                waiter = self.waiters.setdefault(request_id, Event())
+            waiter.wait(timeout)
+            with self.lock:
+                record = self.records.get(request_id)
+                return dict(record, request_id=request_id) if record is not None else None
+
+        def _expire(self, now):
+            """
+            清理超时或超出数量的已完成结果，调用方需持有lock
+            """
+            while self.finished:
+                request_id, finished_at = next(iter(self.finished.items()))
+                if now - finished_at < self.result_ttl and len(self.finished) <= self.max_results:
+                    break
+                del self.finished[request_id]
+                self.records.pop(request_id, None)
+
+    class AdmissionControl:
+        def __init__(self, router, max_in_flight=None, max_per_priority=None, rate=None, burst=None, client_header=None,
+                     max_clients=10000, default_latency=1.0, max_retry_after=60):
+            """
+            激活请求的准入控制：每个客户端一个令牌桶限速，超过返回429；按优先级和全局限制进行中的请求数，超过返回503。
+            拒绝时给出Retry-After：排在前面(优先级数值不大于它)的请求数 * 观测到的推理耗时 / 推理槽位数。
+            负载检查和请求登记之间不加锁，并发的激活可能让进行中的请求数略微超过上限
+            :param router: 推理路由器，提供槽位数和推理耗时
+            :param max_in_flight: 全局进行中的请求数上限，为None时不限制
+            :param max_per_priority: 每个优先级进行中的请求数上限，整数对所有优先级生效，也可以写成 {优先级: 上限}
+            :param rate: 每个客户端每秒可以激活的次数，必须大于0，为None时不限速
+            :param burst: 令牌桶容量，即允许的突发次数，必须大于0，默认为rate(至少为1)
+            :param client_header: 标识客户端的请求头，请求没有带这个头时按来源地址区分
+            :param max_clients: 最多保留的令牌桶数，超过时淘汰最久没有请求的客户端
+            :param default_latency: 还没有推理样本时(例如只做前端的进程)假定的单次推理耗时(秒)
+            :param max_retry_after: Retry-After的上限(秒)
+            """
+            # 令牌按rate补充，Retry-After也要除以rate；rate为0时桶一旦取空永远不会补满
+            if rate is not None and rate <= 0:
+                raise ValueError(f"admission.rate 必须大于0，不限速时不要配置它，当前为 {rate}")
+            if burst is not None and burst <= 0:
+                raise ValueError(f"admission.burst 必须大于0，当前为 {burst}")
+            self.router = router
+            self.max_in_flight = max_in_flight
+            self.max_per_priority = max_per_priority
+            self.rate = rate
+            self.burst = burst if burst is not None else max(1.0, rate or 0)
+            self.client_header = client_header
+            self.max_clients = max_clients
+            self.default_latency = default_latency
+            self.max_retry_after = max_retry_after
+            self.buckets = OrderedDict() # 客户端 -> [令牌数, 上次补充的时间]，最久未用的在前
+            self.rejected = {} # 拒绝原因 -> 次数
+            self.lock = Lock()
+
+        @property
+        def limits_load(self):
+            # 是否需要统计负载，不限制进行中的请求数时不必每次查询
+            return self.max_in_flight is not None or self.max_per_priority is not None
+
+        def _priority_limit(self, priority):
+            if isinstance(self.max_per_priority, dict):
+                return self.max_per_priority.get(priority)
+            return self.max_per_priority
+
+        def retry_after(self, priority, load: dict) -> int:
+            """
+            估算多少秒后再试
+            :param priority: 被拒绝的请求的优先级
+            :param load: 优先级 -> 进行中的请求数
+            """
+            ahead = sum(count for level, count in load.items() if level <= priority)
+            latency = self.router.latency or self.default_latency
+            seconds = ahead * latency / max(self.router.capacity, 1)
+            return int(min(self.max_retry_after, max(1, math.ceil(seconds))))
+
+        def _take(self, client) -> float:
+            """
+            从客户端的令牌桶取一个令牌
+            :return: 取到时为0，否则为还要等待的秒数
+            """
+            now = time.monotonic()
+            with self.lock:
+                bucket = self.buckets.get(client)
+                if bucket is None:
+                    bucket = self.buckets[client] = [self.burst, now]
+                    while len(self.buckets) > self.max_clients:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end(client)
+                    bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return 0.0
+                return (1 - bucket[0]) / self.rate
+
+        def _reject(self, reason, retry_after):
+            with self.lock:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            metrics.inc('xh_admission_rejected_total', reason=reason)
+            return {"status": "Error", "result": reason, "retry_after": retry_after}
+
+        def admit(self, client, priority, load):
+            """
+            检查一次激活能否被接受，先看服务是否过载，再扣客户端的令牌，过载时被拒绝的请求不消耗令牌
+            :param client: 客户端标识
+            :param priority: 请求的任务模板的优先级
+            :param load: 返回 优先级 -> 进行中请求数 的函数，只在需要时调用
+            :return: 接受时为None，否则为带retry_after的错误结果
+            """
+            if self.limits_load:
+                current = load()
+                limit = self._priority_limit(priority)
+                if ((self.max_in_flight is not None and sum(current.values()) >= self.max_in_flight)
+                        or (limit is not None and current.get(priority, 0) >= limit)):
+                    return self._reject("overloaded", self.retry_after(priority, current))
+            if self.rate is not None:
+                wait = self._take(client)
+                if wait > 0:
+                    return self._reject("rate_limited", int(min(self.max_retry_after, max(1, math.ceil(wait)))))
+            return None
+
+        def stats(self) -> dict:
+            with self.lock:
+                return {"clients": len(self.buckets), "rejected": dict(self.rejected), "inference_latency": self.router.latency}
+
+    class MetaTaskLog:
+        def __init__(self, path='state/meta_tasks.wal', snapshot_every=1000, fsync=True):
+            """
+            元任务对话的预写日志：每次追加、清空、压缩对话都写成一行JSON记录，由后台线程批量落盘，
+            记录数超过snapshot_every时把全部状态写成快照并清空日志，启动时按 快照+日志 恢复
+            :param path: 日志文件路径，快照为同名的.snapshot文件
+            :param snapshot_every: 两次快照之间的最大记录数
+            :param fsync: 每批写入后是否fsync
+            """
+            self.path = path
+            self.snapshot_path = path + '.snapshot'
+            self.snapshot_every = snapshot_every
+            self.fsync = fsync
+            self.queue = Queue()
+            self.lock = Lock()
+            self.state = {} # "模板名/session_id" -> {'user_history', 'tool_history', 'summary'}，只由刷写线程修改
+            self.seq = 0 # 最后一条记录的序号，快照记录它，重放时跳过已进入快照的记录
+            self.since_snapshot = 0
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._restore()
+            Thread(target=self._flusher, daemon=True, name='meta-log-flusher').start()
+
+        @staticmethod
+        def _key(name, session_id):
+            return f"{name}/{session_id}"
+
+        @staticmethod
+        def _apply(state, record):
+            key = XingHe.MetaTaskLog._key(record['task'], record.get('session'))
+            task = state.setdefault(key, {'user_history': [], 'tool_history': [], 'summary': None})
+            if record['op'] == 'append':
+                task[record['key']].append(record['msg'])
+            elif record['op'] == 'reset':
+                task[record['key']] = []
+            elif record['op'] == 'compact':
+                del task['user_history'][:record['count']]
+                task['summary'] = record['summary']
+
+        def _restore(self):
+            """
+            读取快照再重放日志，崩溃时写了一半的最后一行直接丢弃
+            """
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                    snapshot = json.load(file)
+                self.state, self.seq = snapshot['tasks'], snapshot['seq']
+            replayed = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb+') as file:
+                    valid = 0 # 最后一条完整记录之后的偏移
+                    for line in file:
+                        try:
+                            record = json.loads(line)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            record = None
+                        if record is None or not line.endswith(b'\n'):
+                            # 截掉不完整的记录，否则新记录会接在它后面
+                            logger.warning("元任务日志 %s 末尾有不完整的记录，已截断", self.path)
+                            file.truncate(valid)
+                            break
+                        valid += len(line)
+                        if record['seq'] <= self.seq:
+                            continue # 快照之后、清空日志之前崩溃时留下的旧记录
+                        self._apply(self.state, record)
+                        self.seq = record['seq']
+                        replayed += 1
+            self.since_snapshot = replayed
+            logger.info("元任务日志恢复完成: %d 个会话，重放 %d 条记录", len(self.state), replayed)
+
+        def record(self, task, op: str, fields: dict):
+            """
+            作为LLMTask.journal回调，只入队不做IO
+            """
+            self.queue.put(dict(fields, task=task.info['task_name'], session=task.info['session_id'], op=op))
+
+        def attach(self, task):
+            """
+            为元任务恢复已保存的对话并挂上日志回调
+            :param task: 元任务实例
+            """
+            with self.lock:
+                state = self.state.get(self._key(task.info['task_name'], task.info['session_id']))
+                if state is not None:
+                    task.load_state(json.loads(json.dumps(state))) # 深拷贝，之后任务和日志各改各的
+            task.journal = self.record
+
+        def flush(self, snapshot=False, timeout=None) -> bool:
+            """
+            等待已入队的记录全部落盘
+            :param snapshot: 为True时顺便写快照并清空日志
+            :return: 是否在超时前完成
+            """
+            done = Event()
+            self.queue.put(('flush', done, snapshot))
+            return done.wait(timeout)
+
+        def _flusher(self):
+            with open(self.path, 'a', encoding='utf-8') as file:
+                while True:
+                    batch = [self.queue.get()]
+                    while True: # 组提交：把已经排队的记录一起写
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except Empty:
+                            break
+                    waiters, snapshot = [], False
+                    lines = []
+                    with self.lock:
+                        for record in batch:
+                            if isinstance(record, tuple):
+                                waiters.append(record[1])
+                                snapshot = snapshot or record[2]
+                                continue
+                            self.seq += 1
+                            record['seq'] = self.seq
+                            self._apply(self.state, record)
+                            lines.append(json.dumps(record, ensure_ascii=False))
+                    try:
+                        if lines:
+                            file.write('\n'.join(lines) + '\n')
+                            file.flush()
+                            if self.fsync:
+                                os.fsync(file.fileno())
+                            self.since_snapshot += len(lines)
+                        if snapshot or self.since_snapshot >= self.snapshot_every:
+                            self._snapshot(file)
+                    except OSError as e:
+                        logger.exception(f"元任务日志写入失败: {e}")
+                    for done in waiters:
+                        done.set()
+
+        def _snapshot(self, file):
+            """
+            写快照后清空日志，调用方为刷写线程
+            """
+            with self.lock:
+                data = json.dumps({'seq': self.seq, 'tasks': self.state}, ensure_ascii=False)
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                if self.fsync:
+                    os.fsync(snapshot_file.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            file.truncate(0)
+            self.since_snapshot = 0
+            logger.info("元任务日志已压缩为快照 %s (seq %d)", self.snapshot_path, self.seq)
+
+    class TaskStore(abc.ABC):
+        """
+        任务存储接口：REST前端把元任务的输入写成作业，调度工作者(可以在其他进程)原子地租取作业并定期心跳续租，
+        回复后写回结果和会话的对话状态；租约过期的作业会被其他工作者重新租取。
+        同一会话同时最多租出一个作业，按写入顺序处理；会话状态带版本号，工作者据此判断本地的会话副本是否过期。
+        租出的作业为 {"request_id", "name", "session_id", "input", "version"}，version是租出时会话状态的版本。
+        子类必须实现全部抽象方法，缺了的在创建时就报错
+        """
         def __init__(self):
+            self.listeners = [] # 本进程写入作业时的回调，用于立即唤醒同进程的工作者
+
+        def subscribe(self, callback):
+            self.listeners.append(callback)
+
+        def _notify(self):
+            for callback in self.listeners:
+                callback()
+
+        @abc.abstractmethod
+        def enqueue(self, name: str, session_id: str, input, max_pending=None):
+            """
+            写入一个作业
+            :param max_pending: 该会话除正在处理的一个外最多排队的作业数，为None时不限制
+            :return: 请求id，会话排队已满时返回None
+            """
+
+        @abc.abstractmethod
+        def lease(self, worker_id: str, limit: int, lease_seconds: float) -> list:
+            """
+            租取最多limit个作业，每个会话只看最早的未完成作业，它未被租出或租约已过期时才租出
+            """
+
+        @abc.abstractmethod
+        def heartbeat(self, worker_id: str, request_ids: list, lease_seconds: float):
+            """
+            为工作者仍持有的作业续租，顺便清理过期的结果
+            """
+
+        @abc.abstractmethod
+        def release(self, request_id: str, worker_id: str):
+            """
+            工作者暂时无法处理时交还作业，不计入租取次数
+            """
+
+        @abc.abstractmethod
+        def complete(self, request_id: str, worker_id: str, reply=None, state="done", session_state=None):
+            """
+            写入作业结果，session_state不为None时同时保存会话的对话状态并递增版本
+            :return: 会话状态的版本，租约已经被其他工作者接手时返回None，结果作废
+            """
+
+        @abc.abstractmethod
+        def load_session(self, name: str, session_id: str):
+            """
+            :return: (版本, 对话状态)，会话没有保存过时为(0, None)
+            """
+
+        @abc.abstractmethod
+        def get(self, request_id: str, timeout=0.0):
+            """
+            和RequestTracker.get相同：取请求结果，未完成时最多等待timeout秒，请求不存在或已过期时返回None
+            """
+
+        @abc.abstractmethod
+        def stats(self) -> dict:
+            """
+            :return: 排队和租出的作业数，用于状态查询
+            """
+
+        @abc.abstractmethod
+        def outstanding(self) -> dict:
+            """
+            和RequestTracker.outstanding相同：任务名 -> 未完成(排队或租出)的作业数，供准入控制统计负载
+            """
+
+    class MemoryTaskStore(TaskStore):
+        def __init__(self, result_ttl=300.0, max_results=10000, max_attempts=3):
+            """
+            进程内的任务存储，结果复用RequestTracker，用于在一个进程里运行多个工作者或验证租约逻辑
+            :param max_attempts: 作业最多被租出的次数，租约反复过期(工作者反复崩溃)的作业超过后记为failed
+            """
+            super().__init__()
+            self.results = XingHe.RequestTracker(result_ttl, max_results)
+            self.max_attempts = max_attempts
+            self.jobs = OrderedDict() # 未完成的作业，request_id -> 作业记录，按写入顺序
+            self.session_jobs = {} # "模板名/session_id" -> 该会话未完成作业的request_id，按写入顺序，排队上限据此判断
+            self.sessions = {} # "模板名/session_id" -> (版本, 对话状态)
+            self.lock = Lock()
+
+        def enqueue(self, name, session_id, input, max_pending=None):
+            key = XingHe.MetaTaskLog._key(name, session_id)
+            with self.lock:
+                if max_pending is not None and len(self.session_jobs.get(key, ())) > max_pending:
+                    return None
+                request_id = self.results.create(name=name, session_id=session_id)
+                self.jobs[request_id] = {"key": key, "name": name, "session_id": session_id, "input": input,
+                                         "worker": None, "lease_until": 0.0, "attempts": 0}
+                self.session_jobs.setdefault(key, deque()).append(request_id)
+            self._notify()
+            return request_id
+
+        def lease(self, worker_id, limit, lease_seconds):
+            now = time.time()
+            leased, seen, failed = [], set(), []
+            with self.lock:
+                for request_id, job in self.jobs.items():
+                    if len(leased) >= limit:
+                        break
+                    if job["key"] in seen:
+                        continue
+                    seen.add(job["key"])
+                    if job["worker"] is not None and job["lease_until"] > now:
+                        continue
+                    if job["attempts"] >= self.max_attempts:
+                        failed.append(request_id)
+                        continue
+                    job.update(worker=worker_id, lease_until=now + lease_seconds, attempts=job["attempts"] + 1)
+                    leased.append({"request_id": request_id, "name": job["name"], "session_id": job["session_id"],
+                                   "input": job["input"], "version": self.sessions.get(job["key"], (0, None))[0]})
+                for request_id in failed:
+                    self._drop(request_id)
+            for request_id in failed:
+                logger.error(f"作业 {request_id} 超过最大租取次数 {self.max_attempts}，记为失败")
+                self.results.finish(request_id, state="failed")
+            return leased
+
+        def heartbeat(self, worker_id, request_ids, lease_seconds):
+            lease_until = time.time() + lease_seconds
+            with self.lock:
+                for request_id in request_ids:
+                    job = self.jobs.get(request_id)
+                    if job is not None and job["worker"] == worker_id:
+                        job["lease_until"] = lease_until
+
+        def release(self, request_id, worker_id):
+            with self.lock:
+                job = self.jobs.get(request_id)
+                if job is not None and job["worker"] == worker_id:
+                    job.update(worker=None, lease_until=0.0, attempts=job["attempts"] - 1)
+            self._notify()
+
+        def complete(self, request_id, worker_id, reply=None, state="done", session_state=None):
+            with self.lock:
+                job = self.jobs.get(request_id)
+                if job is None or job["worker"] != worker_id:
+                    return None
+                self._drop(request_id)
+                version = self.sessions.get(job["key"], (0, None))[0]
+                if session_state is not None:
+                    version += 1
+                    self.sessions[job["key"]] = (version, session_state)
+            self.results.finish(request_id, reply, state)
+            self._notify() # 同一会话的下一个作业可以租出了
+            return version
+
+        def _drop(self, request_id):
+            """
+            删除一个结束的作业，调用方需持有lock
+            """
+            key = self.jobs.pop(request_id)["key"]
+            queue = self.session_jobs[key]
+            queue.remove(request_id) # 结束的总是会话最早的作业，实际只看队首
+            if not queue:
+                del self.session_jobs[key]
+
+        def load_session(self, name, session_id):
+            with self.lock:
+                return self.sessions.get(XingHe.MetaTaskLog._key(name, session_id), (0, None))
+
+        def get(self, request_id, timeout=0.0):
+            return self.results.get(request_id, timeout)
+
+        def stats(self):
+            with self.lock:
+                leased = sum(1 for job in self.jobs.values() if job["worker"] is not None)
+                return {"pending": len(self.jobs) - leased, "leased": leased}
+
+        def outstanding(self):
+            return self.results.outstanding()
+
+    class SQLiteTaskStore(TaskStore):
+        FINISHED = ("done", "interrupted", "cancelled", "failed")
+
+        def __init__(self, path='state/tasks.sqlite', result_ttl=300.0, max_results=10000, max_attempts=3, poll_interval=0.05):
+            """
+            sqlite文件上的任务存储，同一台机器上的多个进程共享一个文件。
+            租取、续租和完成都在 BEGIN IMMEDIATE 事务里进行，过期的租约在下一次租取时被回收
+            :param path: 数据库文件路径
+            :param result_ttl: 已完成的结果保留多少秒
+            :param max_results: 最多保留的已完成结果数
+            :param max_attempts: 作业最多被租出的次数，超过后记为failed
+            :param poll_interval: 长轮询结果时查询数据库的间隔(秒)
+            """
+            super().__init__()
+            self.path = path
+            self.result_ttl = result_ttl
+            self.max_results = max_results
+            self.max_attempts = max_attempts
+            self.poll_interval = poll_interval
+            self.lock = Lock()
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 自己管理事务；timeout是其他进程持有写锁时的等待时间
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            with self._transaction():
+                self.db.execute('CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, request_id TEXT UNIQUE, '
+                                'session_key TEXT, name TEXT, session_id TEXT, input TEXT, state TEXT, worker TEXT, '
+                                'lease_until REAL, attempts INTEGER DEFAULT 0, reply TEXT, finished_at REAL)')
+                self.db.execute("CREATE INDEX IF NOT EXISTS jobs_open ON jobs (session_key, seq) WHERE state IN ('pending', 'leased')")
+                self.db.execute('CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at) WHERE finished_at IS NOT NULL')
+                self.db.execute('CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, version INTEGER, state TEXT)')
+
+        @contextlib.contextmanager
+        def _transaction(self):
+            # 一开始就拿写锁，读和写之间不会插进其他进程的写
+            with self.lock:
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    yield
+                except BaseException:
+                    self.db.execute('ROLLBACK')
+                    raise
+                self.db.execute('COMMIT')
+
+        def enqueue(self, name, session_id, input, max_pending=None):
+            key = XingHe.MetaTaskLog._key(name, session_id)
+            request_id = uuid.uuid4().hex
+            with self._transaction():
+                if max_pending is not None:
+                    count = self.db.execute("SELECT COUNT(*) FROM jobs WHERE session_key = ? AND state IN ('pending', 'leased')",
+                                            (key,)).fetchone()[0]
+                    if count > max_pending:
+                        return None
+                self.db.execute("INSERT INTO jobs (request_id, session_key, name, session_id, input, state) VALUES (?, ?, ?, ?, ?, 'pending')",
+                                (request_id, key, name, session_id, json.dumps(input, ensure_ascii=False)))
+            self._notify()
+            return request_id
+
+        def _leasable(self, now, limit):
+            # 每个会话最早的未完成作业，未租出或租约已过期的才能租
+            return self.db.execute(
+                "SELECT j.request_id, j.name, j.session_id, j.input, j.attempts, COALESCE(s.version, 0) FROM jobs j "
+                "JOIN (SELECT MIN(seq) AS seq FROM jobs WHERE state IN ('pending', 'leased') GROUP BY session_key) h ON j.seq = h.seq "
+                "LEFT JOIN sessions s ON s.key = j.session_key "
+                "WHERE j.state = 'pending' OR j.lease_until <= ? ORDER BY j.seq LIMIT ?", (now, limit)).fetchall()
+
+        def lease(self, worker_id, limit, lease_seconds):
+            now = time.time()
+            with self.lock:
+                # 空闲时工作者频繁轮询，先在事务外读一次，没有可租的作业就不去抢写锁
+                if not self._leasable(now, 1):
+                    return []
+            with self._transaction():
+                rows = self._leasable(now, limit)
+                leased = []
+                for request_id, name, session_id, input, attempts, version in rows:
+                    if attempts >= self.max_attempts:
+                        logger.error(f"作业 {request_id} 超过最大租取次数 {self.max_attempts}，记为失败")
+                        self.db.execute("UPDATE jobs SET state = 'failed', worker = NULL, finished_at = ? WHERE request_id = ?",
+                                        (now, request_id))
+                        continue
+                    self.db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                                    "WHERE request_id = ?", (worker_id, now + lease_seconds, request_id))
+                    leased.append({"request_id": request_id, "name": name, "session_id": session_id,
+                                   "input": json.loads(input), "version": version})
+            return leased
+
+        def heartbeat(self, worker_id, request_ids, lease_seconds):
+            now = time.time()
+            with self._transaction():
+                self.db.executemany("UPDATE jobs SET lease_until = ? WHERE request_id = ? AND worker = ? AND state = 'leased'",
+                                    [(now + lease_seconds, request_id, worker_id) for request_id in request_ids])
+                self.db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - self.result_ttl,))
+                self.db.execute("DELETE FROM jobs WHERE request_id IN (SELECT request_id FROM jobs WHERE finished_at IS NOT NULL "
+                                "ORDER BY finished_at DESC LIMIT -1 OFFSET ?)", (self.max_results,))
+
+        def release(self, request_id, worker_id):
+            with self._transaction():
+                self.db.execute("UPDATE jobs SET state = 'pending', worker = NULL, attempts = attempts - 1 "
+                                "WHERE request_id = ? AND worker = ? AND state = 'leased'", (request_id, worker_id))
+
+        def complete(self, request_id, worker_id, reply=None, state="done", session_state=None):
+            with self._transaction():
+                updated = self.db.execute("UPDATE jobs SET state = ?, reply = ?, worker = NULL, finished_at = ? "
+                                          "WHERE request_id = ? AND worker = ? AND state = 'leased'",
+                                          (state, json.dumps(reply, ensure_ascii=False), time.time(), request_id, worker_id)).rowcount
+                if not updated:
+                    return None
+                key = self.db.execute("SELECT session_key FROM jobs WHERE request_id = ?", (request_id,)).fetchone()[0]
+                if session_state is not None:
+                    self.db.execute("INSERT INTO sessions (key, version, state) VALUES (?, 1, ?) "
+                                    "ON CONFLICT(key) DO UPDATE SET version = version + 1, state = excluded.state",
+                                    (key, json.dumps(session_state, ensure_ascii=False)))
+                row = self.db.execute("SELECT version FROM sessions WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else 0
+
+        def load_session(self, name, session_id):
+            with self.lock:
+                row = self.db.execute("SELECT version, state FROM sessions WHERE key = ?",
+                                      (XingHe.MetaTaskLog._key(name, session_id),)).fetchone()
+            return (row[0], json.loads(row[1])) if row else (0, None)
+
+        def get(self, request_id, timeout=0.0):
+            deadline = time.monotonic() + max(0.0, timeout)
+            interval = min(0.005, self.poll_interval) # 查询间隔从5ms起倍增到poll_interval，短请求不用多等一个完整的间隔
+            while True:
+                with self.lock:
+                    row = self.db.execute("SELECT state, reply, name, session_id FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                if row is None:
+                    return None
+                finished = row[0] in self.FINISHED
+                remaining = deadline - time.monotonic()
+                if finished or remaining <= 0:
+                    return {"name": row[2], "session_id": row[3], "state": row[0] if finished else "pending",
+                            "reply": json.loads(row[1]) if finished and row[1] is not None else None, "request_id": request_id}
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, self.poll_interval)
+
+        def stats(self):
+            with self.lock:
+                counts = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs WHERE state IN ('pending', 'leased') GROUP BY state").fetchall())
+            return {"pending": counts.get("pending", 0), "leased": counts.get("leased", 0)}
+
+        def outstanding(self):
+            # 未完成的作业受准入控制限制，数量不大，走jobs_open部分索引
+            with self.lock:
+                return dict(self.db.execute("SELECT name, COUNT(*) FROM jobs WHERE state IN ('pending', 'leased') GROUP BY name").fetchall())
+
+    class StoreWorker:
+        def __init__(self, task_store, lease_seconds=30.0, heartbeat_interval=10.0, poll_interval=0.05, max_jobs=None):
+            """
+            任务存储和本进程调度器之间的桥：租取作业交给会话表和调度器，定期为持有的作业续租。
+            它代替RequestTracker传给调度器，回复时把结果和会话状态写回存储；也代替预写日志传给会话表，创建会话时从存储取回对话
+            :param task_store: 任务存储实例
+            :param lease_seconds: 租约时长(秒)，工作者停止心跳这么久后作业可以被其他工作者接手
+            :param heartbeat_interval: 续租间隔(秒)，应明显小于lease_seconds
+            :param poll_interval: 没有作业时查询存储的间隔(秒)
+            :param max_jobs: 同时持有的作业数上限，默认为推理后端的总槽位数
+            """
+            self.task_store = task_store
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+            self.lease_seconds = lease_seconds
+            self.heartbeat_interval = heartbeat_interval
+            self.poll_interval = poll_interval
+            self.max_jobs = max_jobs
+            self.meta_tasks = None
+            self.scheduler = None
+            self.leased = {} # 持有的作业，request_id -> 作业
+            self.versions = {} # (模板名, session_id) -> 本地会话副本对应的存储版本
+            self.lock = Lock()
+            self.wakeup = Event()
+            # 结果和会话状态由单独的线程写回，不在调度器持锁时做数据库IO；作业在写回之后才会释放，下一轮不会读到旧状态
+            self.commits = Queue()
+            task_store.subscribe(self.wakeup.set)
+
+        def start(self, meta_tasks, scheduler, capacity: int):
+            """
+            开始租取作业
+            :param meta_tasks: 本进程的会话表
+            :param scheduler: 本进程的调度器
+            :param capacity: 推理后端的总槽位数，没有配置max_jobs时作为持有作业数的上限
+            """
+            self.meta_tasks = meta_tasks
+            self.scheduler = scheduler
+            if self.max_jobs is None:
+                self.max_jobs = capacity
+            Thread(target=self._lease_loop, daemon=True, name='store-worker').start()
+            Thread(target=self._commit_loop, daemon=True, name='store-commit').start()
+            logger.info(f"工作者 {self.worker_id} 开始租取作业，最多同时持有 {self.max_jobs} 个")
+
+        def attach(self, task):
+            """
+            会话表创建会话时调用，从存储取回对话
+            :param task: 元任务实例
+            """
+            key = (task.info["task_name"], task.info["session_id"])
+            version, state = self.task_store.load_session(*key)
+            if state is not None:
+                task.load_state(state)
+            with self.lock:
+                self.versions[key] = version
+
+        def _lease_loop(self):
+            last_heartbeat = 0.0
+            while True:
+                self.wakeup.clear()
+                now = time.monotonic()
+                with self.lock:
+                    holding = list(self.leased)
+                try:
+                    if now - last_heartbeat >= self.heartbeat_interval:
+                        self.task_store.heartbeat(self.worker_id, holding, self.lease_seconds)
+                        last_heartbeat = now
+                    room = self.max_jobs - len(holding)
+                    jobs = self.task_store.lease(self.worker_id, room, self.lease_seconds) if room > 0 else []
+                except Exception as e:
+                    logger.exception(f"工作者 {self.worker_id} 访问任务存储失败: {e}")
+                    jobs = []
+                for job in jobs:
+                    self._dispatch(job)
+                if not jobs:
+                    self.wakeup.wait(self.poll_interval)
+
+        def _dispatch(self, job):
+            """
+            把租到的作业交给会话表，本地会话副本的版本和存储不一致时先丢弃，重新创建时从存储恢复
+            """
+            key = (job["name"], job["session_id"])
+            with self.lock:
+                if job["request_id"] in self.leased:
+                    return # 本地还在处理，租约过期后又租回了自己
+                self.leased[job["request_id"]] = job
+                stale = self.versions.get(key) != job["version"]
+            if stale:
+                self.meta_tasks.discard(*key)
+            try:
+                result, task = self.meta_tasks.submit(job["name"], job["session_id"], job["input"], job["request_id"])
+            except Exception as e:
+                logger.exception(f"作业 {job['request_id']} 无法创建会话: {e}")
+                self.finish(job["request_id"], state="failed")
+                return
+            if result == "start":
+                self.scheduler.add_task(task)
+            elif result != "queued":
+                # 本地会话表已满，交还给存储，稍后由自己或其他工作者再租
+                logger.warning(f"工作者 {self.worker_id} 暂时无法处理作业 {job['request_id']}: {result}")
+                with self.lock:
+                    self.leased.pop(job["request_id"], None)
+                self.task_store.release(job["request_id"], self.worker_id)
+
+        def finish(self, request_id, reply=None, state="done", **fields):
+            """
+            调度器写入回复时调用，和RequestTracker.finish的签名相同：取下会话状态的快照，交给提交线程写回存储
+            """
+            with self.lock:
+                job = self.leased.get(request_id)
+            if job is None:
+                return
+            task = self.meta_tasks.get(job["name"], job["session_id"])
+            session_state = task.dump_state() if task is not None and state == "done" else None
+            self.commits.put((job, reply, state, session_state))
+
+        def _commit_loop(self):
+            while True:
+                self._commit(*self.commits.get())
+
+        def _commit(self, job, reply, state, session_state):
+            key = (job["name"], job["session_id"])
+            try:
+                version = self.task_store.complete(job["request_id"], self.worker_id, reply, state, session_state)
+            except Exception as e:
+                # 不再续租，租约过期后由其他工作者从上一个版本重做这一轮
+                logger.exception(f"作业 {job['request_id']} 的结果写回失败: {e}")
+                version = None
+            with self.lock:
+                self.leased.pop(job["request_id"], None)
+                if version is None or session_state is None:
+                    self.versions.pop(key, None) # 本地副本和存储不再一致，下次租到这个会话时重新恢复
+                else:
+                    self.versions[key] = version
+            if version is None:
+                logger.warning(f"作业 {job['request_id']} 的租约已失效，本地结果作废")
+            self.wakeup.set()
+
+    class Session:
+        __slots__ = ('task', 'inputs', 'active', 'last_used')
+
+        def __init__(self, task):
+            """
+            一个会话：元任务实例、排队等待的(输入, 请求id)，以及是否有一轮对话正在进行
+            """
+            self.task = task
+            self.inputs = deque()
+            self.active = False
+            self.last_used = time.monotonic()
+
+    class MetaSessions:
+        def __init__(self, task_templates, lock, meta_log=None, max_sessions=1000, idle_timeout=1800.0, max_pending=16, status_board=None):
+            """
+            元任务会话表：每个(模板名, session_id)一个元任务实例，按最近使用排序，
+            空闲超时或超过上限时淘汰最久未用的空闲会话，忙碌的会话把新输入排队
+            :param task_templates: 任务模板实例
+            :param lock: 保护会话表的锁
+            :param meta_log: 元任务预写日志，被淘汰的会话下次激活时从日志恢复；为None时淘汰即丢弃对话
+            :param max_sessions: 同时存在的会话上限
+            :param idle_timeout: 空闲多少秒后淘汰(秒)
+            :param max_pending: 每个会话最多排队的输入数
+            :param status_board: 状态公告板，会话创建、排队变化和淘汰时写入，为None时不发布
+            """
+            self.task_templates = task_templates
+            self.lock = lock
+            self.meta_log = meta_log
+            self.max_sessions = max_sessions
+            self.idle_timeout = idle_timeout
+            self.max_pending = max_pending
+            self.status_board = status_board
+            self.sessions = OrderedDict() # (模板名, session_id) -> Session，最久未用的在前
+            if idle_timeout:
+                Thread(target=self._sweep_loop, daemon=True, name='session-sweeper').start()
+
+        def __len__(self):
+            return len(self.sessions)
+
+        def __iter__(self):
+            # 遍历元任务实例，调用方需持有lock
+            return (session.task for session in self.sessions.values())
+
+        def submit(self, name: str, session_id: str, input: str, request_id=None):
+            """
+            把一条输入交给会话
+            :param request_id: 这条输入的请求id，开始处理时写入task.info["request_id"]
+            :return: (结果, 元任务)，结果为 "start"(调用方把任务交给调度器)、"interrupt"(调用方中断挂起的子任务)、
+                     "queued"(已排队)、"queue_full"(该会话排队已满)、"busy"(会话数已达上限且没有可淘汰的会话)
+            """
+            key = (name, session_id)
+            with self.lock:
+                now = time.monotonic()
+                session = self.sessions.get(key)
+                if session is None:
+                    self._evict(now, room=1)
+                    if len(self.sessions) >= self.max_sessions:
+                        return "busy", None
+                    task = self.task_templates.get_task(name)
+                    task.info["session_id"] = session_id
+                    if self.meta_log is not None:
+                        self.meta_log.attach(task)
+                    session = self.sessions[key] = XingHe.Session(task)
+                    logger.info(f"元任务 {name} 创建会话 {session_id}，当前 {len(self.sessions)} 个会话")
+                self.sessions.move_to_end(key)
+                session.last_used = now
+                task = session.task
+                if not session.active:
+                    session.active = True
+                    task.info["request_id"] = request_id
+                    task.set_input(input)
+                    task.forward()
+                    self._publish(key, session)
+                    return "start", task
+                if task.status == "ReTool" and task.events["suspend"].is_set() and not session.inputs:
+                    # 正在等子任务，新输入打断它
+                    return "interrupt", task
+                if len(session.inputs) >= self.max_pending:
+                    return "queue_full", task
+                session.inputs.append((input, request_id))
+                self._publish(key, session)
+                return "queued", task
+
+        def next_input(self, task):
+            """
+            一轮对话结束时由调度器调用，取出该会话排队的下一条输入，没有时会话变为空闲
+            :return: (下一条输入, 请求id)或None
+            """
+            with self.lock:
+                session = self.sessions.get((task.info["task_name"], task.info["session_id"]))
+                if session is None or session.task is not task:
+                    return None
+                session.last_used = time.monotonic()
+                if session.inputs:
+                    follow_up = session.inputs.popleft()
+                    self._publish((task.info["task_name"], task.info["session_id"]), session)
+                    return follow_up
+                session.active = False
+                return None
+
+        def get(self, name: str, session_id: str):
+            """
+            :return: 会话的元任务实例，会话不存在时返回None
+            """
+            with self.lock:
+                session = self.sessions.get((name, session_id))
+                return session.task if session is not None else None
+
+        def discard(self, name: str, session_id: str):
+            """
+            丢弃本地的会话，下次激活时重新创建并从日志或任务存储恢复对话，用于本地副本已经过期的情况
+            """
+            with self.lock:
+                if self.sessions.pop((name, session_id), None) is not None:
+                    self._unpublish((name, session_id))
+                    logger.info(f"元任务 {name} 的会话 {session_id} 已丢弃")
+
+        def _evict(self, now, room=0):
+            """
+            从最久未用的一端淘汰空闲会话：超时的全部淘汰，另外为新会话腾出room个位置，调用方需持有lock
+            """
+            checked = 0
+            while self.sessions and checked < len(self.sessions):
+                key, session = next(iter(self.sessions.items()))
+                expired = self.idle_timeout and now - session.last_used >= self.idle_timeout
+                if not expired and len(self.sessions) + room <= self.max_sessions:
+                    break
+                if session.active:
+                    self.sessions.move_to_end(key) # 忙碌的会话不淘汰，跳过
+                    checked += 1
+                    continue
+                del self.sessions[key]
+                self._unpublish(key)
+                logger.info(f"元任务 {key[0]} 的会话 {key[1]} 空闲，已淘汰")
+
+        def _sweep_loop(self):
+            while True:
+                time.sleep(min(60.0, self.idle_timeout / 4))
+                with self.lock:
+                    self._evict(time.monotonic())
+
+        def _publish(self, key, session):
+            # 把会话的当前状态写到公告板，调用方需持有lock
+            if self.status_board is not None:
+                self.status_board.put("meta_tasks", key, {"uuid": session.task.info["uuid"], "name": key[0], "session_id": key[1],
+                                                          "status": session.task.status, "queued": len(session.inputs)})
+
+        def _unpublish(self, key):
+            if self.status_board is not None:
+                self.status_board.remove("meta_tasks", key)
+
+    class TaskTemplate:
+        def __init__(self, config_path='tasks.yaml', tools_folder='Tools', watch_interval=None):
             """
-            初始化任务模板类，读取tasks.yaml文件中的任务模板
+            初始化任务模板类，读取tasks.yaml文件中的任务模板，并一次性加载工具、为每个模板预先构建工具集
+            :param config_path: 任务配置文件路径
+            :param tools_folder: 工具文件夹(同时也是包名)
+            :param watch_interval: 工具文件热重载的检查间隔(秒)，为None时不监视
             """
-            with open('tasks.yaml', 'r', encoding='utf-8') as file:
-                self.templates = yaml.safe_load(file)["tasks"]
+            with open(config_path, 'r', encoding='utf-8') as file:
+                self.config = yaml.safe_load(file)
+            self.templates = self.config["tasks"]
             logger.info("读取到的模板: %s", self.templates)
+            self.template_index = {template["name"]: template for template in self.templates}
+            for template in self.templates:
+                if template.get("context_mode", "default") not in LLMTask.CONTEXT_MODES:
+                    raise ValueError(f"模板 {template['name']} 的context_mode {template['context_mode']} 无效，可选 {LLMTask.CONTEXT_MODES}")
+            self.tools_folder = tools_folder
+            self.tool_classes = {} # 工具名 -> 工具类
+            self.tool_mtimes = {} # 工具文件名 -> 最后修改时间
+            self.template_tools = {} # 模板名 -> 预先构建的LLMTools，所有同名任务共享，只读
+            self.tool_selectors = {} # 配置了tool_selection的模板名 -> ToolSelector，和template_tools一起重建
+            # 在模板中配置了cache的子任务结果缓存，模板名 -> ResponseCache
+            self.template_caches = {template["name"]: ResponseCache(**template["cache"])
+                                    for template in self.templates if template.get("cache")}
+            self.tool_caches = {} # 声明了cache属性的工具的结果缓存，工具名 -> ResponseCache
+            self.tool_policies = {} # 工具名 -> 执行策略，来自工具类的execution属性
+            self.lock = Lock()
+            self._load_tools()
+            self._build_template_tools()
+            if watch_interval:
+                Thread(target=self._watch_tools, args=(watch_interval,), daemon=True).start()
 
         def get_template(self, task_name: str):
             """
@@ -47,14 +1244,11 @@ class XingHe:
             :param task_name: 任务名称
             :return: 任务模板字典
             """
-            for template in self.templates:
-                if template["name"] == task_name:
-                    return template
-            return None
+            return self.template_index.get(task_name)
         
         def get_task(self, task_name: str) -> LLMTask:
             """
-            根据任务名称获取任务实例
+            根据任务名称获取任务实例，只为任务分配自己的记忆，工具集使用模板预先构建的
             :param task_name: 任务名称
             :return: LLMTask实例
             """
@@ -62,116 +1256,192 @@ class XingHe:
             if template is None:
                 logger.error(f"任务 {task_name} 不存在")
                 raise ValueError(f"任务 {task_name} 不存在")
-            logger.info("匹配到的模板: %s", template)
+            return LLMTask(template["name"], template["pirority"], template["sysprompt"], self.template_tools[task_name],
+                           context_budget=template.get("context_budget"), context_mode=template.get("context_mode", "default"),
+                           tool_selector=self.tool_selectors.get(task_name))
 
-            llmtools = LLMTools()
-            tools_folder = 'Tools'
-            if template['tools']:
-                self._load_tools(template, llmtools, tools_folder)
-            logger.info(f"工具json: {llmtools.tools}, 映射表: {llmtools.available_functions}")
-            return LLMTask(template["name"], template["pirority"], template["sysprompt"], llmtools)
+        def _load_tools(self):
+            """
+            扫描工具文件夹，导入新增的工具文件，重新加载修改过的工具文件
+            :return: 布尔值，表示是否有工具发生变化
+            """
+            changed = False
+            for tool_file in sorted(os.listdir(self.tools_folder)):
+                if not tool_file.endswith('.py'):
+                    continue
+                mtime = os.path.getmtime(os.path.join(self.tools_folder, tool_file))
+                if self.tool_mtimes.get(tool_file) == mtime:
+                    continue
+                tool_name = tool_file[:-3]
+                try:
+                    module = importlib.import_module(f'{self.tools_folder}.{tool_name}')
+                    if tool_file in self.tool_mtimes:
+                        module = importlib.reload(module)
+                        self.tool_caches.pop(tool_name, None) # 工具实现可能已经改变，丢弃旧结果
+                        if tool_name in self.tool_policies:
+                            self.tool_policies.pop(tool_name).close() # 进程池里还是旧代码，换新的
+                        logger.info(f"工具 {tool_name} 已重新加载")
+                    self.tool_classes[tool_name] = getattr(module, tool_name)
+                    if getattr(self.tool_classes[tool_name], 'cache', None):
+                        self.tool_caches[tool_name] = ResponseCache(**self.tool_classes[tool_name].cache)
+                    self.tool_policies[tool_name] = ToolPolicy.from_tool(self.tool_classes[tool_name])
+                    self.tool_policies[tool_name].start()
+                except Exception as e:
+                    logger.error(f"工具 {tool_name} 加载失败: {e}")
+                self.tool_mtimes[tool_file] = mtime
+                changed = True
+            return changed
 
-        def _load_tools(self, template, llmtools: LLMTools, tools_folder: str):
+        def subtask_cache_key(self, task_name: str, input: str):
             """
-            加载并匹配工具
-            :param template: 任务模板
-            :param llmtools: LLMTools实例
-            :param tools_folder: 工具文件夹路径
-            """
-            for tool_file in os.listdir(tools_folder):
-                if tool_file.endswith('.py'):
-                    tool_name = tool_file[:-3]
-                    module = importlib.import_module(f'{tools_folder}.{tool_name}')
-                    tool_class = getattr(module, tool_name)
-                    if self._is_tool_in_template(tool_class, template):
-                        logger.info(f"工具 {tool_class.__name__} 在模板中，激活")
-                        llmtools.add_tools([tool_class])
-
-        def _is_tool_in_template(self, tool_class, template):
-            """
-            检查工具是否在模板中
-            :param tool_class: 工具类
+            计算子任务结果的缓存键
+            :param task_name: 模板名称
+            :param input: 子任务输入
+            :return: (缓存实例, 键)，模板未开启缓存时返回(None, None)
+            """
+            cache = self.template_caches.get(task_name)
+            if cache is None:
+                return None, None
+            sysprompt_hash = hashlib.sha256(self.template_index[task_name]["sysprompt"].encode('utf-8')).hexdigest()
+            model = self.template_index[task_name].get("model", DEFAULT_MODEL)
+            return cache, ResponseCache.make_key(task_name, sysprompt_hash, ResponseCache.normalize(input), model)
+
+        def tool_cache_key(self, tool_name: str, arguments: dict):
+            """
+            计算工具结果的缓存键，只使用模型给出的参数，不含框架注入的uuid、句柄和取消信号
+            :param tool_name: 工具名
+            :param arguments: 调用参数
+            :return: (缓存实例, 键)，工具未开启缓存时返回(None, None)
+            """
+            cache = self.tool_caches.get(tool_name)
+            if cache is None:
+                return None, None
+            model_arguments = {key: value for key, value in arguments.items() if key not in INJECTED_ARGUMENTS}
+            return cache, ResponseCache.make_key(tool_name, model_arguments)
+
+        def _build_template_tools(self):
+            """
+            为每个模板按模板中的顺序构建工具集，配置了tool_selection的模板同时构建工具索引
+            """
+            template_tools, tool_selectors = {}, {}
+            for template in self.templates:
+                llmtools = LLMTools()
+                for tool_name in self._template_tool_names(template):
+                    tool_class = self.tool_classes.get(tool_name)
+                    if tool_class is None:
+                        logger.error(f"模板 {template['name']} 中的工具 {tool_name} 不存在")
+                        continue
+                    llmtools.add_tools([tool_class])
+                logger.info(f"模板 {template['name']} 的工具json: {llmtools.tools}, 映射表: {llmtools.available_functions}")
+                template_tools[template["name"]] = llmtools
+                if template.get("tool_selection"):
+                    tool_selectors[template["name"]] = ToolSelector(llmtools, **template["tool_selection"])
+            self.tool_selectors = tool_selectors
+            self.template_tools = template_tools # 整体替换，正在创建任务的线程不会看到构建了一半的字典
+
+        def _template_tool_names(self, template):
+            """
+            取出模板中声明的工具名，兼容 "- 工具名" 和 "- 工具名: 描述" 两种写法
             :param template: 任务模板
-            :return: 布尔值，表示工具是否在模板中
+            :return: 工具名列表
             """
-            for tool_template in template['tools']:
-                if list(tool_template.keys())[0] == tool_class.__name__:
-                    return True
-            return False
+            return [next(iter(tool)) if isinstance(tool, dict) else tool for tool in template['tools'] or []]
+
+        def _watch_tools(self, interval):
+            """
+            定期检查工具文件的修改时间，有变化时重新加载并重建工具集，已创建的任务继续使用旧工具集
+            :param interval: 检查间隔(秒)
+            """
+            while True:
+                time.sleep(interval)
+                with self.lock:
+                    if self._load_tools():
+                        self._build_template_tools()
 
     class RestServer:
-        def __init__(self, meta_tasks: list, task_templates, tasks_list: list, meta_tasks_lock, tasks_list_lock, port=5000):
+        def __init__(self, meta_tasks: list, task_templates, tasks: dict, meta_tasks_lock, tasks_lock, scheduler, stream_hub, port=5000, meta_log=None,
+                     request_tracker=None, max_poll=60.0, task_store=None, admission=None, status_board=None, http=None):
             """
             初始化REST服务器类
-            :param meta_tasks: 元任务列表
+            :param meta_tasks: 元任务会话表
             :param task_templates: 任务模板实例
-            :param tasks_list: 任务列表
+            :param tasks: 以uuid为键的任务字典
+            :param scheduler: 调度器实例，新任务通过它入队
+            :param stream_hub: 顶层任务输出的广播中心
             :param port: 服务器端口号
+            :param meta_log: 元任务预写日志，为None时不持久化
+            :param request_tracker: 请求结果表，和调度器共用
+            :param max_poll: 长轮询取结果时最多等待的秒数
+            :param task_store: 任务存储，不为None时元任务的输入只写进存储，由工作者租取执行
+            :param admission: 准入控制，为None时接受所有激活
+            :param status_board: 状态公告板，/status从它的快照读取会话和任务
+            :param http: HTTP服务器配置，例如 {"server": "waitress", "threads": 16}，为None时使用Flask自带的服务器
             """
             self.app = Flask(__name__)
             self.port = port
             self.meta_tasks = meta_tasks
             self.task_templates = task_templates
-            self.tasks_list = tasks_list
+            self.tasks = tasks
             self.meta_tasks_lock = meta_tasks_lock
-            self.tasks_list_lock = tasks_list_lock
+            self.tasks_lock = tasks_lock
+            self.scheduler = scheduler
+            self.stream_hub = stream_hub
+            self.meta_log = meta_log
+            self.request_tracker = request_tracker
+            self.max_poll = max_poll
+            self.task_store = task_store
+            self.admission = admission
+            self.status_board = status_board or XingHe.StatusBoard()
+            self.http = dict(http or {})
             self.setup_routes()
             logger.info("REST服务器初始化完成，端口号: %d", self.port)
 
-        def get_system_status(self):
+        def get_system_status(self, since=None, if_none_match=None):
             """
-            提取系统运行状态
-            :return: 包含系统状态信息的字典
+            提取系统运行状态：会话和任务列表来自状态公告板的快照，不获取调度器的锁
+            :param since: 客户端已有的状态版本，给出时会话和任务只返回增量
+            :param if_none_match: 客户端缓存的ETag集合，和当前状态一致时不生成状态
+            :return: (状态字典, ETag)，状态没有变化时状态字典为None
             """
-            status = {
-            "task_templates": self.task_templates.templates,
-            "meta_tasks": [],
-            "tasks_list": []
-            }
-
-            with self.meta_tasks_lock:
-                for task in self.meta_tasks:
-                    status["meta_tasks"].append({
-                    "uuid": task.info["uuid"],
-                    "name": task.info["task_name"],
-                    "status": task.status
-                    })
+            snapshot = self.status_board.snapshot
+            extra = {"task_templates": self.task_templates.templates}
+            if self.task_store is not None:
+                extra["task_store"] = self.task_store.stats()
+            if self.admission is not None:
+                extra["admission"] = dict(self.admission.stats(), in_flight=self.priority_load())
+            # 会话和任务由版本号标识，模板、任务存储和准入统计没有版本，按内容算校验和
+            etag = "%d-%08x" % (snapshot["version"], zlib.crc32(json.dumps(extra, sort_keys=True, default=str).encode()))
+            if if_none_match is not None and if_none_match.contains(etag):
+                return None, etag
+            return dict(self.status_board.view(snapshot, since), **extra), etag
 
-            with self.tasks_list_lock:
-                for task in self.tasks_list:
-                    status["tasks_list"].append({
-                    "uuid": task.info["uuid"],
-                    "name": task.info["task_name"],
-                    "status": task.status
-                    })
-
-            return status
-
-        def save_meta_tasks(self, filename='meta_tasks.pkl'):
+        def save_meta_tasks(self):
             """
-            保存当前meta_task元任务的状态到本地文件
-            :param filename: 保存文件名
+            元任务的对话变更由预写日志持续保存，这里等待日志落盘并写一次快照
+            :return: 是否已保存
             """
-            with self.meta_tasks_lock:
-                meta_tasks_state = [{'uuid': task.info['uuid'], 'context_ctrl': task.context_ctrl} for task in self.meta_tasks]
-                with open(filename, 'wb') as file:
-                    pickle.dump(meta_tasks_state, file)
-            logger.info("元任务状态已保存到 %s", filename)
+            if self.meta_log is None:
+                logger.error("未配置persistence，元任务状态不会保存")
+                return False
+            saved = self.meta_log.flush(snapshot=True, timeout=30)
+            logger.info("元任务状态已保存到 %s", self.meta_log.snapshot_path)
+            return saved
 
-        def load_meta_tasks(self, filename='meta_tasks.pkl'):
+        def load_meta_tasks(self):
             """
-            从本地文件恢复所有元任务
-            :param filename: 恢复文件名
+            按预写日志中的状态恢复空闲的元任务，会话创建时已经自动恢复过，通常不需要调用
+            :return: 是否已恢复
             """
-            with open(filename, 'rb') as file:
-                meta_tasks_state = pickle.load(file)
+            if self.meta_log is None:
+                logger.error("未配置persistence，没有可恢复的元任务状态")
+                return False
+            self.meta_log.flush(timeout=30)
             with self.meta_tasks_lock:
-                for state in meta_tasks_state:
-                    for task in self.meta_tasks:
-                        if task.info['uuid'] == state['uuid']:
-                            task.context_ctrl = state['context_ctrl']
-                            break
-            logger.info("元任务状态已从 %s 恢复", filename)
+                for session in self.meta_tasks.sessions.values():
+                    if not session.active:
+                        self.meta_log.attach(session.task)
+            logger.info("元任务状态已从 %s 恢复", self.meta_log.path)
+            return True
 
         def setup_routes(self):
             """
@@ -179,181 +1449,973 @@ class XingHe:
             """
             @self.app.route('/activate_task', methods=['POST'])
             def activate_task():
-                message = request.json
-                self.active_task(message)
-                return jsonify({"status": "OK"})
+                result = self.active_task(request.json, self.client_id())
+                headers = {"Retry-After": str(result["retry_after"])} if "retry_after" in result else {}
+                return jsonify(result), self.result_code(result), headers
+
+            @self.app.route('/activate_tasks', methods=['POST'])
+            def activate_tasks():
+                # 批量激活，请求体为激活消息的列表，按顺序返回每条的结果和状态码
+                messages = request.json
+                if not isinstance(messages, list):
+                    return jsonify({"status": "Error", "error": "expected a list of activations"}), 400
+                results = []
+                client = self.client_id()
+                for message in messages:
+                    result = self.active_task(message, client)
+                    result["code"] = self.result_code(result)
+                    results.append(result)
+                return jsonify({"status": "OK", "results": results})
+
+            @self.app.route('/result/<request_id>', methods=['GET'])
+            def get_result(request_id):
+                # 长轮询：请求未完成时最多等待 ?timeout= 秒，完成返回200，仍在进行返回202
+                try:
+                    timeout = min(float(request.args.get("timeout", 0)), self.max_poll)
+                except ValueError:
+                    return jsonify({"status": "Error", "error": "invalid timeout"}), 400
+                result = (self.task_store or self.request_tracker).get(request_id, timeout)
+                if result is None:
+                    return jsonify({"status": "Error", "error": "unknown or expired request"}), 404
+                return jsonify(result), 202 if result["state"] == "pending" else 200
+
+            @self.app.route('/stream/<task_name>', methods=['GET'])
+            def stream(task_name):
+                # Server-Sent Events，逐段推送顶层任务的输出，回复结束时推送reply事件
+                # 元任务按 ?session_id= 订阅某个会话，不指定时为默认会话
+                template = self.task_templates.get_template(task_name)
+                session_id = request.args.get("session_id", DEFAULT_SESSION) if template and template.get("is_meta") else None
+                topic = self.stream_hub.topic(task_name, session_id)
+                queue = self.stream_hub.subscribe(topic)
+                def events():
+                    try:
+                        while True:
+                            try:
+                                event = queue.get(timeout=15)
+                            except Empty:
+                                yield ": keepalive\n\n"
+                                continue
+                            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    finally:
+                        self.stream_hub.unsubscribe(topic, queue)
+                return Response(events(), mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
             @self.app.route('/status', methods=['GET'])
             def status():
-                logger.info(self.get_system_status())
-                return jsonify(self.get_system_status())
+                # 支持If-None-Match，?since=版本 只返回之后变化的会话和任务
+                try:
+                    since = int(request.args["since"]) if "since" in request.args else None
+                except ValueError:
+                    return jsonify({"status": "Error", "error": "invalid since"}), 400
+                status, etag = self.get_system_status(since, request.if_none_match)
+                if status is None:
+                    response = Response(status=304)
+                else:
+                    logger.debug("状态查询: %d 个元任务, %d 个任务", len(status["meta_tasks"]), len(status["tasks_list"]))
+                    response = jsonify(status)
+                response.set_etag(etag)
+                return response
+
+            @self.app.route('/metrics', methods=['GET'])
+            def metrics_endpoint():
+                return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
             @self.app.route('/save_meta_tasks', methods=['POST'])
             def save_meta_tasks():
-                self.save_meta_tasks()
+                if not self.save_meta_tasks():
+                    return jsonify({"status": "Error", "error": "persistence disabled"}), 503
                 return jsonify({"status": "OK"})
 
             @self.app.route('/load_meta_tasks', methods=['POST'])
             def load_meta_tasks():
-                self.load_meta_tasks()
+                if not self.load_meta_tasks():
+                    return jsonify({"status": "Error", "error": "persistence disabled"}), 503
                 return jsonify({"status": "OK"})
 
-        def active_task(self, message: dict):
+        @staticmethod
+        def result_code(result: dict) -> int:
+            """
+            激活结果对应的HTTP状态码，会话数满、该会话排队已满或客户端超过限速时返回429，服务过载时返回503，
+            这几种结果都带retry_after，客户端按它稍后重试
+            """
+            return {"busy": 429, "queue_full": 429, "rate_limited": 429, "overloaded": 503,
+                    "not_found": 404}.get(result["result"], 200 if result["status"] == "OK" else 400)
+
+        def client_id(self):
+            # 当前请求的客户端标识，优先取准入控制配置的请求头
+            header = self.admission.client_header if self.admission is not None else None
+            return (header and request.headers.get(header)) or request.remote_addr
+
+        def priority_load(self) -> dict:
+            """
+            进行中的请求数按任务模板的优先级汇总，模板已被删除的请求排在所有优先级之后
+            :return: 优先级 -> 进行中的请求数
+            """
+            load = {}
+            for name, count in (self.task_store or self.request_tracker).outstanding().items():
+                template = self.task_templates.get_template(name)
+                priority = template["pirority"] if template else float("inf")
+                load[priority] = load.get(priority, 0) + count
+            return load
+
+        def active_task(self, message: dict, client=None):
             """
             激活任务
             :param message: 包含任务信息的字典
+            :param client: 客户端标识，准入控制按它限速
+            :return: 结果字典，status为OK或Error，result说明输入是开始处理、排队还是被拒绝，
+                     被接受时带request_id，用 /result/<request_id> 取回复；因负载被拒绝时带retry_after(秒)
             """
-            # 消息的格式为{"name": "task_name", "input": "input", (可选)"parent_uuid": "uuid"}
+            # 消息的格式为{"name": "task_name", "input": "input", (可选)"session_id": "会话", (可选)"parent_uuid": "uuid"}
+            if not isinstance(message, dict) or "name" not in message or "input" not in message:
+                logger.error(f"激活消息格式错误: {message}")
+                return {"status": "Error", "result": "bad_request"}
             if self.task_templates.get_template(message["name"]) == None:
                 logger.error(f"任务 {message['name']} 不存在")
-                return
+                return {"status": "Error", "result": "not_found"}
             task_info = self.task_templates.get_template(message["name"])
+            if self.admission is not None:
+                rejected = self.admission.admit(client, task_info["pirority"], self.priority_load)
+                if rejected is not None:
+                    logger.warning(f"任务 {message['name']} 的激活被准入控制拒绝: {rejected['result']}")
+                    return rejected
+            if self.task_store is not None:
+                return self.enqueue_task(message, task_info)
 
-            if task_info["is_meta"]: # 如果是元任务
-                new_meta_task = None
-                for meta_task in self.meta_tasks:
-                    if meta_task.info["task_name"] == message["name"]:
-                        if meta_task.status == "Free":
-                            new_meta_task = meta_task
-                            break
-                        elif meta_task.status == "ReUser" or meta_task.status == "ToolCall" or (meta_task.status == "ReTool" and not meta_task.events["suspend"].is_set()):
-                            logger.info(f"元任务 {message['name']} 正在运行，等待")
-                            return
-                        elif meta_task.status == "Ready":
-                            logger.error(f"元任务 {message['name']} 已完成，不可重复激活")
-                            return
-                        elif meta_task.status == "ReTool" and meta_task.events["suspend"].is_set():
-                            # 放弃调用工具，返回预设打断模板+用户输入
-                            # 递归深入子任务和子任务的子任务直到最后一层，然后从task_list中删除他们
-                            self._remove_subtasks(meta_task.info["uuid"])
-                            meta_task.suspend("None", "None", False, True, message["input"])
-                            return
-                        else:
-                            logger.error(f"元任务 {message['name']} 状态异常")
-                            return
-                if new_meta_task is None: # 如果已实例化的元任务列表中没有这个元任务
-                    logger.info(f"任务 {message['name']} 是元任务，但未在元任务列表中，创建")
-                    # 创建元任务，搞一个统一的创建任务的函数
-                    new_meta_task = self.task_templates.get_task(message["name"])
-                    with self.meta_tasks_lock:
-                        self.meta_tasks.append(new_meta_task) # 添加到元任务列表
-
-                # 激活并放入队列
-                new_meta_task.context_ctrl["input"] = message["input"]
-                new_meta_task.forward()
-                with self.tasks_list_lock:
-                    self.tasks_list.append(new_meta_task)
-                logger.info(f"元任务 {message['name']} 已激活并添加到任务列表")
-                logger.info("当前元任务列表: %s", self.meta_tasks)
+            if task_info["is_meta"]: # 如果是元任务，每个session_id一个实例
+                session_id = str(message.get("session_id") or DEFAULT_SESSION)
+                request_id = self.request_tracker.create(name=message["name"], session_id=session_id)
+                result, meta_task = self.meta_tasks.submit(message["name"], session_id, message["input"], request_id)
+                if result == "start":
+                    self.scheduler.add_task(meta_task)
+                    logger.info(f"元任务 {message['name']} 的会话 {session_id} 已激活并添加到任务列表")
+                elif result == "interrupt":
+                    # 放弃调用工具，返回预设打断模板+用户输入
+                    # 取消并删除整棵子任务树，子任务在途的推理和工具调用随之中止
+                    # 这一轮的回复改为属于新请求，被打断的请求指向它
+                    self.request_tracker.finish(meta_task.info["request_id"], state="interrupted", superseded_by=request_id)
+                    meta_task.info["request_id"] = request_id
+                    self.scheduler.remove_subtasks(meta_task.info["uuid"])
+                    meta_task.suspend("None", "None", False, True, message["input"])
+                elif result == "queued":
+                    logger.info(f"元任务 {message['name']} 的会话 {session_id} 正在运行，输入已排队")
+                else:
+                    logger.warning(f"元任务 {message['name']} 的会话 {session_id} 无法接收输入: {result}")
+                    self.request_tracker.discard(request_id)
+                    return self.retry_later({"status": "Error", "result": result, "session_id": session_id}, task_info)
+                return {"status": "OK", "result": result, "session_id": session_id, "request_id": request_id}
             elif message.get("parent_uuid", None) is None:
                 logger.error("子任务%s没有指定父任务",message["name"])
+                return {"status": "Error", "result": "no_parent"}
             # 如果是子任务
             else:
-                for parent_task in self.tasks_list:
-                    if parent_task.info["uuid"] == message.get("parent_uuid", None):
-                        # 创建子任务
-                        child_task = self.task_templates.get_task(message["name"])
-                        parent_task.suspend(child_task.info["uuid"], child_task.info["task_name"], True, False)
-                        child_task.info["parent_uuid"] = message.get("parent_uuid", None)
-                        child_task.context_ctrl["input"] = message["input"]
-                        child_task.forward()
-                        with self.tasks_list_lock:
-                            self.tasks_list.append(child_task)
-                        logger.info(f"子任务 {message['name']} 已激活并添加到任务列表")
-                        break
+                request_id = self.request_tracker.create(name=message["name"], parent_uuid=message["parent_uuid"])
+                try:
+                    self.scheduler.spawn_subtask(message["name"], message["input"], message["parent_uuid"], request_id)
+                except ValueError as e:
+                    logger.error(f"子任务 {message['name']} 创建失败: {e}")
+                    self.request_tracker.discard(request_id)
+                    return {"status": "Error", "result": "spawn_failed"}
+                return {"status": "OK", "result": "start", "request_id": request_id}
+
+        def retry_later(self, result: dict, task_info: dict) -> dict:
+            # 会话数满或会话排队已满的拒绝结果也带上Retry-After估计
+            if self.admission is not None:
+                result["retry_after"] = self.admission.retry_after(task_info["pirority"], self.priority_load())
+            return result
 
-        def _remove_subtasks(self, parent_uuid):
+        def enqueue_task(self, message: dict, task_info: dict):
             """
-            递归删除子任务和子任务的子任务
-            :param parent_uuid: 父任务的UUID
+            把元任务的输入写进任务存储，由工作者按会话顺序处理；会话忙时同样排队，不会打断正在进行的一轮
+            子任务挂在某个工作者进程里的父任务上，不能经任务存储创建
+            :return: 和active_task相同格式的结果字典
             """
-            subtasks_to_remove = [task for task in self.tasks_list if task.info.get("parent_uuid") == parent_uuid]
-            for subtask in subtasks_to_remove:
-                self._remove_subtasks(subtask.info["uuid"])
-                self.tasks_list.remove(subtask)
-                logger.info(f"子任务 {subtask.info['task_name']} 已从任务列表中删除")
+            if not task_info["is_meta"]:
+                logger.error(f"使用任务存储时不能经REST创建子任务 {message['name']}")
+                return {"status": "Error", "result": "unsupported"}
+            session_id = str(message.get("session_id") or DEFAULT_SESSION)
+            request_id = self.task_store.enqueue(message["name"], session_id, message["input"], self.meta_tasks.max_pending)
+            if request_id is None:
+                logger.warning(f"元任务 {message['name']} 的会话 {session_id} 排队已满")
+                return self.retry_later({"status": "Error", "result": "queue_full", "session_id": session_id}, task_info)
+            return {"status": "OK", "result": "queued", "session_id": session_id, "request_id": request_id}
 
         def start(self):
             """
-            启动REST服务器
+            启动REST服务器：默认是Flask自带的开发服务器；server为"waitress"时用waitress的线程池，
+            多进程部署用gunicorn加载 create_app，不经过这里
             """
-            self.app.run(host='0.0.0.0', port=self.port)
+            server = self.http.get("server", "flask")
+            host = self.http.get("host", "0.0.0.0")
+            if server == "waitress":
+                from waitress import serve # 可选依赖，只在配置了waitress时需要
+                serve(self.app, host=host, port=self.port, threads=self.http.get("threads", 16))
+            elif server == "flask":
+                self.app.run(host=host, port=self.port, threaded=True)
+            else:
+                raise ValueError(f"未知的HTTP服务器 {server}，可选 flask、waitress")
 
     class Scheduler:
-        def __init__(self, meta_tasks: list, tasks_list: list, meta_tasks_lock, tasks_list_lock):
+        def __init__(self, meta_tasks: list, tasks: dict, meta_tasks_lock, tasks_lock, stream_hub=None, task_templates=None, router=None,
+                     request_tracker=None, status_board=None, idle_timeout=5.0, aging_interval=10.0, tool_workers=8, tool_timeout=60.0,
+                     max_infer_failures=3, retry_backoff=1.0):
             """
             初始化调度器类
-            :param meta_tasks: 元任务列表
-            :param tasks_list: 任务列表
+            :param meta_tasks: 元任务会话表
+            :param tasks: 以uuid为键的任务字典
+            :param stream_hub: 顶层任务输出的广播中心，为None时不推送
+            :param task_templates: 任务模板实例，用于进程内创建子任务
+            :param router: 推理路由器，为None时使用默认后端
+            :param request_tracker: 请求结果表，顶层任务和经REST创建的子任务的回复写入其中，为None时不记录
+            :param status_board: 状态公告板，任务登记、移除和状态变化时写入，为None时不发布
+            :param idle_timeout: 无唤醒信号时的兜底检查间隔(秒)
+            :param aging_interval: 老化间隔(秒)，每等待这么久相当于优先级提升一级，防止低优先级任务饿死
+            :param tool_workers: 共享工具线程池的线程数，同一条回复中的多个工具调用在池中并发执行
+            :param tool_timeout: 工具调用的默认超时(秒)，工具类可以用execution或timeout属性覆盖
+            :param max_infer_failures: 一轮中推理连续失败多少次后以错误回复结束这一轮，路由器内部的重试和故障转移不计在内
+            :param retry_backoff: 暂时性推理错误后第一次重试前的等待(秒)，之后每次失败翻倍
             """
             self.infer_queue = Queue()
             self.meta_tasks = meta_tasks
-            self.tasks_list = tasks_list
+            self.tasks = tasks
             self.meta_tasks_lock = meta_tasks_lock
-            self.tasks_list_lock = tasks_list_lock
+            self.tasks_lock = tasks_lock
+            self.stream_hub = stream_hub
+            self.task_templates = task_templates
+            self.router = router or InferenceRouter.from_config(DEFAULT_BACKENDS)
+            self.request_tracker = request_tracker
+            self.status_board = status_board
+            self.children = {} # 父任务uuid -> 子任务uuid集合
+            self.ready_heap = [] # 待推理任务堆，元素为(老化后的优先级键, 入队序号, uuid)
+            self.in_ready = set() # 已在堆中的任务uuid，保证每个任务最多一个条目
+            self.ready_seq = itertools.count()
+            self.pending = deque() # 状态发生变化、等待调度循环处理的任务
+            self.reply_handlers = {} # 调度器内部创建的顶层任务uuid -> 接收回复的回调
+            self.summarizing = set() # 正在压缩历史的任务uuid
+            self.compactions = {} # 摘要已生成、等任务不在推理或调用工具时再压缩的任务uuid -> (任务, 发起时的history, 条数, 摘要)
+            self.cache_keys = {} # 开启了缓存的子任务uuid -> (缓存实例, 键)，完成时写入结果
+            self.wakeup = Event() # 任务状态变化时置位，唤醒调度循环
+            self.idle_timeout = idle_timeout
+            self.aging_interval = aging_interval
+            # 共享工具线程池，由策略持有，有调用超时时整个换掉
+            self.tool_pool = ToolPolicy('tool', 'thread', max_concurrency=tool_workers)
+            self.tool_timeout = tool_timeout
+            self.max_infer_failures = max_infer_failures
+            self.retry_backoff = retry_backoff
+            self.default_tool_policy = ToolPolicy('default') # 没有通过模板加载的工具使用共享线程池
             logger.info("调度器初始化完成")
 
+        def notify(self, task=None):
+            """
+            唤醒调度器，由任务状态变化、挂起/恢复、工具完成等处调用
+            :param task: 发生变化的任务实例
+            """
+            if task is not None:
+                self.pending.append(task)
+                if self.status_board is not None:
+                    self.status_board.task_changed(task)
+            self.wakeup.set()
+
+        def add_task(self, task):
+            """
+            将任务加入任务字典并注入唤醒回调
+            :param task: 任务实例
+            """
+            with self.tasks_lock:
+                self._register_task(task)
+            self.notify(task)
+
+        def _register_task(self, task):
+            """
+            登记任务并建立父子索引，子任务的取消令牌由父任务的令牌派生，调用方需持有tasks_lock
+            :param task: 任务实例
+            """
+            task.notify = self.notify
+            self.tasks[task.info["uuid"]] = task
+            parent_task = self.tasks.get(task.info["parent_uuid"]) if task.info["parent_uuid"] else None
+            task.cancel_token = CancelToken(parent_task.cancel_token if parent_task is not None else None)
+            if task.info["parent_uuid"]:
+                self.children.setdefault(task.info["parent_uuid"], set()).add(task.info["uuid"])
+            if self.status_board is not None:
+                self.status_board.put("tasks_list", task.info["uuid"],
+                                      {"uuid": task.info["uuid"], "name": task.info["task_name"], "status": task.status})
+            metrics.set_gauge('xh_tasks_in_flight', len(self.tasks))
+
+        def spawn_subtask(self, name: str, input: str, parent_uuid: str, request_id=None) -> SubtaskHandle:
+            """
+            在进程内创建子任务并挂起父任务，作为句柄注入给子任务唤起函数，不经过REST服务器
+            :param name: 子任务模板名称
+            :param input: 子任务输入
+            :param parent_uuid: 父任务的UUID
+            :param request_id: 经REST创建时的请求id，子任务的结果同时写入请求结果表
+            :return: 子任务句柄，工具直接返回它即可，结果会在子任务完成后写回父任务
+            """
+            parent_task = self.get_task(parent_uuid)
+            if parent_task is None:
+                raise ValueError(f"父任务 {parent_uuid} 不存在")
+            if parent_task.info["child_uuid"] is not None:
+                raise ValueError(f"父任务 {parent_uuid} 已经挂起在子任务 {parent_task.info['child_uuid']} 上")
+            cache, key = self.task_templates.subtask_cache_key(name, input)
+            if cache is not None:
+                cached = cache.get(key)
+                if cached is not None:
+                    # 缓存命中，不创建子任务，直接经suspend把结果写回父任务
+                    cached_uuid = "cache" + key[:27]
+                    parent_task.suspend(cached_uuid, name, True, False)
+                    parent_task.suspend(cached_uuid, name, False, False, cached)
+                    if self.request_tracker is not None:
+                        self.request_tracker.finish(request_id, cached)
+                    logger.info(f"子任务 {name} 命中缓存")
+                    return SubtaskHandle(cached_uuid)
+            child_task = self.task_templates.get_task(name)
+            child_task.info["parent_uuid"] = parent_uuid
+            child_task.info["request_id"] = request_id
+            if cache is not None:
+                self.cache_keys[child_task.info["uuid"]] = (cache, key)
+            parent_task.suspend(child_task.info["uuid"], child_task.info["task_name"], True, False)
+            child_task.set_input(input)
+            child_task.forward()
+            self.add_task(child_task)
+            logger.info(f"子任务 {name} 已激活并添加到任务列表")
+            return SubtaskHandle(child_task.info["uuid"])
+
+        def get_task(self, uuid):
+            """
+            按uuid查找任务
+            :param uuid: 任务uuid
+            :return: 任务实例，不存在时返回None
+            """
+            with self.tasks_lock:
+                return self.tasks.get(uuid)
+
+        def _remove_task(self, task):
+            """
+            从任务字典和父子索引中移除任务，调用方需持有tasks_lock
+            :param task: 任务实例
+            """
+            self.tasks.pop(task.info["uuid"], None)
+            self.children.pop(task.info["uuid"], None)
+            self.cache_keys.pop(task.info["uuid"], None)
+            if task.cancel_token is not None:
+                task.cancel_token.detach()
+            siblings = self.children.get(task.info["parent_uuid"])
+            if siblings is not None:
+                siblings.discard(task.info["uuid"])
+                if not siblings:
+                    self.children.pop(task.info["parent_uuid"], None)
+            if self.status_board is not None:
+                self.status_board.remove("tasks_list", task.info["uuid"])
+            metrics.set_gauge('xh_tasks_in_flight', len(self.tasks))
+
+        def remove_subtasks(self, parent_uuid):
+            """
+            取消并删除子任务和子任务的子任务，只遍历该子树；在途的推理和工具调用经取消令牌中止，结果不再写回
+            :param parent_uuid: 父任务的UUID
+            """
+            with self.tasks_lock:
+                stack = list(self.children.get(parent_uuid, ()))
+                while stack:
+                    subtask = self.tasks.get(stack.pop())
+                    if subtask is None:
+                        continue
+                    stack.extend(self.children.get(subtask.info["uuid"], ()))
+                    subtask.cancel_token.set()
+                    metrics.inc('xh_cancelled_total', kind='task')
+                    self._remove_task(subtask)
+                    if self.request_tracker is not None:
+                        self.request_tracker.finish(subtask.info["request_id"], state="cancelled")
+                    logger.info(f"子任务 {subtask.info['task_name']} 已从任务列表中删除")
+
+        def _push_ready(self, task):
+            """
+            将待推理任务压入堆，键为 优先级*老化间隔+入队时间，
+            等价于每等待aging_interval秒优先级提升一级，同优先级先进先出
+            :param task: 任务实例
+            """
+            if task.info["uuid"] in self.in_ready:
+                return
+            key = task.info["priority"] * self.aging_interval + time.monotonic()
+            heapq.heappush(self.ready_heap, (key, next(self.ready_seq), task.info["uuid"]))
+            self.in_ready.add(task.info["uuid"])
+
+        def _pop_ready(self):
+            """
+            弹出堆中第一个仍处于待推理状态的任务，过期条目直接丢弃
+            :return: (堆条目, 任务实例)，没有可推理任务时返回(None, None)
+            """
+            while self.ready_heap:
+                entry = heapq.heappop(self.ready_heap)
+                self.in_ready.discard(entry[2])
+                task = self.tasks.get(entry[2])
+                if (task is not None and task.status in ("ReUser", "ReTool")
+                        and not task.events["suspend"].is_set() and not task.events["running"].is_set()):
+                    return entry, task
+            return None, None
+
+        def _route(self, task):
+            """
+            取任务模板指定的模型和候选后端
+            :param task: 任务实例
+            :return: (模型名, 候选后端名列表)，候选为None表示所有后端都可以
+            """
+            template = self.task_templates.get_template(task.info["task_name"]) if self.task_templates else None
+            if template is None:
+                return DEFAULT_MODEL, None
+            backends = template.get("backend")
+            if isinstance(backends, str):
+                backends = [backends]
+            return template.get("model", DEFAULT_MODEL), backends
+
+        def _token_callback(self, task):
+            """
+            顶层任务的逐段输出推送给订阅者，子任务的输出只回给父任务，不推送
+            :param task: 任务实例
+            :return: 回调函数或None
+            """
+            if self.stream_hub is None or task.info["parent_uuid"]:
+                return None
+            topic, uuid = self.stream_hub.topic(task.info["task_name"], task.info["session_id"]), task.info["uuid"]
+            return lambda text: self.stream_hub.publish(topic, {"type": "token", "uuid": uuid, "content": text})
+
         def infer(self):
             """
-            执行推理任务
+            执行推理任务，可以启动多个线程作为推理工作者并发执行
             """
             while True:
-                task = self.infer_queue.get()
-                logger.info(f"开始推理任务 {task.info['uuid']}")
-                task.context_ctrl["response"] = ollama.infer('qwen2.5:7b', task.get_context(), task.tools_ctrl["llmtools"].tools)
+                task, backend = self.infer_queue.get()
+                token = task.cancel_token
+                if token.is_set(): # 排队期间任务被取消，不再发出请求
+                    self.router.release(backend)
+                    self._inference_cancelled(task)
+                    continue
+                model, candidates = self._route(task)
+                logger.info(f"开始推理任务 {task.info['uuid']}，后端 {backend}，模型 {model}")
+                try:
+                    # 路由器在返回前释放槽位，失败时会尝试转移到其他候选后端
+                    response = self.router.infer(backend, model, task.get_context(), task.tool_schema(),
+                                                 candidates=candidates, on_token=self._token_callback(task), cancel=token)
+                except InferenceCancelled:
+                    self._inference_cancelled(task)
+                    continue
+                except Exception as e:
+                    self._inference_failed(task, e)
+                    continue
+                if token.is_set(): # 非流式请求无法中途打断，结果作废
+                    self._inference_cancelled(task)
+                    continue
+                task.info["infer_failures"] = 0
+                task.set_response(response)
                 task.forward()
                 task.events['running'].clear()
+                self.notify(task)
                 logger.info(f"推理任务 {task.info['uuid']} 完成")
 
-        def toolcall(self, task):
+        def _inference_failed(self, task, error):
             """
-            执行工具调用任务
+            处理一次失败的推理(路由器的重试和故障转移都已用尽)：暂时性错误(连接、429、5xx)的任务按指数退避
+            延迟后再通知调度器重试，避免后端故障时空转；其他错误(如400、上下文超长)重试也不会成功，
+            和连续失败max_infer_failures次的任务一样以错误回复结束这一轮，请求结果、准入计数和会话随之释放
             :param task: 任务实例
+            :param error: 推理抛出的异常
             """
-            task.action_toolcall()
+            logger.error(f"推理任务 {task.info['uuid']} 失败: {error!r}", exc_info=error)
+            task.info["infer_failures"] += 1
+            if isinstance(error, Inference.TRANSIENT_ERRORS) and task.info["infer_failures"] < self.max_infer_failures:
+                task.events['running'].clear()
+                self.notify() # 槽位已释放，等待中的其他任务可以派发
+                retry = Timer(self.retry_backoff * 2 ** (task.info["infer_failures"] - 1), self.notify, (task,))
+                retry.daemon = True
+                retry.start()
+                return
+            metrics.inc('xh_inference_failed_total', task=task.info["task_name"])
+            task.info["infer_failures"] = 0
+            task.fail(f"推理失败({type(error).__name__}): {error}")
             task.events['running'].clear()
-            logger.info(f"工具调用任务 {task.info['uuid']} 完成")
+            self.notify(task)
+
+        def _inference_cancelled(self, task):
+            """
+            记录一次因任务被取消而中止或作废的推理，调用前后端槽位已经释放，唤醒调度器派发等待中的任务
+            """
+            task.events['running'].clear()
+            metrics.inc('xh_cancelled_total', kind='inference')
+            logger.info(f"推理任务 {task.info['uuid']} 已取消")
+            self.notify()
+
+        def _tool_cache(self, tool_name, arguments):
+            """
+            取工具的结果缓存和键
+            :return: (缓存实例, 键)，未开启缓存时返回(None, None)
+            """
+            if self.task_templates is None:
+                return None, None
+            return self.task_templates.tool_cache_key(tool_name, arguments)
+
+        def _store_tool_output(self, cache, key, output):
+            """
+            写入工具结果，子任务句柄和空结果不缓存
+            """
+            if cache is not None and output is not None and not isinstance(output, SubtaskHandle):
+                cache.put(key, output)
+
+        def _tool_policy(self, tool_name):
+            """
+            取工具的执行策略
+            """
+            if self.task_templates is not None:
+                policy = self.task_templates.tool_policies.get(tool_name)
+                if policy is not None:
+                    return policy
+            return self.default_tool_policy
+
+        def _prepare_tools(self, task):
+            """
+            取出一批工具调用并为声明了cancel_event参数的工具注入取消信号，
+            信号由任务的取消令牌派生，调用超时或任务被取消时置位
+            :param task: 任务实例
+            :return: [(工具调用, 函数对象, 参数, 取消信号, 超时秒数, 执行策略)]，参数不合法的调用函数对象为None，参数是ToolError
+            """
+            batch = []
+            for tool_call, function_called, arguments in task.prepare_toolcalls({"spawn_subtask": self.spawn_subtask}):
+                if isinstance(arguments, ToolError):
+                    self._tool_failed(arguments.tool, arguments.kind, arguments.message)
+                cancel_event = task.cancel_token.child()
+                policy = self._tool_policy(tool_call.function.name)
+                if function_called and "cancel_event" in inspect.signature(function_called).parameters:
+                    arguments["cancel_event"] = cancel_event
+                batch.append((tool_call, function_called, arguments, cancel_event, policy.timeout or self.tool_timeout, policy))
+            return batch
+
+        def _recycle_tool_executor(self, policy, executor):
+            """
+            调用超时后换掉它所在的执行器，使用共享线程池的工具换掉共享线程池，卡住的线程不再占用后续调用的名额
+            :param policy: 工具的执行策略
+            :param executor: 这次调用使用的执行器，inline执行时为None
+            """
+            (self.tool_pool if policy.shares_pool else policy).recycle(executor)
+
+        def _tool_failed(self, tool_name, kind, message, exc_info=False):
+            """
+            记录一次失败的工具调用
+            :return: 写进tool_history的结构化错误
+            """
+            logger.error(f"工具 {tool_name} 调用失败({kind}): {message}", exc_info=exc_info)
+            metrics.inc('xh_tool_errors_total', tool=tool_name, kind=kind)
+            return ToolError(kind, tool_name, message)
+
+        def _submit_tool(self, tool_name, function_called, arguments, policy):
+            """
+            按工具的执行策略提交一次调用，开启了缓存的工具先查缓存
+            :return: (Future, 执行器)，命中缓存和inline执行的调用返回已经完成的Future，执行器为None
+            """
+            cache, key = self._tool_cache(tool_name, arguments)
+            if cache is not None:
+                output = cache.get(key)
+                if output is not None:
+                    future = Future()
+                    future.set_result(output)
+                    return future, None
+            start = time.perf_counter()
+
+            def done(future):
+                metrics.observe('xh_tool_seconds', time.perf_counter() - start, tool=tool_name)
+                if not future.cancelled() and future.exception() is None:
+                    self._store_tool_output(cache, key, future.result())
+
+            executor = None
+            if policy.mode == 'inline':
+                future = Future()
+                try:
+                    with policy.slots or contextlib.nullcontext():
+                        future.set_result(call_tool(function_called, arguments))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                executor = policy.get_executor(self.tool_pool)
+                future = executor.submit(call_tool, function_called, arguments)
+            future.add_done_callback(done)
+            return future, executor
+
+        def _finish_tools(self, task, batch, results):
+            """
+            按原始顺序写回一批工具的输出并唤醒调度器；任务已被取消时丢弃输出
+            :param batch: _prepare_tools取出的这批调用
+            :param results: [(工具调用, 函数对象, 输出)]
+            """
+            if task.cancel_token.is_set():
+                task.events['running'].clear()
+                metrics.inc('xh_cancelled_total', len(batch), kind='tool')
+                logger.info(f"工具调用任务 {task.info['uuid']} 已取消，丢弃 {len(batch)} 个调用")
+                return
+            for call in batch:
+                call[3].detach()
+            task.finish_toolcalls(results)
+            task.events['running'].clear()
+            self.notify(task)
+            logger.info(f"工具调用任务 {task.info['uuid']} 完成，共 {len(results)} 个调用")
+
+        def toolcall(self, task):
+            """
+            执行一批工具调用：并发提交到工具线程池，按各自的超时等待，超时的调用被取消且不拖住其他调用
+            :param task: 任务实例
+            """
+            batch = self._prepare_tools(task)
+            token = task.cancel_token
+            start = time.monotonic()
+            # 任务被取消后剩下的调用不再提交
+            submitted = [self._submit_tool(tool_call.function.name, function_called, arguments, policy)
+                         if function_called and not token.is_set() else None
+                         for tool_call, function_called, arguments, _, _, policy in batch]
+            # 任务被取消时不再等待：还在排队的调用直接取消，已经在运行的由派生的cancel_event通知
+            cancelled = Future()
+            def on_cancel():
+                for call in submitted:
+                    if call is not None:
+                        call[0].cancel()
+                cancelled.set_result(None)
+            token.add_callback(on_cancel)
+            results = []
+            for (tool_call, function_called, arguments, cancel_event, timeout, policy), call in zip(batch, submitted):
+                output = arguments if isinstance(arguments, ToolError) else None
+                if call is not None:
+                    future, executor = call
+                    tool_name = tool_call.function.name
+                    try:
+                        wait((future, cancelled), timeout=max(0.0, start + timeout - time.monotonic()), return_when=FIRST_COMPLETED)
+                        if cancelled.done():
+                            break
+                        output = future.result(timeout=0)
+                    except FutureTimeoutError:
+                        future.cancel() # 还在排队的直接取消，已经在运行的通过cancel_event通知，并换掉卡住的工作者
+                        cancel_event.set()
+                        self._recycle_tool_executor(policy, executor)
+                        output = self._tool_failed(tool_name, 'timeout', f"no result after {timeout}s")
+                    except (BrokenExecutor, CancelledError) as e:
+                        output = self._tool_failed(tool_name, 'crashed', f"{type(e).__name__}: {e}")
+                    except Exception as e:
+                        output = self._tool_failed(tool_name, 'exception', f"{type(e).__name__}: {e}", exc_info=True)
+                results.append((tool_call, function_called, output))
+            token.remove_callback(on_cancel)
+            self._finish_tools(task, batch, results)
+
+        def _wait_for_work(self):
+            """
+            阻塞直到有任务状态变化，超时作为兜底
+            """
+            if not self.wakeup.wait(self.idle_timeout):
+                # 兜底：重新检查全部任务，防止遗漏未经notify的状态变化
+                with self.tasks_lock:
+                    self.pending.extend(self.tasks.values())
+            # 先清除再处理，处理期间的新信号会让下一轮立即开始
+            self.wakeup.clear()
+
+        def _complete(self, task):
+            """
+            处理Ready状态的任务：向父任务返回结果或输出回复，并从任务字典中移除，调用方需持有tasks_lock
+            :param task: 任务实例
+            """
+            # 调用task.get_reply()会导致task状态转移，只允许调用一次！！！
+            error, task.info["error"] = task.info["error"], None
+            state = "failed" if error else "done"
+            if task.info["parent_uuid"]:
+                logger.info("任务 %s 有父任务", task.info["uuid"])
+                parent_task = self.tasks.get(task.info["parent_uuid"])
+                if parent_task is None:
+                    logger.error("任务 %s 的父任务 %s 已不存在", task.info["uuid"], task.info["parent_uuid"])
+                    if self.request_tracker is not None:
+                        self.request_tracker.finish(task.info["request_id"], state="cancelled")
+                else:
+                    reply = task.get_reply()
+                    if task.info["uuid"] in self.cache_keys:
+                        cache, key = self.cache_keys.pop(task.info["uuid"])
+                        if not error: # 失败的回复不缓存
+                            cache.put(key, reply)
+                    if self.request_tracker is not None:
+                        self.request_tracker.finish(task.info["request_id"], reply, state=state)
+                    parent_task.suspend(task.info["uuid"], task.info["task_name"], False, False, reply)
+                    logger.info("父任务tool history%s", parent_task.context_ctrl["tool_history"])
+            elif task.info["uuid"] in self.reply_handlers:
+                reply = task.get_reply()
+                self.reply_handlers.pop(task.info["uuid"])(None if error else reply) # 失败时回调收到None
+            else:
+                reply = task.get_reply()
+                logger.info(f"任务 {task.info['task_name']} 回复: {reply}")
+                if self.request_tracker is not None:
+                    self.request_tracker.finish(task.info["request_id"], reply, state=state)
+                if self.stream_hub is not None:
+                    self.stream_hub.publish(self.stream_hub.topic(task.info["task_name"], task.info["session_id"]),
+                                            {"type": "reply", "uuid": task.info["uuid"], "request_id": task.info["request_id"], "content": reply})
+                self._maybe_summarize(task)
+            task.events['end'].set()
+            self._remove_task(task)
+            if task.info["session_id"] is not None and not task.info["parent_uuid"]:
+                # 会话里排队的下一条输入接着处理，先移除再重新登记，保证和新到的激活请求不重复
+                follow_up = self.meta_tasks.next_input(task)
+                if follow_up is not None:
+                    task.events['end'].clear()
+                    task.info["request_id"] = follow_up[1]
+                    task.set_input(follow_up[0])
+                    task.forward()
+                    self._register_task(task)
+                    self.notify(task)
+
+        def _start_toolcall(self, task):
+            """
+            启动一次工具调用，同步调度器为每次调用开一个线程
+            :param task: 任务实例
+            """
+            Thread(target=self.toolcall, args=(task,)).start()
+
+        def _start_infer(self, task, backend):
+            """
+            把任务交给推理工作者
+            :param task: 任务实例
+            :param backend: 已占用槽位的后端名
+            """
+            self.infer_queue.put((task, backend))
+
+        def _schedule_pass(self):
+            """
+            处理状态发生变化的任务，并按优先级派发推理
+            """
+            changed = {}
+            while self.pending:
+                task = self.pending.popleft()
+                changed[task.info["uuid"]] = task
+            with self.tasks_lock:
+                for uuid, task in changed.items():
+                    if uuid in self.compactions:
+                        self._compact(task)
+                    if self.tasks.get(uuid) is not task:
+                        continue # 已被移除的任务
+                    if(task.events["suspend"].is_set() or task.events["running"].is_set()):
+                        continue # 恢复或运行结束时会再次通知
+                    elif (task.status == "ReUser" or task.status == "ReTool"):
+                        self._push_ready(task)
+                    elif task.status == "ToolCall":
+                        task.events['running'].set()
+                        self._start_toolcall(task)
+                    elif task.status == "Ready":
+                        self._complete(task)
+                # 有多少空闲槽位就派发多少个任务，槽位已满时等推理完成释放后再次唤醒
+                # 模板指定的后端都满了的任务先放一边，不挡住能用其他后端的低优先级任务
+                deferred = []
+                while self.ready_heap and self.router.has_free_slot():
+                    entry, task = self._pop_ready()
+                    if task is None:
+                        break
+                    backend = self.router.acquire(self._route(task)[1])
+                    if backend is None:
+                        deferred.append(entry)
+                        continue
+                    # 堆键减去优先级偏移就是入队时间
+                    waited = time.monotonic() - (entry[0] - task.info["priority"] * self.aging_interval)
+                    metrics.observe('xh_queue_wait_seconds', waited, task=task.info["task_name"])
+                    task.events['running'].set()
+                    self._start_infer(task, backend)
+                for entry in deferred:
+                    heapq.heappush(self.ready_heap, entry)
+                    self.in_ready.add(entry[2])
+
+        def _maybe_summarize(self, task):
+            """
+            任务的对话超出上下文预算时，创建模板中配置的摘要任务，把窗口外的较早对话和旧摘要合并成新摘要，调用方需持有tasks_lock
+            :param task: 刚完成一轮回复的任务实例
+            """
+            template = self.task_templates.get_template(task.info["task_name"]) if self.task_templates else None
+            summarizer = template.get("summarizer") if template else None
+            if not summarizer or task.info["uuid"] in self.summarizing:
+                return
+            count = task.history_overflow()
+            if count == 0:
+                return
+            history = task.context_ctrl["user_history"]
+            transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in history[:count])
+            summary_input = f"旧摘要：{task.context_ctrl.get('summary') or '无'}\n新对话：\n{transcript}"
+
+            def on_summary(summary):
+                self.summarizing.discard(task.info["uuid"])
+                if summary is not None:
+                    self.compactions[task.info["uuid"]] = (task, history, count, summary)
+                    self._compact(task)
+
+            summary_task = self.task_templates.get_task(summarizer)
+            summary_task.set_input(summary_input)
+            summary_task.forward()
+            self.summarizing.add(task.info["uuid"])
+            self.reply_handlers[summary_task.info["uuid"]] = on_summary
+            self._register_task(summary_task)
+            self.notify(summary_task)
+            logger.info(f"任务 {task.info['uuid']} 超出上下文预算，开始压缩 {count} 条较早对话")
+
+        def _compact(self, task):
+            """
+            把已生成的摘要压缩进任务的对话，调用方需持有tasks_lock。任务正在推理或调用工具时，
+            推理线程可能正在读user_history构建上下文，先不动，等它运行结束通知调度器时再压缩；
+            running只在持有tasks_lock时被置位，所以这里看到它未置位时，压缩期间任务不会开始运行
+            :param task: 发起压缩的任务实例
+            """
+            if task.events['running'].is_set():
+                return
+            _, history, count, summary = self.compactions.pop(task.info["uuid"])
+            if task.compact_history(history, count, summary):
+                logger.info(f"任务 {task.info['uuid']} 的 {count} 条较早对话已压缩进摘要")
 
         def run(self):
             """
-            运行调度器，定期检查任务状态并执行相应操作
+            运行调度器，被唤醒后处理状态发生变化的任务，并按优先级派发推理
             """
             while True:
-                time.sleep(0.5) # 0.5秒检查一次, 降低CPU占用
-                infer_wait = None
-                with self.tasks_list_lock:
-                    for task in self.tasks_list:
-                        if(task.events["suspend"].is_set() or task.events["running"].is_set()):
-                            continue
-                        elif (task.status == "ReUser" or task.status == "ReTool"):
-                            # 缓存推理任务直到找到优先级最高的
-                            if infer_wait is None:
-                                infer_wait = task
-                            elif task.info["priority"] < infer_wait.info["priority"]:
-                                # 优先级数字越小，优先级越高
-                                infer_wait = task
-                        elif task.status == "ToolCall":
-                            task.events['running'].set()
-                            Thread(target=self.toolcall, args=(task,)).start()
-                        elif task.status == "Ready":
-                            # 调用task.get_reply()会导致task状态转移，只允许调用一次！！！
-                            if task.info["parent_uuid"]:
-                                logger.info("任务 %s 有父任务", task.info["uuid"])
-                                # 从self.tasks_list中找到第一个uuid等于parent_uuid的任务，并将其赋值给parent_task
-                                parent_task = [find_task for find_task in self.tasks_list if find_task.info["uuid"] == task.info["parent_uuid"]][0]
-                                parent_task.suspend(task.info["uuid"], task.info["task_name"], False, False, task.get_reply())
-                                logger.info("父任务tool history%s", parent_task.context_ctrl["tool_history"])
-                            else:
-                                print(task.get_reply())
-                                try: #尚未实现发送消息
-                                    self.send_message("task_reply",{task.info["task_name"]: task.get_reply()})
-                                except Exception as e:
-                                    logger.error(f"发送消息失败: {e}")
-                            task.events['end'].set()
-                            self.tasks_list.remove(task)
-                if infer_wait:
-                    infer_wait.events['running'].set()
-                    self.infer_queue.put(infer_wait)
+                self._wait_for_work()
+                self._schedule_pass()
+
+    class AsyncScheduler(Scheduler):
+        def __init__(self, meta_tasks: list, tasks: dict, meta_tasks_lock, tasks_lock, stream_hub=None, **kwargs):
+            """
+            asyncio调度器：调度循环是协程，推理用异步客户端await，
+            async定义的工具直接await，同步工具放进有界线程池，不再为每次调用开线程
+            """
+            super().__init__(meta_tasks, tasks, meta_tasks_lock, tasks_lock, stream_hub, **kwargs)
+            self.loop = None
+            self.async_wakeup = None
+
+        def notify(self, task=None):
+            """
+            唤醒调度协程，可以从任意线程调用
+            :param task: 发生变化的任务实例
+            """
+            super().notify(task)
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.async_wakeup.set)
+
+        def _start_toolcall(self, task):
+            asyncio.create_task(self.atoolcall(task))
+
+        def _start_infer(self, task, backend):
+            asyncio.create_task(self.ainfer(task, backend))
+
+        async def ainfer(self, task, backend):
+            """
+            执行推理任务
+            :param task: 任务实例
+            :param backend: 已占用槽位的后端名
+            """
+            token = task.cancel_token
+            if token.is_set():
+                self.router.release(backend)
+                self._inference_cancelled(task)
+                return
+            model, candidates = self._route(task)
+            logger.info(f"开始推理任务 {task.info['uuid']}，后端 {backend}，模型 {model}")
+            inference = asyncio.ensure_future(self.router.ainfer(backend, model, task.get_context(), task.tool_schema(),
+                                                                 candidates=candidates, on_token=self._token_callback(task)))
+            # 任务被取消时取消推理协程，在途的请求或流立即关闭；取消可能来自其他线程
+            on_cancel = lambda: self.loop.call_soon_threadsafe(inference.cancel)
+            token.add_callback(on_cancel)
+            try:
+                task.set_response(await inference)
+            except asyncio.CancelledError:
+                if not token.is_set():
+                    raise # 调度器本身在退出
+                self._inference_cancelled(task)
+                return
+            except Exception as e:
+                self._inference_failed(task, e)
+                return
+            finally:
+                token.remove_callback(on_cancel)
+            task.info["infer_failures"] = 0
+            task.forward()
+            task.events['running'].clear()
+            self.notify(task)
+            logger.info(f"推理任务 {task.info['uuid']} 完成")
+
+        async def _arun_tool(self, tool_call, function_called, arguments, cancel_event, timeout, policy):
+            """
+            按工具的执行策略执行一次调用：inline的在事件循环上执行，其余交给线程池或进程池，超时后取消等待、通知工具并换掉卡住的工作者
+            :return: 工具输出
+            """
+            if function_called is None:
+                return arguments if isinstance(arguments, ToolError) else None
+            tool_name = tool_call.function.name
+            cache, key = self._tool_cache(tool_name, arguments)
+            if cache is not None:
+                output = cache.get(key)
+                if output is not None:
+                    return output
+            start = time.perf_counter()
+            executor = None
+            try:
+                if policy.is_inline(function_called):
+                    if policy.max_concurrency and policy.async_slots is None:
+                        policy.async_slots = asyncio.Semaphore(policy.max_concurrency)
+                    async with policy.async_slots or contextlib.nullcontext():
+                        if inspect.iscoroutinefunction(function_called):
+                            output = await asyncio.wait_for(function_called(**arguments), timeout)
+                        else:
+                            output = call_tool(function_called, arguments)
+                else:
+                    executor = policy.get_executor(self.tool_pool)
+                    future = executor.submit(call_tool, function_called, arguments)
+                    cancel_event.add_callback(future.cancel) # 任务被取消时在取消的线程里直接撤下还在排队的调用，不等事件循环
+                    output = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                cancel_event.set()
+                self._recycle_tool_executor(policy, executor)
+                return self._tool_failed(tool_name, 'timeout', f"no result after {timeout}s")
+            except BrokenExecutor as e:
+                return self._tool_failed(tool_name, 'crashed', f"{type(e).__name__}: {e}")
+            except Exception as e:
+                return self._tool_failed(tool_name, 'exception', f"{type(e).__name__}: {e}", exc_info=True)
+            finally:
+                metrics.observe('xh_tool_seconds', time.perf_counter() - start, tool=tool_name)
+            self._store_tool_output(cache, key, output)
+            return output
+
+        async def atoolcall(self, task):
+            """
+            并发执行一批工具调用，按原始顺序写回
+            :param task: 任务实例
+            """
+            batch = self._prepare_tools(task)
+            token = task.cancel_token
+            calls = asyncio.gather(*(self._arun_tool(*call) for call in batch))
+            # 任务被取消时取消整批调用：线程池里还在排队的被取消，已经在运行的由派生的cancel_event通知
+            on_cancel = lambda: self.loop.call_soon_threadsafe(calls.cancel)
+            token.add_callback(on_cancel)
+            try:
+                outputs = await calls
+            except asyncio.CancelledError:
+                if not token.is_set():
+                    raise
+                outputs = [None] * len(batch)
+            finally:
+                token.remove_callback(on_cancel)
+            self._finish_tools(task, batch, [(tool_call, function_called, output)
+                                             for (tool_call, function_called, _, _, _, _), output in zip(batch, outputs)])
+
+        async def arun(self):
+            """
+            调度协程，被唤醒后处理状态发生变化的任务，并按优先级派发推理
+            """
+            self.async_wakeup = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+            self.async_wakeup.set() # 处理启动前已经入队的任务
+            while True:
+                try:
+                    await asyncio.wait_for(self.async_wakeup.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    with self.tasks_lock:
+                        self.pending.extend(self.tasks.values())
+                self.async_wakeup.clear()
+                self._schedule_pass()
+
+        def run(self):
+            """
+            在当前线程中运行事件循环
+            """
+            asyncio.run(self.arun())
 
     def system_init(self):
         """
@@ -362,13 +2424,96 @@ class XingHe:
         # 不知道这里要干啥，先放着
         pass
 
-    def run(self):
+    def run(self, serve_rest=True, port=5000, worker=True):
         """
         启动系统，运行服务器和调度器
+        :param serve_rest: 是否启动REST服务器，关闭时仍可在进程内通过调度器提交任务
+        :param port: REST服务器端口号
+        :param worker: 配置了task_store时是否在本进程里租取并执行作业，为False时本进程只作为前端写入作业；没有task_store时忽略
         """
-        rest_server = self.RestServer(self.meta_tasks, self.task_templates, self.tasks_list, self.meta_tasks_lock, self.tasks_list_lock)
-        self.scheduler = self.Scheduler(self.meta_tasks, self.tasks_list, self.meta_tasks_lock, self.tasks_list_lock)
-        Thread(target=rest_server.start).start()
-        Thread(target=self.scheduler.infer).start()
-        Thread(target=self.scheduler.run).start()
+        worker = worker or self.task_store is None
+        if worker and self.async_mode:
+            self.scheduler = self.AsyncScheduler(self.meta_tasks, self.tasks, self.meta_tasks_lock, self.tasks_lock, self.stream_hub,
+                                                 task_templates=self.task_templates, router=self.router,
+                                                 request_tracker=self.store_worker or self.request_tracker, status_board=self.status_board)
+        elif worker:
+            self.scheduler = self.Scheduler(self.meta_tasks, self.tasks, self.meta_tasks_lock, self.tasks_lock, self.stream_hub,
+                                            self.task_templates, self.router, self.store_worker or self.request_tracker, self.status_board)
+            for _ in range(self.router.capacity):
+                Thread(target=self.scheduler.infer).start()
+        if worker and self.task_templates.config.get("health_check_interval"):
+            Thread(target=self.router.health_loop, args=(self.task_templates.config["health_check_interval"],), daemon=True).start()
+        if serve_rest:
+            Thread(target=self.make_rest_server(port).start).start()
+        if worker:
+            Thread(target=self.scheduler.run).start()
+            if self.store_worker is not None:
+                self.store_worker.start(self.meta_tasks, self.scheduler, self.router.capacity)
         logger.info("系统运行中...")
+
+
+    def make_rest_server(self, port=5000):
+        """
+        创建REST服务器，在run()之后调用，使用本进程的调度器(只做前端时为None)
+        :param port: REST服务器端口号
+        :return: RestServer实例，app属性是Flask应用
+        """
+        return self.RestServer(self.meta_tasks, self.task_templates, self.tasks, self.meta_tasks_lock, self.tasks_lock, self.scheduler, self.stream_hub, port, self.meta_log,
+                               self.request_tracker, task_store=self.task_store, admission=self.admission,
+                               status_board=self.status_board, http=self.task_templates.config.get("http"))
+
+
+def create_app(config_path='tasks.yaml', async_mode=False):
+    """
+    WSGI应用工厂，供多进程的WSGI服务器加载，例如 gunicorn -w 4 -b 0.0.0.0:5000 "XHserver:create_app()"
+    配置了sqlite任务存储时每个服务进程只做前端，作业由 python XHserver.py --workers N --no-rest 启动的工作进程执行；
+    没有任务存储时每个服务进程各自运行调度器，会话不能共享，只能用一个进程(可以多线程)
+    :param config_path: 任务配置文件路径
+    :param async_mode: 是否使用asyncio调度器
+    :return: Flask应用
+    """
+    global log_file
+    log_file = f'server_log.http{os.getpid()}.log'
+    xinghe = XingHe(async_mode=async_mode, config_path=config_path)
+    xinghe.run(serve_rest=False, worker=False)
+    return xinghe.make_rest_server().app
+
+
+def run_worker(config_path='tasks.yaml', async_mode=False, index=0):
+    """
+    调度工作进程的入口：只从任务存储租取并执行作业，不启动REST服务器，日志写到自己的文件
+    :param config_path: 任务配置文件路径，需要配置sqlite任务存储
+    :param async_mode: 是否使用asyncio调度器
+    :param index: 工作进程序号，用于区分日志文件
+    """
+    global log_file
+    log_file = f'server_log.worker{index}.log'
+    parent = os.getppid()
+    xinghe = XingHe(async_mode=async_mode, config_path=config_path)
+    xinghe.run(serve_rest=False)
+    # 主线程退出后线程池不再接受任务，这里一直等着；父进程没了就退出，租约到期后作业由其他工作进程接手
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='启动星绘服务：REST前端和调度工作进程')
+    parser.add_argument('--config', default='tasks.yaml', help='任务配置文件路径')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='使用asyncio调度器')
+    parser.add_argument('--workers', type=int, default=0, help='另外启动的调度工作进程数，需要配置sqlite任务存储')
+    parser.add_argument('--frontend-only', action='store_true', help='本进程只运行REST前端，作业全部交给工作进程')
+    parser.add_argument('--no-rest', action='store_true', help='不启动REST服务器，前端由gunicorn等加载create_app提供')
+    args = parser.parse_args()
+    if args.frontend_only and args.no_rest:
+        parser.error('--frontend-only 和 --no-rest 不能同时使用')
+    xinghe = XingHe(async_mode=args.async_mode, config_path=args.config)
+    if (args.workers or args.frontend_only or args.no_rest) and not isinstance(xinghe.task_store, XingHe.SQLiteTaskStore):
+        parser.error('多个工作进程需要在配置中使用 task_store: {type: "sqlite"}')
+    context = multiprocessing.get_context('spawn')
+    for i in range(args.workers):
+        context.Process(target=run_worker, args=(args.config, args.async_mode, i), name=f'xinghe-worker-{i}').start()
+    xinghe.run(serve_rest=not args.no_rest, port=args.port, worker=not args.frontend_only)
+    while True:
+        time.sleep(3600)
@@ -1,12 +1,41 @@
-from openai import OpenAI
-from threading import Event
-import json, random, uuid
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError, Timeout, DefaultHttpxClient, DefaultAsyncHttpxClient
+try:
+    import httpx
+except ImportError: # 有的openai发行版改用接口相同的httpx2作为HTTP客户端
+    import httpx2 as httpx
+from threading import Thread, Event, Semaphore, BoundedSemaphore, Lock
+from queue import SimpleQueue
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from types import SimpleNamespace
+import json, random, uuid, inspect, asyncio, bisect, hashlib, sqlite3, time, os, re, math, multiprocessing, logging
+from XHmetrics import metrics
+
+logger = logging.getLogger('server_log') # 和XHserver共用，服务器配置的处理器同样生效
 
 class LLMTools:
     def __init__(self):
         self.tools = [] # 函数描述，推理时给推理节点
         self.available_functions = {} # 函数名和函数对象的映射
         self.tool_prompt = {}   # 工具调用时的提示，key是函数名，value是含有至少一个提示的列表
+        self.tool_classes = {}  # 函数名和工具类的映射，用于读取工具类上声明的超时、缓存等属性
+        self._schema = None     # 推理时发给后端的工具列表，按函数名排序、键名有序，工具变化后重建
+
+    def schema(self):
+        # 同一组工具每次序列化出完全相同的字节，后端的前缀缓存才能命中；和增删工具的先后顺序无关
+        if self._schema is None:
+            self._schema = [json.loads(json.dumps(tool, sort_keys=True, ensure_ascii=False))
+                            for tool in sorted(self.tools, key=lambda tool: tool['function']['name'])]
+        return self._schema
+
+    def copy(self):
+        # 浅拷贝出一份可以独立增删的工具集，模板的工具集被同名任务共享，修改前要先拷贝
+        llmtools = LLMTools()
+        llmtools.tools = list(self.tools)
+        llmtools.available_functions = dict(self.available_functions)
+        llmtools.tool_prompt = dict(self.tool_prompt)
+        llmtools.tool_classes = dict(self.tool_classes)
+        return llmtools
 
     def add_tools(self, tools):
         # function是函数对象，discription是函数描述，函数名在discription.name中，callprompt是调用函数时LLM被注入的记忆
@@ -14,13 +43,603 @@ class LLMTools:
             self.tools.append(tool.description)
             self.available_functions[tool.description['function']['name']] = tool.function
             self.tool_prompt[tool.description['function']['name']] = tool.prompt
+            self.tool_classes[tool.description['function']['name']] = tool
+        self._schema = None
+
+    def remove_tool(self, name: str):
+        tool = self.tool_classes.pop(name)
+        self.tools.remove(tool.description)
+        self.available_functions.pop(name)
+        self.tool_prompt.pop(name)
+        self._schema = None
+
+# 把文本切成检索用的词：英文和数字按词(去掉复数s)，中日韩文字没有分词器，按单字和相邻两字
+LEXICAL_PATTERN = re.compile(r'[a-z0-9]+|[\u2e80-\u9fff\uf900-\ufaff]+')
+def lexical_terms(text) -> list:
+    terms = []
+    for word in LEXICAL_PATTERN.findall(str(text or '').lower()):
+        if word[0] < '\u2e80':
+            terms.append(word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word)
+        else:
+            terms.extend(word)
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+# 按相关性筛选每轮发给模型的工具：对工具名、描述、参数说明、调用提示和工具类可选的keywords属性建BM25索引，
+# 取和这轮输入最相关的top_k个(只取有匹配且分数不低于最高分min_ratio倍的)，再加上always中始终发送的工具
+# 配置来自tasks.yaml中模板的tool_selection字段，例如 {'top_k': 4, 'always': ['solve_riddles']}
+class ToolSelector:
+    def __init__(self, tools: LLMTools, top_k: int = 5, always: list = None, min_ratio: float = 0.5,
+                 k1: float = 1.5, b: float = 0.75, max_subsets: int = 256):
+        self.tools = tools
+        self.top_k = top_k
+        self.min_ratio = min_ratio # 分数远低于最高分的工具大多只匹配上了常见词，不选，减少每轮工具列表的变化
+        self.always = [name for name in always or [] if name in tools.available_functions]
+        self.k1 = k1
+        self.b = b
+        self.names = list(tools.available_functions)
+        self.postings = {} # 词 -> [(工具序号, 词频)]
+        self.lengths = []
+        for index, name in enumerate(self.names):
+            counts = {}
+            for term in lexical_terms(self._document(tools.tool_classes[name])):
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((index, count))
+            self.lengths.append(sum(counts.values()))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 1.0
+        self.idf = {term: math.log(1 + (len(self.names) - len(posting) + 0.5) / (len(posting) + 0.5))
+                    for term, posting in self.postings.items()}
+        # 工具子集按名字集合缓存，同一组工具在所有会话里是同一个LLMTools，序列化结果也只算一次
+        self.subsets = OrderedDict()
+        self.max_subsets = max_subsets
+        self.lock = Lock()
+
+    @staticmethod
+    def _document(tool_class) -> str:
+        function = tool_class.description['function']
+        properties = function.get('parameters', {}).get('properties', {})
+        parts = [function['name'], function.get('description', '')]
+        parts += ['%s %s' % (key, value.get('description', '')) for key, value in properties.items()]
+        parts += list(getattr(tool_class, 'prompt', None) or [])
+        parts += list(getattr(tool_class, 'keywords', None) or [])
+        return ' '.join(parts)
+
+    def rank(self, query: str, allowed=None) -> list:
+        # 返回和query最相关的至多top_k个工具名，按分数从高到低，allowed为允许使用的工具名集合
+        scores = {}
+        for term in set(lexical_terms(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, count in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.average_length)
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        ranked = [index for index in sorted(scores, key=lambda index: (-scores[index], index))
+                  if allowed is None or self.names[index] in allowed]
+        return [self.names[index] for index in ranked[:self.top_k] if scores[index] >= scores[ranked[0]] * self.min_ratio]
+
+    def subset(self, names) -> LLMTools:
+        key = frozenset(names)
+        with self.lock:
+            llmtools = self.subsets.get(key)
+            if llmtools is None:
+                llmtools = LLMTools()
+                llmtools.add_tools([self.tools.tool_classes[name] for name in self.names if name in key])
+                self.subsets[key] = llmtools
+                while len(self.subsets) > self.max_subsets:
+                    self.subsets.popitem(last=False)
+            else:
+                self.subsets.move_to_end(key)
+            return llmtools
+
+    def select(self, query: str, allowed: LLMTools, current: LLMTools = None) -> LLMTools:
+        # 这一轮发给模型的工具子集；会话当前的子集已经包含这轮选中的工具时原样保留，工具列表不变，后端的前缀缓存继续有效
+        names = self.rank(query, allowed.available_functions)
+        if current is not None and all(name in current.available_functions for name in names):
+            return current
+        return self.subset(names + [name for name in self.always if name in allowed.available_functions])
+
+# 粗略估计一段文本的token数：中日韩字符大约1个token，其余字符大约4个1个token，另加每条消息的格式开销
+# 需要精确计数时可以把tokenizer包装成同样签名的函数传给LLMTask
+def estimate_tokens(text) -> int:
+    text = str(text or '')
+    cjk = sum(1 for char in text if char >= '\u2e80')
+    return cjk + (len(text) - cjk + 3) // 4 + 4
+
+# 工具通过spawn_subtask委托子任务时的返回值
+# 子任务的结果会在完成后经suspend写回父任务，工具本身不产生工具消息
+class SubtaskHandle:
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+
+    def __repr__(self):
+        return f'SubtaskHandle({self.uuid})'
+
+# 确定性子任务和纯函数工具的结果缓存：内存里是带TTL的LRU，可选一层sqlite磁盘缓存，重启后仍然有效
+# 配置来自tasks.yaml中模板的cache字段或工具类的cache属性，例如 {'max_entries': 1024, 'ttl': 3600, 'disk': 'cache/riddles.sqlite'}
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = None, disk: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl # 秒，为None时不过期
+        self.entries = OrderedDict() # key -> (过期时间, 值)，按最近使用排序
+        self.lock = Lock()
+        self.db = None
+        if disk:
+            if os.path.dirname(disk):
+                os.makedirs(os.path.dirname(disk), exist_ok=True)
+            self.db = sqlite3.connect(disk, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expire REAL)')
+            self.db.commit()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        # 把(模板或工具名, 系统提示词哈希, 归一化的输入或参数, 模型)等组成部分哈希成一个键
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def normalize(text) -> str:
+        # 合并空白，避免只差空格换行的输入无法命中
+        return ' '.join(str(text).split())
+
+    def get(self, key: str, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] is None or entry[0] > now:
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+            if self.db is None:
+                return default
+            row = self.db.execute('SELECT value, expire FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                return default
+            value = json.loads(row[0])
+            self._put_memory(key, value, row[1]) # 磁盘命中提升到内存
+            return value
+
+    def put(self, key: str, value):
+        expire = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self._put_memory(key, value, expire)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO cache (key, value, expire) VALUES (?, ?, ?)',
+                                (key, json.dumps(value, ensure_ascii=False, default=str), expire))
+                self.db.commit()
+
+    def _put_memory(self, key, value, expire):
+        self.entries[key] = (expire, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False) # 淘汰最久未使用的
+
+# 工具调用失败时写进tool_history的结构化错误，模型看到的是一段JSON，例如
+# {"error": "timeout", "tool": "solve_riddles", "message": "no result after 60s"}
+# kind: not_found(函数不存在)、bad_arguments(参数不是合法的JSON对象)、exception(函数抛出异常)、timeout(超时)、crashed(工作进程崩溃或被回收)
+class ToolError:
+    __slots__ = ('kind', 'tool', 'message')
+
+    def __init__(self, kind: str, tool: str, message: str):
+        self.kind = kind
+        self.tool = tool
+        self.message = message
+
+    @classmethod
+    def from_exception(cls, tool: str, error: BaseException):
+        return cls('exception', tool, f'{type(error).__name__}: {error}')
+
+    def __str__(self):
+        return json.dumps({'error': self.kind, 'tool': self.tool, 'message': self.message}, ensure_ascii=False)
+
+    def __repr__(self):
+        return f'ToolError({self.kind}, {self.tool}, {self.message!r})'
+
+# 框架注入给工具函数的参数，不是模型给出的：子任务唤起函数的uuid、创建子任务的句柄、取消信号
+INJECTED_ARGUMENTS = frozenset(('uuid', 'spawn_subtask', 'cancel_event'))
+
+# 执行一次工具函数，async定义的工具在当前线程里跑完
+# 进程池按模块名和函数名pickle调用对象，所以放在模块顶层
+def call_tool(function, arguments: dict):
+    output = function(**arguments)
+    if inspect.iscoroutine(output):
+        output = asyncio.run(output)
+    return output
+
+# 执行工具的线程池，接口和ThreadPoolExecutor相同(submit、shutdown、_max_workers)，但工作线程是守护线程：
+# 线程无法强制结束，卡住的工具调用所在的池子被换掉后，它的线程不会拖住解释器退出
+class ToolThreadPool:
+    def __init__(self, max_workers: int = None, thread_name_prefix: str = 'tool'):
+        self._max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.thread_name_prefix = thread_name_prefix
+        self.queue = SimpleQueue() # (Future, 函数, 位置参数, 关键字参数)，None让一个工作线程退出
+        self.idle = Semaphore(0) # 空闲的工作线程数，有空闲线程时提交不再新开线程
+        self.threads = []
+        self.closed = False
+        self.lock = Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self.queue.put((future, fn, args, kwargs))
+            if not self.idle.acquire(blocking=False) and len(self.threads) < self._max_workers:
+                thread = Thread(target=self._work, name=f'{self.thread_name_prefix}_{len(self.threads)}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            del item, future
+            self.idle.release()
+
+    def shutdown(self, wait: bool = True):
+        # 已经提交的调用仍会执行完，之后工作线程退出
+        with self.lock:
+            self.closed = True
+            for _ in self.threads:
+                self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+# 工具的执行策略，在工具类上用execution属性声明，例如 {'mode': 'process', 'timeout': 30, 'max_concurrency': 2, 'max_tasks_per_worker': 100}
+# inline: 在发起工具调用的地方直接执行，适合很快的纯函数，省去线程切换，但超时无法打断
+# thread: 在线程池里执行，没有声明并发上限和回收次数时使用调度器共享的线程池；线程无法强制结束，超时后换掉调用所在的线程池(包括共享的)，卡住的线程不再占用并发名额
+# process: 在独立的进程池里执行，不和调度器抢GIL，超时时终止工作进程；函数、参数和结果都要能pickle，不能使用框架注入的句柄
+#          工作进程用spawn启动，会重新导入主模块，启动较慢：加载工具时就预先启动，max_tasks_per_worker不宜设得太小
+# mode未声明时同步函数用thread，async函数在asyncio调度器里直接await、在线程调度器里按thread执行
+class ToolPolicy:
+    MODES = ('inline', 'thread', 'process')
+
+    def __init__(self, name: str, mode: str = None, timeout: float = None, max_concurrency: int = None, max_tasks_per_worker: int = None):
+        if mode is not None and mode not in self.MODES:
+            raise ValueError(f'工具 {name} 的执行方式 {mode} 不存在，可选 {self.MODES}')
+        self.name = name
+        self.mode = mode
+        self.timeout = timeout # 秒，为None时使用调度器的默认超时
+        self.max_concurrency = max_concurrency # 同时执行的调用数上限
+        self.max_tasks_per_worker = max_tasks_per_worker # 平均每个工作者执行这么多次调用后整个池子换新的
+        self.slots = BoundedSemaphore(max_concurrency) if max_concurrency and mode == 'inline' else None
+        self.async_slots = None # asyncio调度器里inline执行时的并发上限，在事件循环里按需创建
+        self.executor = None
+        self.standby = None # 进程池按次数回收时预热中的替换池子，(执行器, 预热调用)
+        self.calls = 0 # 当前执行器已经接收的调用数
+        self.lock = Lock()
+
+    @classmethod
+    def from_tool(cls, tool_class):
+        # 读取工具类的execution属性，兼容单独声明的timeout属性
+        name = tool_class.description['function']['name']
+        execution = dict(getattr(tool_class, 'execution', None) or {})
+        execution.setdefault('timeout', getattr(tool_class, 'timeout', None))
+        if execution.get('mode') == 'process':
+            injected = INJECTED_ARGUMENTS & set(inspect.signature(tool_class.function).parameters)
+            if injected:
+                raise ValueError(f'工具 {name} 使用了框架注入的参数 {sorted(injected)}，不能在进程池中执行')
+        return cls(name, **execution)
+
+    def is_inline(self, function) -> bool:
+        # asyncio调度器里是否直接在事件循环上执行
+        return self.mode == 'inline' or (self.mode is None and inspect.iscoroutinefunction(function))
+
+    @property
+    def shares_pool(self) -> bool:
+        # thread模式没有声明并发上限和回收次数时使用调度器的共享线程池
+        return self.mode != 'process' and not self.max_concurrency and not self.max_tasks_per_worker
+
+    def get_executor(self, shared=None):
+        # 本次调用使用的执行器，shared是调度器共享线程池的策略，使用共享线程池时从它取
+        if self.shares_pool:
+            return shared.get_executor() if shared is not None else None
+        with self.lock:
+            if self.executor is not None and self.max_tasks_per_worker and self.calls >= self.max_tasks_per_worker * self.executor._max_workers:
+                if self.mode != 'process':
+                    self.executor.shutdown(wait=False) # 旧线程执行完手头的调用后退出
+                    self.executor = None
+                elif self.standby is None:
+                    self.standby = self._new_executor() # 进程池先在后台预热替换的池子，预热完成前继续用旧的
+                elif all(future.done() for future in self.standby[1]):
+                    self.executor.shutdown(wait=False)
+                    self.executor, self.standby = self.standby[0], None
+                    self.calls = 0
+            if self.executor is None:
+                self.executor = self._new_executor()[0]
+                self.calls = 0
+            self.calls += 1
+            return self.executor
+
+    def start(self):
+        # 预先启动进程池，工作进程的启动时间不计入第一次调用的超时
+        if self.mode == 'process':
+            with self.lock:
+                if self.executor is None:
+                    self.executor = self._new_executor()[0]
+
+    def _new_executor(self):
+        # 返回(执行器, 预热中的调用)
+        if self.mode == 'process':
+            # 服务器进程里线程很多，fork出的子进程可能继承被占住的锁，所以用spawn
+            # 不用max_tasks_per_child：3.11里工作进程按次数退出后，进程池可能不再补充新进程
+            executor = ProcessPoolExecutor(max_workers=self.max_concurrency or 1, mp_context=multiprocessing.get_context('spawn'))
+            # 每次提交启动一个工作进程，让它们现在就开始导入
+            return executor, [executor.submit(os.getpid) for _ in range(executor._max_workers)]
+        return ToolThreadPool(max_workers=self.max_concurrency, thread_name_prefix=f'tool-{self.name}'), []
+
+    def recycle(self, executor, replace=True):
+        # 有调用超时，换一个新的执行器：进程池终止旧的工作进程，同池中其他进行中的调用以crashed结束，并立即换上新的进程池；
+        # 线程无法强制结束，只能放弃旧线程池，新线程池在下次调用时创建
+        with self.lock:
+            if executor is None or self.executor is not executor:
+                return
+            self.executor = None
+            if replace and self.mode == 'process':
+                self.executor = (self.standby or self._new_executor())[0]
+                self.standby = None
+            self.calls = 0
+        if self.mode == 'process':
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False)
+
+    def close(self):
+        self.recycle(self.executor, replace=False)
+        if self.standby is not None:
+            self.standby[0].shutdown(wait=False)
+            self.standby = None
+
+# 角色以小整数存在消息里，大量空闲会话时比每条消息一个字典省得多
+ROLES = ('system', 'user', 'assistant', 'tool')
+ROLE_IDS = {role: index for index, role in enumerate(ROLES)}
+
+# 记忆中的一条消息，只保存必要字段；仍可以按msg['role']、msg['content']读取
+class Message:
+    __slots__ = ('role_id', 'content', 'name', 'tool_call_id')
+
+    def __init__(self, role: str, content, name=None, tool_call_id=None):
+        self.role_id = ROLE_IDS[role]
+        self.content = content
+        self.name = name
+        self.tool_call_id = tool_call_id
+
+    @property
+    def role(self):
+        return ROLES[self.role_id]
+
+    def __getitem__(self, key):
+        if key not in ('role', 'content', 'name', 'tool_call_id'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        value = self[key]
+        return default if value is None else value
+
+    def __repr__(self):
+        return f'Message({ROLES[self.role_id]!r}, {self.content!r})'
+
+    def as_context(self) -> dict:
+        # 发给推理后端的格式
+        return {'role': ROLES[self.role_id], 'content': self.content}
+
+    def to_dict(self) -> dict:
+        # 持久化用的完整格式，省略空字段
+        data = {'role': ROLES[self.role_id], 'content': self.content}
+        if self.name is not None:
+            data['name'] = self.name
+        if self.tool_call_id is not None:
+            data['tool_call_id'] = self.tool_call_id
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['role'], data['content'], data.get('name'), data.get('tool_call_id'))
+
+
+# 推理结果中任务真正用到的部分：回复文本和工具调用，不保留完整的response对象
+# tool_call.function返回自身，读取方式和openai的工具调用对象一致：tool_call.id、tool_call.function.name/arguments
+class ToolCall:
+    __slots__ = ('id', 'name', 'arguments')
+
+    def __init__(self, id, name: str, arguments: str):
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+
+    @property
+    def function(self):
+        return self
+
+
+class Reply:
+    __slots__ = ('content', 'tool_calls')
+
+    def __init__(self, content, tool_calls=None):
+        self.content = content
+        self.tool_calls = tool_calls
+
+    @classmethod
+    def from_response(cls, response):
+        message = response.choices[0].message
+        tool_calls = [ToolCall(tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                      for tool_call in message.tool_calls] if message.tool_calls else None
+        return cls(message.content, tool_calls)
+
+
+# 只当标志位用的事件(running、suspend)，没有人等待它们，不需要Event里的条件变量和锁
+class Flag:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = False
+
+    def set(self):
+        self.value = True
+
+    def clear(self):
+        self.value = False
+
+    def is_set(self):
+        return self.value
+
+
+# 可等待的事件，只有真的有人wait时才创建Event
+class LazyEvent:
+    __slots__ = ('value', 'event')
+    creation_lock = Lock()
+
+    def __init__(self):
+        self.value = False
+        self.event = None
+
+    def set(self):
+        self.value = True
+        if self.event is not None:
+            self.event.set()
+
+    def clear(self):
+        self.value = False
+        if self.event is not None:
+            self.event.clear()
+
+    def is_set(self):
+        return self.value
+
+    def wait(self, timeout=None):
+        if self.value:
+            return True
+        with LazyEvent.creation_lock:
+            if self.event is None:
+                self.event = Event()
+                if self.value: # 创建前刚被set
+                    self.event.set()
+        return self.event.wait(timeout)
+
+
+# 协作式取消令牌：子任务和工具调用的令牌由父任务的令牌派生，取消时连同派生的整棵子树一起取消，
+# 并调用登记的回调中止在途的推理和工具。接口和Event相同(set/is_set/wait)，可以直接作为cancel_event注入给工具
+class CancelToken:
+    __slots__ = ('cancelled', 'parent', 'children', 'callbacks', 'event')
+    lock = Lock() # 所有令牌共用一把锁，令牌很多但取消很少发生
+
+    def __init__(self, parent=None):
+        self.cancelled = False
+        self.parent = parent
+        self.children = None
+        self.callbacks = None
+        self.event = None
+        if parent is not None:
+            with CancelToken.lock:
+                if parent.cancelled:
+                    self.cancelled = True
+                else:
+                    if parent.children is None:
+                        parent.children = set()
+                    parent.children.add(self)
+
+    def child(self):
+        return CancelToken(self)
+
+    def add_callback(self, callback):
+        # 取消时调用callback()，已经取消时立即调用；回调可能在任意线程执行，不能阻塞
+        with CancelToken.lock:
+            if not self.cancelled:
+                if self.callbacks is None:
+                    self.callbacks = []
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with CancelToken.lock:
+            if self.callbacks and callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def detach(self):
+        # 工作结束后从父令牌上摘下，父令牌不再引用它
+        with CancelToken.lock:
+            if self.parent is not None and self.parent.children:
+                self.parent.children.discard(self)
+            self.parent = None
+
+    def set(self):
+        # 取消这个令牌和它派生的所有令牌；先在锁外执行回调(例如取消还在排队的调用)，再唤醒wait的人，
+        # 这样正在运行的工具醒来退出时，同一批排队的调用已经被取消，不会接着被执行
+        callbacks, events = [], []
+        with CancelToken.lock:
+            stack = [self]
+            while stack:
+                token = stack.pop()
+                if token.cancelled:
+                    continue
+                token.cancelled = True
+                if token.event is not None:
+                    events.append(token.event)
+                callbacks.extend(token.callbacks or ())
+                stack.extend(token.children or ())
+                token.callbacks = token.children = None
+        for callback in callbacks:
+            callback()
+        for event in events:
+            event.set()
+
+    cancel = set
+
+    def is_set(self):
+        return self.cancelled
+
+    def wait(self, timeout=None):
+        with CancelToken.lock:
+            if self.cancelled:
+                return True
+            if self.event is None:
+                self.event = Event()
+        return self.event.wait(timeout)
+
+
+# 任务的启停信号，按task.events['running']的方式读取
+class TaskEvents:
+    __slots__ = ('running', 'suspend', 'end')
+
+    def __init__(self):
+        self.running = Flag()
+        self.suspend = Flag()
+        self.end = LazyEvent()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
 
 # 这一版task类不再含有推理器，只是用于管理记忆返回记忆
 # 其内部的response是由推理器返回的，正确运行取决于外部调用的正确性
 class LLMTask:
     STATUS = ['Free', 'ReUser', 'ToolCall', 'ReTool', 'Ready']
+    # default: 一轮结束或被打断时丢弃工具历史，窗口随预算逐条滑动
+    # prefix_stable: 发给模型的上下文只在末尾追加，工具历史并入对话，窗口超预算时整段前移，便于后端复用前缀的KV缓存
+    CONTEXT_MODES = ['default', 'prefix_stable']
+    # 空闲会话可能有成千上万个，不给实例分配__dict__
+    __slots__ = ('info', 'events', 'context_ctrl', 'context_budget', 'token_estimator', 'context_cache', 'context_mode',
+                 'tools_ctrl', 'tool_selector', 'status', 'status_since', 'notify', 'journal', 'cancel_token')
     # 使用控制反转(IoC)设计模式
-    def __init__(self, task_name:str, priority:int, sysprompt:str, tools: LLMTools):
+    def __init__(self, task_name:str, priority:int, sysprompt:str, tools: LLMTools,
+                 context_budget: int = None, token_estimator = estimate_tokens, context_mode: str = 'default',
+                 tool_selector: ToolSelector = None):
+        if context_mode not in self.CONTEXT_MODES:
+            raise ValueError('Unknown context mode: %s' % context_mode)
         # 任务自带的标签信息
         self.info = {
             'task_name': task_name,
@@ -28,35 +647,58 @@ class LLMTask:
             'uuid': str(uuid.uuid4()).replace('-', ''), # 生成任务的唯一标识
             'child_uuid': None,
             'parent_uuid': None,
-            'suspended_toolname': None
+            'suspended_toolname': None,
+            'session_id': None, # 元任务所属的会话，由会话表设置
+            'request_id': None, # 当前这轮输入对应的REST请求，回复写入请求结果表
+            'error': None, # 这一轮因推理失败而结束时的错误信息，回复即是它
+            'infer_failures': 0 # 这一轮连续失败的推理次数
         }
         
-        # 调度启停信号量
-        self.events = {
-            #'start': Event(),
-            'running': Event(),
-            'suspend': Event(),
-            'end': Event()
-        }
+        # 调度启停信号量，running和suspend只是标志位，end在有人等待时才创建Event
+        self.events = TaskEvents()
 
         # 记忆结构
         self.context_ctrl = {
-            'system_memory': [{'role': 'system', 'content': sysprompt}],
+            'system_memory': [Message('system', sysprompt)],
             'user_history': [],
             'tool_history': [],
             'input': None,
-            'response': None
+            'response': None, # 最近一次推理的Reply，只保留回复文本和工具调用
+            'summary': None # 被压缩掉的较早对话的滚动摘要
+        }
+
+        # 上下文预算(token)，为None时不限制；超出预算的较早对话不再发给模型，等待被压缩进摘要
+        self.context_budget = context_budget
+        self.token_estimator = token_estimator
+        self.context_mode = context_mode
+        # 已格式化的user_history缓存，只对新追加的消息做格式化和token估计
+        self.context_cache = {
+            'history': None, # 缓存对应的user_history列表对象，被整体替换时重建缓存
+            'messages': None, # 格式化好的消息，只在一轮对话进行中保留
+            'cumulative': [0], # token数的前缀和，cumulative[i]为前i条消息的token总数
+            'start': 0 # prefix_stable模式下固定的窗口起点
         }
 
         # 工具调用
         self.tools_ctrl = {
-            'llmtools': tools,
-            'tools_filtered': tools,
+            'llmtools': tools, # 模板的完整工具集
+            'tools_filtered': tools, # 允许使用的工具，由tool_permission增删
+            'tools_selected': None, # 开启工具筛选时发给模型的子集，每轮输入时更新
             'toolcall_queue': [] # 等待调用的工具的队列
         }
+        # 按输入筛选工具的索引，模板配置了tool_selection时由模板注入，为None时每轮发送全部允许的工具
+        self.tool_selector = tool_selector
 
         # 状态机
         self.status = 'Free'
+        self.status_since = time.perf_counter() # 进入当前状态的时间，用于统计各状态停留时长
+
+        # 调度器唤醒回调，任务被加入调度器时注入，状态变化时调用以立即唤醒调度
+        self.notify = None
+        # 记忆变更回调，元任务由持久化日志注入，每次追加、清空和压缩对话都会调用journal(task, op, fields)
+        self.journal = None
+        # 取消令牌，任务被加入调度器时创建，子任务的令牌由父任务的令牌派生
+        self.cancel_token = None
 
     # 挂起/恢复任务，传入子任务的uuid来判断，谁挂起谁释放
     # tool_name是挂起任务的工具名，用于恢复时调用, 和子任务名字一样
@@ -71,52 +713,172 @@ class LLMTask:
             else:
                 # 构造工具回复message
                 print('ChildTask output:', result)
-                self.context_ctrl['tool_history'].append({'role': 'tool',
-                                        'content': str(result),
-                                        'name': self.info['suspended_toolname']})
+                self._append_history('tool_history', Message('tool', str(result), name=self.info['suspended_toolname']))
                 self.events['suspend'].clear()
                 self.info['child_uuid'] = None
                 self.info['suspended_toolname'] = None # 恢复后清空挂起工具名
         elif not status and interrupt: # 中断任务，中断模板是写死的，后期改为宏定义
             print('Interrupt with input, 添加%s', "(打断了你的思考):"+str(result))
-            self.context_ctrl['user_history'].append({'role': 'user',
-                                                    'content': "(打断了你的思考):"+str(result)})
-            self.context_ctrl['tool_history'] = [] # 中断后清空工具历史
+            self._settle_tool_history() # 中断后清空工具历史
+            self._append_history('user_history', Message('user', "(打断了你的思考):"+str(result)))
+            self._select_tools(result)
             self.status_update('ReUser') # 被输入打断，回到ReUser状态。
             self.events['suspend'].clear()
             self.info['child_uuid'] = None
             self.info['suspended_toolname'] = None # 恢复后清空挂起工具名
+        self._notify()
+
+    def _notify(self):
+        # 通知调度器本任务可能需要处理
+        if self.notify:
+            self.notify(self)
+
+    def _append_history(self, key: str, msg: Message):
+        # 所有对话追加都走这里，保证持久化日志和记忆一致
+        self.context_ctrl[key].append(msg)
+        if self.journal:
+            self.journal(self, 'append', {'key': key, 'msg': msg.to_dict()})
+
+    def _clear_tool_history(self):
+        self.context_ctrl['tool_history'] = []
+        if self.journal:
+            self.journal(self, 'reset', {'key': 'tool_history'})
+
+    def _settle_tool_history(self):
+        # 一轮工具调用结束，prefix_stable模式下把工具历史按原顺序并入对话，模型上次看到的上下文仍是下次的前缀
+        if self.context_mode == 'prefix_stable':
+            for msg in self.context_ctrl['tool_history']:
+                self._append_history('user_history', msg)
+        self._clear_tool_history()
+
+    def dump_state(self) -> dict:
+        # load_state的逆操作，导出可以JSON序列化的对话记忆
+        return {'user_history': [msg.to_dict() for msg in self.context_ctrl['user_history']],
+                'tool_history': [msg.to_dict() for msg in self.context_ctrl['tool_history']],
+                'summary': self.context_ctrl['summary']}
+
+    def load_state(self, state: dict):
+        # 从持久化日志恢复对话记忆，state为{'user_history', 'tool_history', 'summary'}，消息是to_dict的格式
+        self.context_ctrl['user_history'] = [Message.from_dict(msg) for msg in state['user_history']]
+        self.context_ctrl['tool_history'] = [Message.from_dict(msg) for msg in state['tool_history']]
+        self.context_ctrl['summary'] = state['summary']
     
-    # 这是一个未经测试的功能,用于在运行时动态增删llm看到的工具
-    # 使用这个功能请将其他函数中对llmtools的操作改为对tools_filtered的操作
-    # llmtools是原始的工具列表(读取进来的备份)，tools_filtered是经过过滤的工具列表
+    # 在运行时增删模型可以使用的工具，llmtools是模板的完整工具集，tools_filtered是允许使用的工具
+    # 发给模型的工具列表和工具调用都以tools_filtered为准，被禁用的工具即使模型调用了也不会执行
     def tool_permission(self, tool_name: str, is_allowed:bool):
-        if (is_allowed and 
-            tool_name in self.tools_ctrl['llmtools'].available_functions.keys() and
-            tool_name not in self.tools_ctrl['tools_filtered'].available_functions.keys()):
-            self.tools_ctrl['tools_filtered'].add_tools([(tool_name,
-                                            self.tools_ctrl['llmtools'].available_functions[tool_name],
-                                            self.tools_ctrl['llmtools'].tool_prompt[tool_name])])
-        elif (not is_allowed and
-            tool_name in self.tools_ctrl['tools_filtered'].available_functions.keys()):
-            self.tools_ctrl['tools_filtered'].available_functions.pop(tool_name)
-            self.tools_ctrl['tools_filtered'].tools.remove(self.tools_ctrl['llmtools'].available_functions[tool_name])
-            self.tools_ctrl['tools_filtered'].tool_prompt.pop(tool_name)
+        llmtools, filtered = self.tools_ctrl['llmtools'], self.tools_ctrl['tools_filtered']
+        if is_allowed == (tool_name in filtered.available_functions) or tool_name not in llmtools.available_functions:
+            return
+        if filtered is llmtools:
+            # 工具集由同一模板的任务共享，写时拷贝
+            filtered = self.tools_ctrl['tools_filtered'] = llmtools.copy()
+        if is_allowed:
+            filtered.add_tools([llmtools.tool_classes[tool_name]])
+            return # 新允许的工具从下一轮输入起参与筛选
+        filtered.remove_tool(tool_name)
+        selected = self.tools_ctrl['tools_selected']
+        if selected is not None and tool_name in selected.available_functions:
+            self.tools_ctrl['tools_selected'] = self.tool_selector.subset(
+                [name for name in selected.available_functions if name != tool_name])
+
+    def tool_schema(self):
+        # 发给模型的工具列表：开启筛选时是这一轮选中的子集，否则是允许使用的全部工具
+        selected = self.tools_ctrl['tools_selected']
+        return (selected if selected is not None else self.tools_ctrl['tools_filtered']).schema()
+
+    def _select_tools(self, query):
+        # 每轮新输入时按输入重新筛选工具，会话当前的子集已经够用时保持不变
+        if self.tool_selector is not None:
+            self.tools_ctrl['tools_selected'] = self.tool_selector.select(query, self.tools_ctrl['tools_filtered'],
+                                                                          self.tools_ctrl['tools_selected'])
 
     # -----------------交互START-----------------
     def set_input(self, user_input:str):
         self.context_ctrl['input'] = user_input
 
+    def set_response(self, response):
+        # 由推理器的调用方写入推理结果，只保留回复文本和工具调用
+        self.context_ctrl['response'] = Reply.from_response(response)
+
+    def _sync_context_cache(self):
+        # 为user_history新追加的消息累加token数，列表被替换或截短时重建
+        history = self.context_ctrl['user_history']
+        cache = self.context_cache
+        if cache['history'] is not history or len(history) < len(cache['cumulative']) - 1:
+            cache['history'] = history
+            cache['messages'] = None
+            cache['cumulative'] = [0]
+            cache['start'] = 0
+        for msg in history[len(cache['cumulative']) - 1:]:
+            cache['cumulative'].append(cache['cumulative'][-1] + self.token_estimator(msg.content))
+        return cache
+
+    def _context_parts(self):
+        # 返回(摘要消息列表, 工具消息列表, 对话窗口起点)，窗口之前的对话超出了预算
+        cache = self._sync_context_cache()
+        summary = []
+        if self.context_ctrl.get('summary'):
+            summary = [{'role': 'system', 'content': '较早对话的摘要：' + self.context_ctrl['summary']}]
+        tools = [msg.as_context() for msg in self.context_ctrl['tool_history']]
+        start = 0
+        if self.context_budget is not None:
+            fixed = sum(self.token_estimator(msg['content']) for msg in self.context_ctrl['system_memory'] + summary + tools)
+            total = cache['cumulative'][-1]
+            # 找到最小的start使得 窗口内token数 = total - cumulative[start] 不超过剩余预算，至少保留最后一条
+            start = bisect.bisect_left(cache['cumulative'], total - (self.context_budget - fixed))
+            start = max(0, min(start, len(cache['cumulative']) - 2))
+            if self.context_mode == 'prefix_stable':
+                # 固定的起点装不下时一次前移到只占一半剩余预算的位置，之后若干轮都只在末尾追加
+                if start > cache['start']:
+                    half = bisect.bisect_left(cache['cumulative'], total - (self.context_budget - fixed) // 2)
+                    cache['start'] = max(start, min(half, len(cache['cumulative']) - 2))
+                start = cache['start']
+        return summary, tools, start
+
     def get_context(self):
-        context = self.context_ctrl['system_memory'] + self.context_ctrl['user_history'] + self.context_ctrl['tool_history']
-        formatted_context = [{'role': msg['role'], 'content': msg['content']} for msg in context if isinstance(msg, dict)]
-        return formatted_context
-    
+        summary, tools, start = self._context_parts()
+        # 格式化好的对话只在一轮对话进行中缓存，回到Free时释放，空闲会话只保留Message本身
+        cache = self.context_cache
+        history = cache['history']
+        if cache['messages'] is None:
+            cache['messages'] = []
+        for msg in history[len(cache['messages']):]:
+            cache['messages'].append(msg.as_context())
+        system = [msg.as_context() for msg in self.context_ctrl['system_memory']]
+        return system + summary + cache['messages'][start:] + tools
+
+    def history_overflow(self):
+        # 超出上下文预算、不再发给模型的较早对话条数
+        return self._context_parts()[2]
+
+    def compact_history(self, history: list, count: int, summary: str):
+        # 用摘要替换user_history最前面的count条对话，history是发起压缩时的user_history，被整体替换过就放弃
+        if self.context_ctrl['user_history'] is not history or len(history) < count:
+            return False
+        del history[:count]
+        self.context_cache['history'] = None # 原地删除了前面的消息，缓存整体作废
+        self.context_ctrl['summary'] = summary
+        if self.journal:
+            self.journal(self, 'compact', {'count': count, 'summary': summary})
+        return True
+
+    def fail(self, message: str):
+        # 推理无法完成时以错误信息结束这一轮：丢弃未执行的工具调用，错误不写进对话历史，进入Ready后按正常流程回复
+        self._settle_tool_history()
+        self.tools_ctrl['toolcall_queue'] = []
+        self.context_ctrl['response'] = Reply(message)
+        self.info['error'] = message
+        self.status_update('Ready')
+
     def get_reply(self):
         # 由外部调用，用于获取回复
         if self.status == 'Ready':
             self.status_update('Free')
-            return self.context_ctrl['response'].choices[0].message.content
+            reply = self.context_ctrl['response'].content
+            # 一轮对话结束，释放推理结果和格式化缓存
+            self.context_ctrl['response'] = None
+            self.context_cache['messages'] = None
+            return reply
         else:
             return 'No reply yet'
     # -----------------交互END-----------------
@@ -124,70 +886,117 @@ class LLMTask:
     # -----------------状态机START-----------------
     def status_update(self, new_status):
         if new_status in self.STATUS: # 状态只能是预定义的状态
+            changed = new_status != self.status
+            if changed:
+                now = time.perf_counter()
+                metrics.observe('xh_task_state_seconds', now - self.status_since, task=self.info['task_name'], state=self.status)
+                metrics.trace('state', task=self.info['task_name'], uuid=self.info['uuid'], state=self.status, next=new_status,
+                              seconds=now - self.status_since)
+                self.status_since = now
             self.status = new_status
+            if changed:
+                self._notify()
 
     def action_free(self):
         if self.context_ctrl['input']:
-            self.context_ctrl['user_history'].append({'role': 'user',
-                                    'content': self.context_ctrl['input']})
+            self._append_history('user_history', Message('user', self.context_ctrl['input']))
+            self._select_tools(self.context_ctrl['input'])
             print('收到input:', self.context_ctrl['input'])
             self.context_ctrl['input'] = None
             self.status_update('ReUser')
 
     def action_reuser(self):
-        if self.context_ctrl['response'].choices[0].message.tool_calls:
+        if self.context_ctrl['response'].tool_calls:
                 # 如果有函数调用，将所有函数调用加入队列
-                for tool_call in self.context_ctrl['response'].choices[0].message.tool_calls:
-                    # 这里的function是OpenAI定义的一个字典，包含了由LLM响应的函数的名字和参数
-                    self.tools_ctrl['toolcall_queue'].append(tool_call.function)
+                for tool_call in self.context_ctrl['response'].tool_calls:
+                    # tool_call.function包含了由LLM响应的函数的名字和参数，tool_call.id用于对应工具结果
+                    self.tools_ctrl['toolcall_queue'].append(tool_call)
                 self.status_update('ToolCall')
         else:
-            self.context_ctrl['user_history'].append({'role': 'assistant',
-                                    'content': self.context_ctrl['response'].choices[0].message.content})
+            self._append_history('user_history', Message('assistant', self.context_ctrl['response'].content))
             self.status_update('Ready')
 
-    def action_toolcall(self):
-        tool = self.tools_ctrl['toolcall_queue'].pop(0)
-        function_called = self.tools_ctrl['llmtools'].available_functions.get(tool.name) # tool在这是一个字典，推理节点的响应
-        if function_called: # 如果函数在可用函数里面就不是None，这里function_called是一个函数对象
-            self.context_ctrl['tool_history'].append({'role': 'assistant',
-                                    'content': random.choice(self.tools_ctrl['llmtools'].tool_prompt[tool.name])})
-            print('Calling function:', tool.name, 'Arguments:', tool.arguments)
-
-            arguments = json.loads(tool.arguments)
-            
-            # 匹配输入tool.name和self.tools_ctrl.llmtools全部可用工具中哪一个名字name相同，并返回匹配到的工具类
-            find_tool = next((find_tool for find_tool in self.tools_ctrl['llmtools'].tools if find_tool['function']['name'] == tool.name), None)
-            print('Find tool:', find_tool)
-            if find_tool and not find_tool['is_meta']:
-                # 如果是子任务唤起函数，需要传递自己的uuid
-                output = function_called(**arguments, uuid=self.info['uuid'])
-            else:
-                output = function_called(**arguments)
-            print('Function output:', output)
+    def _is_subtask_tool(self, tool_name):
+        # 子任务唤起函数在描述里标记为is_meta: False，会挂起当前任务
+        find_tool = next((find_tool for find_tool in self.tools_ctrl['tools_filtered'].tools if find_tool['function']['name'] == tool_name), None)
+        return bool(find_tool) and not find_tool['is_meta']
 
-            # 构造工具回复message
-            self.context_ctrl['tool_history'].append({'role': 'tool',
-                                    'content': str(output),
-                                    'name': tool.name})
-        else:
-            print('Function', tool.name, 'NotFound')
-            self.context_ctrl['tool_history'].append({'role': 'tool',
-                                    'content': "Function not found"})
+    def prepare_toolcall(self, inject: dict = None):
+        # 弹出队首的工具调用并注入调用提示，返回(工具调用, 函数对象, 参数字典)，函数不存在时函数对象为None
+        # 模型给出的参数不是合法的JSON对象(如输出被截断)时函数对象为None，参数位置是bad_arguments的ToolError，不执行函数
+        # inject是框架提供的句柄(如spawn_subtask)，只传给声明了同名参数的函数
+        tool_call = self.tools_ctrl['toolcall_queue'].pop(0)
+        tool = tool_call.function
+        function_called = self.tools_ctrl['tools_filtered'].available_functions.get(tool.name)
+        if not function_called:
+            return tool_call, None, None
+        try:
+            arguments = json.loads(tool.arguments or '{}') # 没有参数的函数有的后端给空字符串
+        except json.JSONDecodeError as e:
+            return tool_call, None, ToolError('bad_arguments', tool.name, f'arguments are not valid JSON: {e}')
+        if not isinstance(arguments, dict):
+            return tool_call, None, ToolError('bad_arguments', tool.name, f'arguments must be a JSON object, got {type(arguments).__name__}')
+        # 如果函数在可用函数里面就不是None，这里function_called是一个函数对象
+        self._append_history('tool_history', Message('assistant', self._tool_prompt(tool)))
+        print('Calling function:', tool.name, 'Arguments:', tool.arguments)
+
+        if self._is_subtask_tool(tool.name):
+            # 如果是子任务唤起函数，需要传递自己的uuid
+            arguments['uuid'] = self.info['uuid']
+        parameters = inspect.signature(function_called).parameters
+        arguments.update({key: value for key, value in (inject or {}).items() if key in parameters})
+        return tool_call, function_called, arguments
+
+    def _tool_prompt(self, tool):
+        # 按工具名和参数的哈希挑选调用提示，同样的调用总是得到同一句，重放和重试时上下文逐字节一致
+        prompts = self.tools_ctrl['tools_filtered'].tool_prompt[tool.name]
+        digest = hashlib.sha256((tool.name + '\0' + str(tool.arguments)).encode('utf-8')).digest()
+        return prompts[int.from_bytes(digest[:4], 'big') % len(prompts)]
+
+    def prepare_toolcalls(self, inject: dict = None):
+        # 取出一批可以并发执行的工具调用：队首连续的普通工具一起取出；
+        # 子任务唤起函数会挂起任务，只能单独执行，排在队首时只取它一个
+        batch = []
+        queue = self.tools_ctrl['toolcall_queue']
+        while queue:
+            is_subtask = self._is_subtask_tool(queue[0].function.name)
+            if is_subtask and batch:
+                break
+            batch.append(self.prepare_toolcall(inject))
+            if is_subtask:
+                break
+        return batch
+
+    def finish_toolcalls(self, results: list):
+        # 按原始顺序记录一批工具的输出，results中每项为(工具调用, 函数对象, 输出)，队列清空后进入ReTool
+        # 没有执行的调用函数对象为None，输出是ToolError时写入它，否则记为函数不存在
+        for tool_call, function_called, output in results:
+            tool_name = tool_call.function.name
+            if isinstance(output, SubtaskHandle):
+                # 结果由子任务完成时写回，这里不再追加工具消息
+                logger.debug(f"工具 {tool_name} 已交给子任务 {output.uuid}")
+            elif function_called or isinstance(output, ToolError):
+                print('Function output:', output)
+                # 构造工具回复message
+                self._append_history('tool_history', Message('tool', str(output), name=tool_name, tool_call_id=tool_call.id))
+            else:
+                print('Function', tool_name, 'NotFound')
+                self._append_history('tool_history', Message('tool', str(ToolError('not_found', tool_name, 'Function not found')),
+                                                             name=tool_name, tool_call_id=tool_call.id))
         if len(self.tools_ctrl['toolcall_queue']) == 0:
             self.status_update('ReTool')
 
     def action_retool(self):
-        if self.context_ctrl['response'].choices[0].message.tool_calls:
+        if self.context_ctrl['response'].tool_calls:
             # 如果有函数调用，将所有函数调用加入队列
-            for tool_call in self.context_ctrl['response'].choices[0].message.tool_calls:
-                # 这里的function是OpenAI定义的一个字典，包含了由LLM响应的函数的名字和参数
-                self.tools_ctrl['toolcall_queue'].append(tool_call.function)
+            for tool_call in self.context_ctrl['response'].tool_calls:
+                # tool_call.function包含了由LLM响应的函数的名字和参数，tool_call.id用于对应工具结果
+                self.tools_ctrl['toolcall_queue'].append(tool_call)
+            self.status_update('ToolCall')
         else:
-            # 如果没有进一步的函数调用，先更新记忆记录对函数的响应，再清空函数历史以准备以后的新函数调用
-            self.context_ctrl['user_history'].append({'role': 'assistant',
-                                    'content': self.context_ctrl['response'].choices[0].message.content})
-            self.context_ctrl['tool_history'] = []
+            # 如果没有进一步的函数调用，先结算函数历史(prefix_stable下并入对话)以准备以后的新函数调用，再记录对函数的响应
+            self._settle_tool_history()
+            self._append_history('user_history', Message('assistant', self.context_ctrl['response'].content))
             self.status_update('Ready')
 
     def forward(self):
@@ -199,21 +1008,491 @@ class LLMTask:
         elif self.status == 'ReTool':
             self.action_retool()
         # Ready状态是外部调用的标志，在由外部发起的get_reply里面转移到Free
-        return self.get_context() #这个返回不接受也行，只是为了方便调试
+        return self.status #这个返回不接受也行，只是为了方便调试
     # -----------------状态机END-----------------
 
 
+# 流式输出的拼装器，把增量块拼成和非流式response相同结构的对象，LLMTask的状态机因此不需要区分两种模式
+class StreamAssembler:
+    def __init__(self, on_token=None):
+        self.on_token = on_token # 每收到一段文本增量就回调一次
+        self.content = []
+        self.tool_calls = {} # 增量里的index -> 正在拼装的工具调用
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        if getattr(chunk, 'usage', None):
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        delta = choice.delta
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        if delta.content:
+            self.content.append(delta.content)
+            if self.on_token:
+                self.on_token(delta.content)
+        # 工具调用的名字和参数会被拆成多段，按index拼接
+        for tool_delta in delta.tool_calls or []:
+            tool_call = self.tool_calls.setdefault(tool_delta.index, SimpleNamespace(
+                id=None, type='function', function=SimpleNamespace(name='', arguments='')))
+            if tool_delta.id:
+                tool_call.id = tool_delta.id
+            if tool_delta.function:
+                tool_call.function.name += tool_delta.function.name or ''
+                tool_call.function.arguments += tool_delta.function.arguments or ''
+
+    def result(self):
+        tool_calls = [self.tool_calls[index] for index in sorted(self.tool_calls)] or None
+        message = SimpleNamespace(role='assistant', content=''.join(self.content), tool_calls=tool_calls)
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason=self.finish_reason)],
+                               usage=self.usage)
+
+
+class InferenceCancelled(Exception):
+    # 推理被取消(对冲中输掉的一方，或所属任务被取消)，结果作废，不计为推理错误
+    pass
+
+
 # 定义推理类，这个推理不再含于任务类，而是独立由系统调用，有几个模型就实例化几个推理器
 class Inference:
-    def __init__(self, base_url: str, api_key: str):
-        # 初始化OpenAI客户端
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+    # 连接错误(含超时)、429和5xx可以重试，其他错误(如400)重试也不会成功
+    TRANSIENT_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+    def __init__(self, base_url: str, api_key: str, max_concurrency: int = 1, stream: bool = False,
+                 name: str = None, weight: float = 1.0, timeout: float = 120.0, connect_timeout: float = 5.0,
+                 max_retries: int = 2, retry_backoff: float = 0.5, max_backoff: float = 8.0,
+                 max_connections: int = None, keepalive_expiry: float = 30.0):
+        # 初始化OpenAI客户端，异步客户端在异步模式第一次推理时创建
+        self.name = name or base_url
+        self.weight = weight # 路由器按权重分配请求
+        self.base_url = base_url
+        self.api_key = api_key
+        # 一次推理(含重试和退避)的截止时间，后端卡住时推理线程最多等这么久
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        # 重试由这里按截止时间控制，openai客户端自己不再重试
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        # 连接池：保持和并发槽位数相当的长连接，本地后端两轮对话之间的空闲通常超过httpx默认的5秒
+        connections = max_connections or max_concurrency + 2
+        self.limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections,
+                                       keepalive_expiry=keepalive_expiry)
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0, timeout=Timeout(timeout, connect=connect_timeout),
+                             http_client=DefaultHttpxClient(limits=self.limits))
+        self.async_client = None
+        # 同时在途的请求数上限，调度器按空闲槽位派发推理
+        self.max_concurrency = max_concurrency
+        self.slots = BoundedSemaphore(max_concurrency)
+        # 是否以流式请求推理，流式时可以通过on_token拿到逐段输出
+        self.stream = stream
+
+    # 尝试占用一个并发槽位，不阻塞，成功返回True
+    def acquire_slot(self):
+        return self.slots.acquire(blocking=False)
+
+    def release_slot(self):
+        self.slots.release()
+
+    # 检查后端是否可用，列模型成功即认为健康
+    def health_check(self, timeout: float = 3.0):
+        try:
+            self.client.with_options(timeout=timeout, max_retries=0).models.list()
+            return True
+        except Exception:
+            return False
+
+    # 本次尝试的超时：不超过到截止时间的剩余时间
+    def _attempt_timeout(self, deadline: float):
+        remaining = max(deadline - time.monotonic(), 0.001)
+        return Timeout(remaining, connect=min(self.connect_timeout, remaining))
+
+    # 第attempt次重试前的等待时间，指数退避加全抖动，429带Retry-After时至少等那么久；超过截止时间时返回None，不再重试
+    def _retry_delay(self, attempt: int, deadline: float, error):
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.retry_backoff * 2 ** attempt))
+        if isinstance(error, RateLimitError):
+            try:
+                delay = max(delay, float(error.response.headers.get('retry-after', 0)))
+            except ValueError:
+                pass
+        if time.monotonic() + delay >= deadline:
+            return None
+        metrics.inc('xh_inference_retries_total', backend=self.name, error=type(error).__name__)
+        metrics.trace('inference_retry', backend=self.name, attempt=attempt + 1, delay=delay, error=repr(error))
+        return delay
+
+    # 流式输出中途检查：被取消或超过截止时间时关闭连接
+    def _check_stream(self, stream, deadline: float, cancel):
+        if cancel is not None and cancel.is_set():
+            stream.close()
+            raise InferenceCancelled()
+        if time.monotonic() > deadline:
+            stream.close()
+            raise APITimeoutError(request=stream.response.request)
 
-    # 调用LLM推理并返回结果
-    def infer(self, model: str, messages: list, tools: list = []):
-        response = self.client.chat.completions.create(
+    # 调用LLM推理并返回结果，瞬时错误在截止时间内重试；已经输出过文本的流式请求不重试，避免重复推送
+    # cancel是取消信号(Event或CancelToken)，在发出请求前、重试前和流式读取的每一段检查，被取消时抛出InferenceCancelled
+    def infer(self, model: str, messages: list, tools: list = [], on_token=None, cancel=None):
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            emitted = []
+            try:
+                return self._infer_once(model, messages, tools, on_token, deadline, cancel, emitted)
+            except self.TRANSIENT_ERRORS as e:
+                delay = None if emitted else self._retry_delay(attempt, deadline, e)
+                if delay is None:
+                    raise
+                if cancel is None:
+                    time.sleep(delay)
+                elif cancel.wait(delay): # 退避期间被取消
+                    raise InferenceCancelled()
+                attempt += 1
+
+    def _infer_once(self, model, messages, tools, on_token, deadline, cancel, emitted):
+        if cancel is not None and cancel.is_set():
+            raise InferenceCancelled()
+        if not self.stream:
+            return self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                timeout=self._attempt_timeout(deadline)
+            )
+        assembler = StreamAssembler(on_token and (lambda text: (emitted.append(True), on_token(text))))
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=tools,
+            stream=True,
+            stream_options={'include_usage': True},
+            timeout=self._attempt_timeout(deadline)
+        )
+        for chunk in stream:
+            self._check_stream(stream, deadline, cancel)
+            assembler.add(chunk)
+        return assembler.result()
+
+    # 异步模式下的推理，供asyncio调度器await；对冲时输掉的一方直接取消协程
+    async def ainfer(self, model: str, messages: list, tools: list = [], on_token=None):
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0,
+                                            timeout=Timeout(self.timeout, connect=self.connect_timeout),
+                                            http_client=DefaultAsyncHttpxClient(limits=self.limits))
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            emitted = []
+            try:
+                return await self._ainfer_once(model, messages, tools, on_token, deadline, emitted)
+            except self.TRANSIENT_ERRORS as e:
+                delay = None if emitted else self._retry_delay(attempt, deadline, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _ainfer_once(self, model, messages, tools, on_token, deadline, emitted):
+        if not self.stream:
+            return await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                timeout=self._attempt_timeout(deadline)
+            )
+        assembler = StreamAssembler(on_token and (lambda text: (emitted.append(True), on_token(text))))
+        stream = await self.async_client.chat.completions.create(
             model=model,
             messages=messages,
-            tools=tools
+            tools=tools,
+            stream=True,
+            stream_options={'include_usage': True},
+            timeout=self._attempt_timeout(deadline)
         )
-        return response
+        try:
+            async for chunk in stream:
+                if time.monotonic() > deadline:
+                    raise APITimeoutError(request=stream.response.request)
+                assembler.add(chunk)
+        finally:
+            await stream.close()
+        return assembler.result()
+
+
+# 多个推理后端的路由器：在模板允许的后端里按最少在途请求数或权重挑选有空闲槽位的健康后端，
+# 连接错误、超时和5xx时把后端暂时标记为不可用并转移到其他后端
+class InferenceRouter:
+    FAILOVER_ERRORS = (APIConnectionError, InternalServerError) # APITimeoutError是APIConnectionError的子类
+
+    def __init__(self, backends: list, policy: str = 'least_outstanding', cooldown: float = 10.0, hedge: dict = None):
+        self.backends = {backend.name: backend for backend in backends}
+        self.policy = policy # 'least_outstanding' 或 'weighted'
+        self.cooldown = cooldown # 出错后多少秒内不再派发，健康检查成功会提前恢复
+        self.outstanding = {name: 0 for name in self.backends}
+        self.down_until = {name: 0.0 for name in self.backends}
+        self.latency = None # 成功推理耗时的指数滑动平均(秒)，准入控制据此估算Retry-After
+        # 对冲：推理超过该后端耗时的quantile分位数(或固定的delay秒)还没有输出时，向另一个候选后端再发一份，谁先输出用谁
+        # 例如 {"quantile": 0.95, "min_samples": 20}，为None时不对冲
+        self.hedge = dict({'quantile': 0.95, 'min_samples': 20, 'delay': None}, **hedge) if hedge else None
+        self.samples = {name: deque(maxlen=256) for name in self.backends} # 最近成功推理的耗时
+        self.sample_count = {name: 0 for name in self.backends}
+        self.hedge_after = {name: None for name in self.backends} # 每个后端的对冲等待时间，样本够了才有
+        self.hedge_executor = None # 同步模式下对冲时两份请求都在这个线程池里执行，第一次对冲时创建
+        self.lock = Lock()
+
+    @classmethod
+    def from_config(cls, configs: list, **kwargs):
+        # configs是tasks.yaml中backends列表，每项是Inference的构造参数
+        return cls([Inference(**config) for config in configs], **kwargs)
+
+    @property
+    def capacity(self):
+        # 所有后端的并发上限之和，用于决定推理工作者数量
+        return sum(backend.max_concurrency for backend in self.backends.values())
+
+    def is_healthy(self, name: str):
+        return time.monotonic() >= self.down_until[name]
+
+    def acquire(self, candidates=None, exclude=()):
+        # 在候选后端中挑一个健康且有空闲槽位的后端并占用槽位，返回后端名，都不可用时返回None
+        names = [name for name in (candidates or self.backends) if name in self.backends and name not in exclude]
+        with self.lock:
+            healthy = [name for name in names if self.is_healthy(name)]
+            if self.policy == 'weighted':
+                # 按权重随机排序(Efraimidis-Spirakis)，权重越大越可能排在前面
+                healthy.sort(key=lambda name: random.random() ** (1.0 / self.backends[name].weight), reverse=True)
+            else:
+                healthy.sort(key=lambda name: (self.outstanding[name] + 1) / self.backends[name].weight)
+            for name in healthy:
+                if self.backends[name].acquire_slot():
+                    self.outstanding[name] += 1
+                    return name
+        return None
+
+    def has_free_slot(self):
+        with self.lock:
+            return any(self.outstanding[name] < backend.max_concurrency and self.is_healthy(name)
+                       for name, backend in self.backends.items())
+
+    def release(self, name: str):
+        with self.lock:
+            self.outstanding[name] -= 1
+        self.backends[name].release_slot()
+
+    def mark_down(self, name: str):
+        with self.lock:
+            self.down_until[name] = time.monotonic() + self.cooldown
+
+    def check_health(self):
+        # 逐个检查后端，恢复可用的，标记不可用的
+        for name, backend in self.backends.items():
+            healthy = backend.health_check()
+            with self.lock:
+                if healthy:
+                    self.down_until[name] = 0.0
+                elif self.is_healthy(name):
+                    self.down_until[name] = time.monotonic() + self.cooldown
+
+    def health_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.check_health()
+
+    # 在已占用槽位的后端上推理，失败时转移到其他候选后端；返回时槽位已释放
+    def _begin(self, name: str) -> float:
+        metrics.add_gauge('xh_inference_in_flight', 1, backend=name)
+        return time.perf_counter()
+
+    def _end(self, name: str, model: str, start: float, response=None, error=None):
+        # 记录一次推理尝试的耗时、用量和错误，失败转移时每个后端各记一次
+        elapsed = time.perf_counter() - start
+        metrics.add_gauge('xh_inference_in_flight', -1, backend=name)
+        if isinstance(error, (InferenceCancelled, asyncio.CancelledError)):
+            return # 对冲中输掉被取消的请求，不计耗时和错误
+        metrics.observe('xh_inference_seconds', elapsed, backend=name, model=model)
+        if error is not None:
+            metrics.inc('xh_inference_errors_total', backend=name, error=type(error).__name__)
+            metrics.trace('inference', backend=name, model=model, seconds=elapsed, error=repr(error))
+            return
+        # 并发更新时可能丢掉个别样本，对平均值影响不大，不加锁
+        self.latency = elapsed if self.latency is None else self.latency + 0.2 * (elapsed - self.latency)
+        if self.hedge is not None:
+            self._add_sample(name, elapsed)
+        usage = getattr(response, 'usage', None)
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+        if usage is not None:
+            metrics.inc('xh_inference_tokens_total', prompt_tokens, backend=name, model=model, kind='prompt')
+            metrics.inc('xh_inference_tokens_total', completion_tokens, backend=name, model=model, kind='completion')
+        metrics.trace('inference', backend=name, model=model, seconds=elapsed,
+                      prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def _add_sample(self, name: str, elapsed: float):
+        # 记录成功推理的耗时，样本刚够时和之后每16个样本重新计算一次分位数，不在每次推理时排序
+        with self.lock:
+            samples = self.samples[name]
+            samples.append(elapsed)
+            self.sample_count[name] += 1
+            count = self.sample_count[name]
+            if count >= self.hedge['min_samples'] and (count == self.hedge['min_samples'] or count % 16 == 0):
+                ordered = sorted(samples)
+                self.hedge_after[name] = ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge['quantile']))]
+
+    def hedge_delay(self, name: str, candidates=None):
+        # 在name上推理时，等多久还没有输出就对冲；不对冲(未开启、样本不够或没有其他候选后端)时返回None
+        if self.hedge is None or not any(other != name for other in (candidates or self.backends) if other in self.backends):
+            return None
+        return self.hedge['delay'] if self.hedge['delay'] is not None else self.hedge_after[name]
+
+    def _claimer(self, on_token, cancels: list):
+        # 对冲的两份请求共用：第一份输出文本的请求胜出，另一份被叫停，只有胜出者的文本推送给on_token
+        owner = []
+        lock = Lock()
+        def claim(index):
+            def callback(text):
+                with lock:
+                    if not owner:
+                        owner.append(index)
+                        cancels[1 - index]()
+                if owner[0] == index and on_token:
+                    on_token(text)
+            return callback
+        return owner, claim
+
+    def _finish_hedge(self, name: str, won: bool):
+        metrics.inc('xh_inference_hedges_total', backend=name, outcome='won' if won else 'lost')
+        metrics.trace('inference_hedge', backend=name, won=won)
+
+    # cancel是所属任务的CancelToken，被取消时抛出InferenceCancelled；对冲的两份请求各用一个由它派生的令牌
+    def infer(self, name: str, model: str, messages: list, tools: list = [], candidates=None, on_token=None, cancel=None):
+        delay = self.hedge_delay(name, candidates)
+        if delay is None:
+            return self._infer(name, model, messages, tools, candidates, on_token, cancel)
+        if self.hedge_executor is None:
+            with self.lock:
+                if self.hedge_executor is None:
+                    self.hedge_executor = ThreadPoolExecutor(max_workers=2 * self.capacity, thread_name_prefix='hedge')
+        events = [CancelToken(cancel), CancelToken(cancel)]
+        try:
+            return self._hedged_infer(name, model, messages, tools, candidates, on_token, delay, events)
+        finally:
+            for event in events:
+                event.detach()
+
+    def _hedged_infer(self, name, model, messages, tools, candidates, on_token, delay, events):
+        owner, claim = self._claimer(on_token, [event.set for event in events])
+        futures = [self.hedge_executor.submit(self._infer, name, model, messages, tools, candidates, claim(0), events[0])]
+        wait(futures, timeout=delay)
+        if futures[0].done() or owner:
+            return futures[0].result()
+        hedge = self.acquire(candidates, exclude=(name,))
+        if hedge is None: # 其他后端都没有空闲槽位，只能继续等
+            return futures[0].result()
+        futures.append(self.hedge_executor.submit(self._infer, hedge, model, messages, tools, candidates, claim(1), events[1]))
+        errors = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.index(future)
+                if owner and owner[0] != index:
+                    continue # 另一份已经开始输出，这份作废
+                try:
+                    response = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                events[1 - index].set()
+                self._finish_hedge(hedge, index == 1)
+                return response
+        raise errors[0]
+
+    def _infer(self, name: str, model: str, messages: list, tools: list = [], candidates=None, on_token=None, cancel=None):
+        tried = []
+        while True:
+            tried.append(name)
+            start = self._begin(name)
+            try:
+                if cancel is None:
+                    response = self.backends[name].infer(model, messages, tools, on_token=on_token)
+                else:
+                    response = self.backends[name].infer(model, messages, tools, on_token=on_token, cancel=cancel)
+                self._end(name, model, start, response)
+                return response
+            except Exception as e:
+                self._end(name, model, start, error=e)
+                if not isinstance(e, self.FAILOVER_ERRORS):
+                    raise
+                self.mark_down(name)
+                fallback = self.acquire(candidates, exclude=tried)
+                if fallback is None:
+                    raise
+                name = fallback
+            finally:
+                self.release(tried[-1])
+
+    # 取消这个协程所在的asyncio任务即可中止推理，对冲时两份在途的请求都会被取消
+    async def ainfer(self, name: str, model: str, messages: list, tools: list = [], candidates=None, on_token=None):
+        delay = self.hedge_delay(name, candidates)
+        if delay is None:
+            return await self._ainfer(name, model, messages, tools, candidates, on_token)
+        tasks = []
+        loop = asyncio.get_running_loop()
+        # 取消推迟到事件循环的下一步：被取消的协程此时一定已经开始执行，它的finally会释放槽位
+        owner, claim = self._claimer(on_token, [lambda: loop.call_soon(tasks[0].cancel),
+                                                lambda: len(tasks) > 1 and loop.call_soon(tasks[1].cancel)])
+        tasks.append(asyncio.ensure_future(self._ainfer(name, model, messages, tools, candidates, claim(0))))
+        try:
+            await asyncio.wait(tasks, timeout=delay)
+            if tasks[0].done() or owner:
+                return await tasks[0]
+            hedge = self.acquire(candidates, exclude=(name,))
+            if hedge is None:
+                return await tasks[0]
+            tasks.append(asyncio.ensure_future(self._ainfer(hedge, model, messages, tools, candidates, claim(1))))
+            errors = []
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = tasks.index(task)
+                    if task.cancelled() or (owner and owner[0] != index):
+                        continue
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    self._finish_hedge(hedge, index == 1)
+                    return task.result()
+            raise errors[0]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _ainfer(self, name: str, model: str, messages: list, tools: list = [], candidates=None, on_token=None):
+        tried = []
+        while True:
+            tried.append(name)
+            start = self._begin(name)
+            try:
+                response = await self.backends[name].ainfer(model, messages, tools, on_token=on_token)
+                self._end(name, model, start, response)
+                return response
+            except asyncio.CancelledError as e:
+                self._end(name, model, start, error=e)
+                raise
+            except Exception as e:
+                self._end(name, model, start, error=e)
+                if not isinstance(e, self.FAILOVER_ERRORS):
+                    raise
+                self.mark_down(name)
+                fallback = self.acquire(candidates, exclude=tried)
+                if fallback is None:
+                    raise
+                name = fallback
+            finally:
+                self.release(tried[-1])
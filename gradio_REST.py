@@ -2,30 +2,29 @@ from XHserver import XingHe
 import gradio as gr
 import requests
 
-is_get_system_status = False
-
-def activate_task(task_name, input_text):
+def activate_task(task_name, input_text, session_id):
+    # 激活任务后按请求id长轮询取回复，不再轮询/status
     activate_task_url = 'http://127.0.0.1:5000/activate_task'
     task_data = {
         "name": task_name,
         "input": input_text,
+        "session_id": session_id or None,
         "parent_uuid": ""
     }
-    response = requests.post(activate_task_url, json=task_data)
-    return response.json()
+    response = requests.post(activate_task_url, json=task_data).json()
+    if response.get("status") != "OK":
+        return response
+    result_url = 'http://127.0.0.1:5000/result/' + response["request_id"]
+    while True:
+        result = requests.get(result_url, params={"timeout": 30})
+        if result.status_code != 202:
+            return result.json()
 
 def get_system_status():
-    if not is_get_system_status:
-        return {}
     status_url = 'http://127.0.0.1:5000/status'
     response = requests.get(status_url)
     return response.json()
 
-def flag_get_system_status():
-    global is_get_system_status
-    if not is_get_system_status:
-        is_get_system_status = True
-
 def save_meta_tasks():
     save_meta_tasks_url = 'http://127.0.0.1:5000/save_meta_tasks'
     response = requests.post(save_meta_tasks_url)
@@ -43,16 +42,17 @@ with gr.Blocks() as demo:
     with gr.Row():
         task_name = gr.Textbox(label="任务名称")
         input_text = gr.Textbox(label="输入文本")
+        session_id = gr.Textbox(label="会话(可选)")
         activate_button = gr.Button("激活任务")
-        activate_output = gr.Textbox(label="激活任务响应")
+        activate_output = gr.Textbox(label="任务回复")
         
-        activate_button.click(activate_task, inputs=[task_name, input_text], outputs=activate_output)
+        activate_button.click(activate_task, inputs=[task_name, input_text, session_id], outputs=activate_output)
     
     with gr.Row():
         status_button = gr.Button("获取系统状态")
-        status_textbox = gr.Textbox(value = get_system_status, label = "系统状态", interactive=False, every=0.5)
+        status_textbox = gr.Textbox(label = "系统状态", interactive=False)
         
-        status_button.click(flag_get_system_status)#点一下之后再开始获取系统状态
+        status_button.click(get_system_status, outputs=status_textbox)#点一下获取一次系统状态
 
     with gr.Row():
         save_button = gr.Button("保存元任务状态")
@@ -67,4 +67,4 @@ if __name__ == '__main__':
     xinghe = XingHe()
     xinghe.system_init()
     xinghe.run()
-    demo.launch()
\ No newline at end of file
+    demo.launch()
@@ -0,0 +1,111 @@
+"""
+测试共用的桩后端和辅助函数：推理由给定的函数直接返回，不发出网络请求，调度器在守护线程里运行
+运行方式(在仓库根目录): python -m pytest -q
+"""
+import os, sys, time, asyncio
+from threading import Thread, Lock
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from XingHeFarmworkNew import Inference, InferenceRouter
+import XHserver
+from XHserver import XingHe
+
+
+def completion(content='', tool_calls=None):
+    """
+    拼出和openai返回结构相同的推理结果
+    :param tool_calls: [(函数名, 参数JSON字符串)]
+    """
+    calls = [SimpleNamespace(id='call%d' % i, function=SimpleNamespace(name=name, arguments=arguments))
+             for i, (name, arguments) in enumerate(tool_calls or [])]
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=calls or None))])
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+class StubInference(Inference):
+    # respond(messages, tools)返回推理结果或抛出异常
+    def __init__(self, respond, max_concurrency=2, name='stub'):
+        super().__init__('http://127.0.0.1:9/v1', 'stub', max_concurrency=max_concurrency, name=name)
+        self.respond = respond
+        self.calls = 0
+
+    def infer(self, model, messages, tools=[], on_token=None, cancel=None):
+        self.calls += 1
+        response = self.respond(messages, tools)
+        if on_token: # 模拟流式输出，文本逐字推送
+            for text in response.choices[0].message.content or '':
+                on_token(text)
+        return response
+
+    async def ainfer(self, model, messages, tools=[], on_token=None):
+        # respond可能阻塞等待测试放行，放到线程里执行，不卡住事件循环
+        return await asyncio.to_thread(self.infer, model, messages, tools, on_token)
+
+
+def tool(name, function, is_meta=True, **attributes):
+    """
+    构造一个工具类，参数描述只用于发给模型，测试里不校验
+    """
+    description = {'type': 'function', 'is_meta': is_meta,
+                   'function': {'name': name, 'description': name, 'parameters': {'type': 'object', 'properties': {}}}}
+    return type(name, (), dict(attributes, description=description, prompt=['稍等'], function=staticmethod(function)))
+
+
+@pytest.fixture(params=['sync', 'async'])
+def start_scheduler(request):
+    """
+    返回 start(respond, cooldown, capacity, **调度器参数) -> (调度器, 请求结果表, 桩后端)，同步和异步调度器各跑一遍
+    """
+    def start(respond, cooldown=10.0, capacity=2, **kwargs):
+        backend = StubInference(respond, capacity)
+        router = InferenceRouter([backend], cooldown=cooldown)
+        tracker = XingHe.RequestTracker()
+        scheduler_class = XingHe.AsyncScheduler if request.param == 'async' else XingHe.Scheduler
+        scheduler = scheduler_class(None, {}, Lock(), Lock(), router=router, request_tracker=tracker, **kwargs)
+        Thread(target=scheduler.run, daemon=True).start()
+        if request.param == 'sync':
+            for _ in range(router.capacity):
+                Thread(target=scheduler.infer, daemon=True).start()
+        return scheduler, tracker, backend
+    return start
+
+
+@pytest.fixture
+def start_server(tmp_path, monkeypatch):
+    """
+    返回 start(respond, **tasks.yaml的顶层配置) -> (XingHe实例, Flask测试客户端)，
+    模板和工具取自仓库里的tasks.yaml，推理由桩后端完成，不开持久化，调度器在守护线程里运行
+    """
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(XHserver, 'log_file', str(tmp_path / 'server_log.log')) # 只有第一次创建XingHe时生效
+
+    def start(respond, **config):
+        with open(os.path.join(ROOT, 'tasks.yaml'), 'r', encoding='utf-8') as file:
+            settings = yaml.safe_load(file)
+        settings.pop('persistence', None)
+        settings.update(config)
+        config_path = tmp_path / 'tasks.yaml'
+        config_path.write_text(yaml.safe_dump(settings, allow_unicode=True), encoding='utf-8')
+        xinghe = XingHe(config_path=str(config_path))
+        xinghe.router = xinghe.admission.router = InferenceRouter([StubInference(respond, name='ollama')])
+        xinghe.scheduler = XingHe.Scheduler(xinghe.meta_tasks, xinghe.tasks, xinghe.meta_tasks_lock, xinghe.tasks_lock, xinghe.stream_hub,
+                                            xinghe.task_templates, xinghe.router, xinghe.request_tracker, xinghe.status_board)
+        Thread(target=xinghe.scheduler.run, daemon=True).start()
+        for _ in range(xinghe.router.capacity):
+            Thread(target=xinghe.scheduler.infer, daemon=True).start()
+        return xinghe, xinghe.make_rest_server().app.test_client()
+    return start
@@ -0,0 +1,29 @@
+"""
+准入控制的令牌桶和配置校验
+"""
+import pytest
+
+from XingHeFarmworkNew import InferenceRouter
+from XHserver import XingHe
+from conftest import StubInference, completion
+
+
+def make_admission(**config):
+    return XingHe.AdmissionControl(InferenceRouter([StubInference(lambda messages, tools: completion())]), **config)
+
+
+@pytest.mark.parametrize('config', [{'rate': 0}, {'rate': -1}, {'rate': 1, 'burst': 0}])
+def test_non_positive_rate_or_burst_is_rejected(config):
+    with pytest.raises(ValueError):
+        make_admission(**config)
+
+
+def test_rate_limit_rejects_after_burst_with_retry_after():
+    admission = make_admission(rate=0.5, burst=2)
+    assert admission.admit('client', 3, dict) is None
+    assert admission.admit('client', 3, dict) is None
+    rejected = admission.admit('client', 3, dict)
+    assert rejected['result'] == 'rate_limited'
+    assert rejected['retry_after'] == 2
+    # 其他客户端有自己的令牌桶
+    assert admission.admit('other', 3, dict) is None
@@ -0,0 +1,110 @@
+"""
+任务取消：取消令牌沿任务树向下传播，在途的推理被中止或作废、运行中的工具收到cancel_event，释放的后端槽位立即交给排队的任务
+"""
+import time
+from threading import Event, Lock
+
+from XingHeFarmworkNew import LLMTask, LLMTools, InferenceRouter, CancelToken
+from XHserver import XingHe
+from conftest import StubInference, completion, tool, wait_until
+
+
+def submit(scheduler, tracker, text):
+    task = LLMTask('Chat', 3, 'sys', LLMTools())
+    task.info['request_id'] = tracker.create(name='Chat')
+    task.set_input(text)
+    task.forward()
+    scheduler.add_task(task)
+    return task
+
+
+def test_cancelled_inference_frees_the_slot_at_once(start_scheduler):
+    gate = Event()
+
+    def respond(messages, tools):
+        if messages[-1]['content'] == '会被取消':
+            gate.wait(5)
+        return completion('好的')
+    scheduler, tracker, backend = start_scheduler(respond, capacity=1, idle_timeout=3.0)
+    cancelled = submit(scheduler, tracker, '会被取消')
+    assert wait_until(lambda: backend.calls == 1)
+    waiting = submit(scheduler, tracker, '排队')
+    assert wait_until(lambda: waiting.info['uuid'] in scheduler.in_ready) # 已在等槽位
+    start = time.monotonic()
+    cancelled.cancel_token.set()
+    gate.set()
+    assert tracker.get(waiting.info['request_id'], timeout=5)['state'] == 'done'
+    assert time.monotonic() - start < 1.0
+    assert cancelled.status == 'ReUser' and not cancelled.events['running'].is_set() # 结果作废，没有写进对话
+
+
+def test_cancel_token_propagates_to_derived_tokens():
+    root = CancelToken()
+    child = root.child()
+    grandchild = CancelToken(child)
+    detached = root.child()
+    detached.detach()
+    fired = []
+    grandchild.add_callback(lambda: fired.append('grandchild'))
+    root.set()
+    assert child.is_set() and grandchild.is_set() and grandchild.wait(0)
+    assert fired == ['grandchild']
+    assert not detached.is_set() # 摘下的令牌不再受父令牌影响
+    late = root.child() # 父令牌已经取消时派生的令牌直接处于取消状态，回调立即执行
+    late.add_callback(lambda: fired.append('late'))
+    assert late.is_set() and fired == ['grandchild', 'late']
+
+
+def test_remove_subtasks_cancels_only_the_subtree():
+    tracker = XingHe.RequestTracker()
+    scheduler = XingHe.Scheduler(None, {}, Lock(), Lock(), router=InferenceRouter([StubInference(lambda messages, tools: completion())]),
+                                 request_tracker=tracker)
+
+    def add(parent=None):
+        task = LLMTask('Chat', 3, 'sys', LLMTools())
+        task.info['parent_uuid'] = parent.info['uuid'] if parent is not None else None
+        task.info['request_id'] = tracker.create(name='Chat')
+        scheduler.add_task(task)
+        return task
+    root, other = add(), add()
+    child = add(root)
+    grandchild, sibling = add(child), add(root)
+    unrelated = add(other)
+    scheduler.remove_subtasks(root.info['uuid'])
+    for task in (child, grandchild, sibling):
+        assert task.cancel_token.is_set()
+        assert scheduler.get_task(task.info['uuid']) is None
+        assert tracker.get(task.info['request_id'])['state'] == 'cancelled'
+    for task in (root, other, unrelated):
+        assert not task.cancel_token.is_set()
+        assert scheduler.get_task(task.info['uuid']) is task
+    assert root.info['uuid'] not in scheduler.children
+    assert scheduler.children[other.info['uuid']] == {unrelated.info['uuid']}
+    other.cancel_token.set() # 子任务的令牌由父任务派生
+    assert unrelated.cancel_token.is_set()
+
+
+def test_cancelling_a_task_stops_its_running_tool(start_scheduler):
+    started, events = Event(), []
+
+    def wait_for_cancel(cancel_event):
+        events.append(cancel_event)
+        started.set()
+        return '被取消' if cancel_event.wait(10) else '超时'
+
+    def respond(messages, tools):
+        return completion('', [('wait_for_cancel', '{}')])
+    scheduler, tracker, backend = start_scheduler(respond)
+    llmtools = LLMTools()
+    llmtools.add_tools([tool('wait_for_cancel', wait_for_cancel)])
+    task = LLMTask('Chat', 3, 'sys', llmtools)
+    task.info['request_id'] = tracker.create(name='Chat')
+    task.set_input('等着')
+    task.forward()
+    scheduler.add_task(task)
+    assert started.wait(5)
+    task.cancel_token.set()
+    assert events[0].is_set() # 注入的cancel_event由任务的令牌派生
+    assert wait_until(lambda: not task.events['running'].is_set(), timeout=1.0)
+    assert not [msg for msg in task.context_ctrl['tool_history'] if msg.role == 'tool'] # 输出被丢弃
+    assert backend.calls == 1
@@ -0,0 +1,109 @@
+"""
+推理失败时这一轮以错误回复结束：请求结果、进行中计数和任务都被释放，不会每隔兜底间隔无限重试
+"""
+import time
+from threading import Event, Thread
+
+from openai import APIConnectionError
+
+from XingHeFarmworkNew import LLMTask, LLMTools
+from conftest import completion, wait_until
+
+
+def submit(scheduler, tracker, text='你好'):
+    task = LLMTask('Chat', 3, 'sys', LLMTools())
+    task.info['request_id'] = tracker.create(name='Chat')
+    task.set_input(text)
+    task.forward()
+    scheduler.add_task(task)
+    return task
+
+
+def test_permanent_error_fails_the_round_once(start_scheduler):
+    def respond(messages, tools):
+        raise ValueError('context length exceeded')
+    scheduler, tracker, backend = start_scheduler(respond, idle_timeout=0.05)
+    task = submit(scheduler, tracker)
+    result = tracker.get(task.info['request_id'], timeout=5)
+    assert result['state'] == 'failed'
+    assert 'context length exceeded' in result['reply']
+    assert backend.calls == 1
+    assert wait_until(lambda: not scheduler.tasks)
+    assert tracker.outstanding() == {}
+    assert task.status == 'Free' and not task.events['running'].is_set()
+    # 失败的一轮不写进对话历史
+    assert [msg.role for msg in task.context_ctrl['user_history']] == ['user']
+
+
+def test_transient_errors_are_retried_up_to_the_cap(start_scheduler):
+    def respond(messages, tools):
+        raise APIConnectionError(request=None)
+    scheduler, tracker, backend = start_scheduler(respond, cooldown=0.0, max_infer_failures=3, retry_backoff=0.01)
+    task = submit(scheduler, tracker)
+    result = tracker.get(task.info['request_id'], timeout=5)
+    assert result['state'] == 'failed'
+    assert backend.calls == 3
+    assert wait_until(lambda: not scheduler.tasks)
+    assert tracker.outstanding() == {}
+
+
+def test_transient_error_then_success(start_scheduler):
+    outcomes = [APIConnectionError(request=None), completion('好的')]
+
+    def respond(messages, tools):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    scheduler, tracker, backend = start_scheduler(respond, cooldown=0.0, retry_backoff=0.01)
+    task = submit(scheduler, tracker)
+    result = tracker.get(task.info['request_id'], timeout=5)
+    assert (result['state'], result['reply']) == ('done', '好的')
+    assert task.info['infer_failures'] == 0 and task.info['error'] is None
+
+
+def test_transient_retry_is_not_starved_by_other_traffic(start_scheduler):
+    failed = []
+
+    def respond(messages, tools):
+        if messages[-1]['content'] == '会失败一次' and not failed:
+            failed.append(True)
+            raise APIConnectionError(request=None)
+        return completion('好的')
+    # 兜底间隔比其他请求的间隔长，重试只能靠退避定时器唤醒
+    scheduler, tracker, backend = start_scheduler(respond, cooldown=0.0, idle_timeout=1.0, retry_backoff=0.1)
+    stop = Event()
+
+    def traffic():
+        while not stop.is_set():
+            submit(scheduler, tracker, '其他请求')
+            time.sleep(0.05)
+    task = submit(scheduler, tracker, '会失败一次')
+    Thread(target=traffic, daemon=True).start()
+    try:
+        start = time.monotonic()
+        result = tracker.get(task.info['request_id'], timeout=3)
+        assert result['state'] == 'done'
+        assert time.monotonic() - start < 0.9
+    finally:
+        stop.set()
+
+
+def test_freed_slot_is_reused_at_once(start_scheduler):
+    gate = Event()
+
+    def respond(messages, tools):
+        if messages[-1]['content'] == '会失败':
+            gate.wait(5)
+            raise APIConnectionError(request=None)
+        return completion('好的')
+    # 只有一个槽位，失败的任务等很久才重试，槽位释放时排队的任务应立即派发
+    scheduler, tracker, backend = start_scheduler(respond, cooldown=0.0, capacity=1, idle_timeout=3.0, retry_backoff=10.0)
+    submit(scheduler, tracker, '会失败')
+    assert wait_until(lambda: backend.calls == 1)
+    waiting = submit(scheduler, tracker, '排队')
+    assert wait_until(lambda: waiting.info['uuid'] in scheduler.in_ready) # 已在等槽位
+    gate.set()
+    start = time.monotonic()
+    assert tracker.get(waiting.info['request_id'], timeout=5)['state'] == 'done'
+    assert time.monotonic() - start < 1.0
@@ -0,0 +1,93 @@
+"""
+元任务对话的预写日志：重启后按 快照+日志 恢复，崩溃时写了一半的最后一行被截掉，快照之前的旧记录不会重放两次
+"""
+import os, shutil
+
+from XingHeFarmworkNew import LLMTask, LLMTools
+from XHserver import XingHe
+from conftest import completion
+
+
+def open_log(tmp_path, **kwargs):
+    return XingHe.MetaTaskLog(str(tmp_path / 'meta_tasks.wal'), fsync=False, **kwargs)
+
+
+def meta_task(log, session_id='s1'):
+    task = LLMTask('ChatWithUser', 3, 'sys', LLMTools())
+    task.info['session_id'] = session_id
+    log.attach(task)
+    return task
+
+
+def chat(task, text, reply):
+    task.set_input(text)
+    task.forward()
+    task.set_response(completion(reply))
+    task.forward()
+    task.get_reply()
+
+
+def test_restart_replays_the_log(tmp_path):
+    log = open_log(tmp_path)
+    task, other = meta_task(log), meta_task(log, 's2')
+    chat(task, '你好', '你好呀')
+    chat(other, '在吗', '在的')
+    chat(task, '今天周几', '周六')
+    assert log.flush(timeout=5)
+    restored = meta_task(open_log(tmp_path))
+    assert restored.dump_state() == task.dump_state()
+    assert [msg['content'] for msg in restored.dump_state()['user_history']] == ['你好', '你好呀', '今天周几', '周六']
+    assert meta_task(open_log(tmp_path), 's2').dump_state() == other.dump_state()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    log = open_log(tmp_path)
+    task = meta_task(log)
+    chat(task, '你好', '你好呀')
+    assert log.flush(timeout=5)
+    size = os.path.getsize(log.path)
+    with open(log.path, 'ab') as file:
+        file.write('{"seq": 3, "op": "append", "msg": {"content": "写了一'.encode('utf-8')[:-2]) # 崩溃在多字节字符中间
+    log = open_log(tmp_path)
+    restored = meta_task(log)
+    assert restored.dump_state() == task.dump_state()
+    assert os.path.getsize(log.path) == size
+    # 新记录接在最后一条完整记录之后，下次重启能读出来
+    chat(restored, '再见', '拜拜')
+    assert log.flush(timeout=5)
+    assert meta_task(open_log(tmp_path)).dump_state() == restored.dump_state()
+
+
+def test_snapshot_then_replay(tmp_path):
+    log = open_log(tmp_path)
+    task = meta_task(log)
+    chat(task, '问题' * 10, '回答' * 10)
+    assert log.flush(timeout=5)
+    stale = tmp_path / 'stale.wal'
+    shutil.copy(log.path, stale)
+    assert log.flush(snapshot=True, timeout=5)
+    assert os.path.exists(log.snapshot_path) and os.path.getsize(log.path) == 0
+    assert task.compact_history(task.context_ctrl['user_history'], 2, '聊过一个问题')
+    chat(task, '第二个问题', '第二个回答')
+    assert log.flush(timeout=5)
+    # 模拟写完快照、清空日志之前崩溃：快照已包含的旧记录仍留在日志开头
+    with open(log.path, 'rb') as file:
+        tail = file.read()
+    shutil.copy(stale, log.path)
+    with open(log.path, 'ab') as file:
+        file.write(tail)
+    restored = meta_task(open_log(tmp_path))
+    assert restored.dump_state() == task.dump_state()
+    assert restored.context_ctrl['summary'] == '聊过一个问题'
+    assert [msg['content'] for msg in restored.dump_state()['user_history']] == ['第二个问题', '第二个回答']
+
+
+def test_snapshot_every_bounds_the_log(tmp_path):
+    log = open_log(tmp_path, snapshot_every=3)
+    task = meta_task(log)
+    for turn in range(3):
+        chat(task, '问题%d' % turn, '回答%d' % turn)
+        assert log.flush(timeout=5)
+    assert os.path.exists(log.snapshot_path)
+    assert log.since_snapshot < 3
+    assert meta_task(open_log(tmp_path)).dump_state() == task.dump_state()
@@ -0,0 +1,77 @@
+"""
+待推理任务的老化堆：优先级高的先出，等待越久优先级越高，状态已经变化的条目在弹出时丢弃
+"""
+import time
+from threading import Lock
+
+from XingHeFarmworkNew import LLMTask, LLMTools, InferenceRouter
+from XHserver import XingHe
+from conftest import StubInference, completion
+
+
+def make_scheduler(aging_interval):
+    router = InferenceRouter([StubInference(lambda messages, tools: completion())])
+    return XingHe.Scheduler(None, {}, Lock(), Lock(), router=router, aging_interval=aging_interval)
+
+
+def ready_task(scheduler, priority):
+    task = LLMTask('Chat', priority, 'sys', LLMTools())
+    task.set_input('hi')
+    task.forward()
+    scheduler._register_task(task)
+    return task
+
+
+def pop_all(scheduler):
+    order = []
+    while True:
+        _, task = scheduler._pop_ready()
+        if task is None:
+            return order
+        order.append(task)
+
+
+def test_priority_then_arrival_order():
+    scheduler = make_scheduler(aging_interval=60.0)
+    low, high, high_later = ready_task(scheduler, 5), ready_task(scheduler, 1), ready_task(scheduler, 1)
+    for task in (low, high, high_later):
+        scheduler._push_ready(task)
+    assert pop_all(scheduler) == [high, high_later, low]
+    assert not scheduler.in_ready
+
+
+def test_waiting_task_ages_past_higher_priority():
+    scheduler = make_scheduler(aging_interval=0.01)
+    old = ready_task(scheduler, 5)
+    scheduler._push_ready(old)
+    time.sleep(0.1) # 等待了约10个老化间隔，超过4级的优先级差
+    new = ready_task(scheduler, 1)
+    scheduler._push_ready(new)
+    assert pop_all(scheduler) == [old, new]
+
+
+def test_each_task_has_at_most_one_entry():
+    scheduler = make_scheduler(aging_interval=60.0)
+    task = ready_task(scheduler, 3)
+    for _ in range(3):
+        scheduler._push_ready(task)
+    assert len(scheduler.ready_heap) == 1
+    assert pop_all(scheduler) == [task]
+    scheduler._push_ready(task) # 弹出后可以再次入堆
+    assert pop_all(scheduler) == [task]
+
+
+def test_stale_entries_are_dropped_lazily():
+    scheduler = make_scheduler(aging_interval=60.0)
+    removed, running, suspended, answered, ready = (ready_task(scheduler, 1) for _ in range(5))
+    for task in (removed, running, suspended, answered, ready):
+        scheduler._push_ready(task)
+    # 入堆之后状态变化的任务不从堆里删除，弹出时才丢弃
+    scheduler._remove_task(removed)
+    running.events['running'].set()
+    suspended.events['suspend'].set()
+    answered.set_response(completion('好的'))
+    answered.forward()
+    assert len(scheduler.ready_heap) == 5
+    assert pop_all(scheduler) == [ready]
+    assert scheduler.ready_heap == [] and not scheduler.in_ready
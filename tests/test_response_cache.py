@@ -0,0 +1,85 @@
+"""
+结果缓存：内存层按最近使用淘汰、按ttl过期，可选的sqlite层在重启后仍能命中；开启了缓存的子任务相同输入不再创建
+"""
+import json, time
+from threading import Lock
+
+from XingHeFarmworkNew import InferenceRouter, ResponseCache
+from XHserver import XingHe
+from conftest import ROOT, StubInference, completion
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1 # a成为最近使用
+    cache.put('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert cache.get('b', 'miss') == 'miss'
+
+
+def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl=0.05)
+    cache.put('a', {'answer': 1})
+    assert cache.get('a') == {'answer': 1}
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert 'a' not in cache.entries
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / 'cache' / 'results.sqlite')
+    ResponseCache(max_entries=1, disk=path).put('a', ['告', 1])
+    cache = ResponseCache(max_entries=1, disk=path)
+    assert cache.entries == {}
+    assert cache.get('a') == ['告', 1]
+    assert 'a' in cache.entries # 磁盘命中提升到内存
+    # 内存层淘汰的条目仍能从磁盘取回
+    cache.put('b', 2)
+    assert 'a' not in cache.entries and cache.get('a') == ['告', 1]
+
+
+def test_expired_disk_entries_are_not_returned(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    ResponseCache(ttl=0.05, disk=path).put('a', 1)
+    time.sleep(0.1)
+    assert ResponseCache(ttl=0.05, disk=path).get('a') is None
+
+
+def test_keys_ignore_whitespace_and_argument_order():
+    assert ResponseCache.normalize(' 一口咬掉\n牛尾巴  ') == ResponseCache.normalize('一口咬掉 牛尾巴')
+    assert ResponseCache.make_key('add', {'a': 1, 'b': 2}) == ResponseCache.make_key('add', {'b': 2, 'a': 1})
+    assert ResponseCache.make_key('add', {'a': 1, 'b': 2}) != ResponseCache.make_key('add', {'a': 2, 'b': 1})
+
+
+def test_cached_subtask_is_not_spawned_again(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    templates = XingHe.TaskTemplate('tasks.yaml', 'Tools') # solve_riddles模板开启了缓存
+    router = InferenceRouter([StubInference(lambda messages, tools: completion())])
+    scheduler = XingHe.Scheduler(None, {}, Lock(), Lock(), router=router, task_templates=templates)
+
+    def ask(question):
+        parent = templates.get_task('ChatWithUser')
+        parent.set_input('猜个谜')
+        parent.forward()
+        parent.set_response(completion('', [('solve_riddles', json.dumps({'question': question}))]))
+        parent.forward()
+        with scheduler.tasks_lock:
+            scheduler._register_task(parent)
+        scheduler.toolcall(parent)
+        return parent
+
+    first = ask('一口咬掉牛尾巴')
+    child = scheduler.tasks[first.info['child_uuid']]
+    child.set_response(completion('告'))
+    child.forward()
+    with scheduler.tasks_lock:
+        scheduler._complete(child)
+    assert [msg.content for msg in first.context_ctrl['tool_history'] if msg.role == 'tool'] == ['告']
+    tasks = set(scheduler.tasks)
+    # 只差空白的相同谜面直接拿到缓存的解答，不创建子任务，父任务也不停在挂起状态
+    second = ask(' 一口咬掉牛尾巴\n')
+    assert set(scheduler.tasks) == tasks | {second.info['uuid']}
+    assert not second.events['suspend'].is_set() and second.status == 'ReTool'
+    assert [msg.content for msg in second.context_ctrl['tool_history'] if msg.role == 'tool'] == ['告']
@@ -0,0 +1,76 @@
+"""
+请求结果接口：/result 长轮询，完成返回200、仍在进行返回202；/activate_tasks 按顺序返回每条激活的结果和状态码
+"""
+import time
+from threading import Event
+
+from conftest import completion
+
+
+def test_result_long_poll(start_server):
+    gate = Event()
+
+    def respond(messages, tools):
+        gate.wait(5)
+        return completion('回复:' + messages[-1]['content'])
+    xinghe, client = start_server(respond)
+    try:
+        request_id = client.post('/activate_task', json={'name': 'ChatWithUser', 'input': '你好', 'session_id': 'a'}).json['request_id']
+        response = client.get(f'/result/{request_id}')
+        assert response.status_code == 202
+        assert (response.json['state'], response.json['reply'], response.json['session_id']) == ('pending', None, 'a')
+        start = time.monotonic()
+        assert client.get(f'/result/{request_id}?timeout=0.2').status_code == 202
+        assert time.monotonic() - start >= 0.2 # 未完成时等满timeout
+        gate.set()
+        start = time.monotonic()
+        response = client.get(f'/result/{request_id}?timeout=5')
+        assert time.monotonic() - start < 2 # 完成时立即返回
+        assert response.status_code == 200
+        assert (response.json['state'], response.json['reply'], response.json['request_id']) == ('done', '回复:你好', request_id)
+        assert client.get(f'/result/{request_id}').status_code == 200 # 结果保留到过期
+    finally:
+        gate.set()
+    assert client.get('/result/unknown').status_code == 404
+    assert client.get(f'/result/{request_id}?timeout=abc').status_code == 400
+
+
+def test_expired_results_are_gone(start_server):
+    xinghe, client = start_server(lambda messages, tools: completion('好的'), requests={'result_ttl': 0.1, 'max_results': 10})
+    first = client.post('/activate_task', json={'name': 'ChatWithUser', 'input': '你好', 'session_id': 'a'}).json['request_id']
+    assert client.get(f'/result/{first}?timeout=5').status_code == 200
+    time.sleep(0.2)
+    second = client.post('/activate_task', json={'name': 'ChatWithUser', 'input': '你好', 'session_id': 'b'}).json['request_id']
+    assert client.get(f'/result/{second}?timeout=5').status_code == 200 # 新结果写入时清理过期的
+    assert client.get(f'/result/{first}').status_code == 404
+
+
+def test_batch_activation_reports_each_item(start_server):
+    gate = Event()
+
+    def respond(messages, tools):
+        gate.wait(5)
+        return completion('好的')
+    xinghe, client = start_server(respond, sessions={'max_sessions': 10, 'idle_timeout': 0, 'max_pending': 1})
+    try:
+        response = client.post('/activate_tasks', json=[
+            {'name': 'ChatWithUser', 'input': '一', 'session_id': 's1'},
+            {'name': 'ChatWithUser', 'input': '二', 'session_id': 's1'},
+            {'name': 'ChatWithUser', 'input': '三', 'session_id': 's1'},
+            {'name': 'ChatWithUser', 'input': '四', 'session_id': 's2'},
+            {'name': 'nope', 'input': '五'},
+            {'input': '六'},
+            {'name': 'solve_riddles', 'input': '七'},
+        ])
+        assert response.status_code == 200
+        results = response.json['results']
+        assert [(result['result'], result['code']) for result in results] == [
+            ('start', 200), ('queued', 200), ('queue_full', 429), ('start', 200), ('not_found', 404), ('bad_request', 400), ('no_parent', 400)]
+        assert 'retry_after' in results[2]
+        accepted = [result['request_id'] for result in results if result['code'] == 200]
+        assert len(set(accepted)) == 3 and all('request_id' not in result for result in results if result['code'] != 200)
+        gate.set()
+        assert [client.get(f'/result/{request_id}?timeout=5').status_code for request_id in accepted] == [200] * 3
+    finally:
+        gate.set()
+    assert client.post('/activate_tasks', json={'name': 'ChatWithUser', 'input': '一'}).status_code == 400
@@ -0,0 +1,124 @@
+"""
+推理路由：连接错误和5xx时转移到其他候选后端并暂停出错的后端，其他错误直接抛出；
+开启对冲时慢请求超过等待时间就向另一个后端再发一份，先输出的一方胜出，两份请求的槽位都会释放
+"""
+import time, asyncio
+
+import pytest
+from openai import APIConnectionError
+
+from XingHeFarmworkNew import Inference, InferenceRouter
+from conftest import StubInference, completion
+
+
+def backend(name, reply=None, error=None, delay=0.0):
+    def respond(messages, tools):
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return completion(reply)
+    return StubInference(respond, max_concurrency=1, name=name)
+
+
+def run(router, candidates=None, mode='sync', on_token=None):
+    """
+    和调度器一样先占用槽位再推理
+    :return: (推理结果, 耗时)，异步模式的耗时不含事件循环退出时等待桩后端线程的时间
+    """
+    name = router.acquire(candidates)
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    async def ainfer():
+        start = time.monotonic()
+        return await router.ainfer(name, 'model', messages, candidates=candidates, on_token=on_token), time.monotonic() - start
+    if mode == 'async':
+        return asyncio.run(ainfer())
+    start = time.monotonic()
+    return router.infer(name, 'model', messages, candidates=candidates, on_token=on_token), time.monotonic() - start
+
+
+def content(result):
+    return result[0].choices[0].message.content
+
+
+def idle(router):
+    # 在途计数归零，每个后端的槽位都已归还
+    for backend in router.backends.values():
+        if not backend.acquire_slot():
+            return False
+        backend.release_slot()
+    return all(count == 0 for count in router.outstanding.values())
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_connection_errors_fail_over(mode):
+    primary, secondary = backend('a', error=APIConnectionError(request=None)), backend('b', '好的')
+    router = InferenceRouter([primary, secondary], cooldown=60.0)
+    assert content(run(router, ['a', 'b'], mode)) == '好的'
+    assert (primary.calls, secondary.calls) == (1, 1)
+    assert not router.is_healthy('a') and router.is_healthy('b')
+    assert idle(router)
+    # a在冷却期内不再被选中
+    assert router.acquire(['a', 'b']) == 'b'
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_other_errors_are_raised_without_failover(mode):
+    primary, secondary = backend('a', error=ValueError('context too long')), backend('b', '好的')
+    router = InferenceRouter([primary, secondary])
+    with pytest.raises(ValueError):
+        run(router, ['a', 'b'], mode)
+    assert secondary.calls == 0 and router.is_healthy('a')
+    assert idle(router)
+
+
+def test_failover_stays_within_candidates():
+    primary, other = backend('a', error=APIConnectionError(request=None)), backend('b', '好的')
+    router = InferenceRouter([primary, other])
+    with pytest.raises(APIConnectionError):
+        run(router, ['a'])
+    assert other.calls == 0
+    assert idle(router)
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_slow_request_is_hedged(mode):
+    slow, fast = backend('a', '慢', delay=0.5), backend('b', '快')
+    router = InferenceRouter([slow, fast], hedge={'delay': 0.05})
+    tokens = []
+    result = run(router, ['a', 'b'], mode, tokens.append)
+    assert content(result) == '快' and result[1] < 0.4
+    assert ''.join(tokens) == '快' # 只推送胜出一方的输出
+    assert fast.calls == 1
+    time.sleep(0.6) # 等输掉的一方结束
+    assert ''.join(tokens) == '快'
+    assert idle(router)
+
+
+def test_no_hedge_without_another_free_backend():
+    slow, busy = backend('a', '慢', delay=0.2), backend('b', '快')
+    router = InferenceRouter([slow, busy], hedge={'delay': 0.05})
+    assert router.acquire(['b']) == 'b' # b的唯一槽位被占用
+    assert content(run(router, ['a', 'b'])) == '慢'
+    assert busy.calls == 0
+
+
+def test_hedge_delay_follows_the_latency_quantile():
+    router = InferenceRouter([backend('a'), backend('b')], hedge={'quantile': 0.5, 'min_samples': 4})
+    for elapsed in (0.1, 0.2, 0.3):
+        router._add_sample('a', elapsed)
+    assert router.hedge_delay('a') is None # 样本不够
+    router._add_sample('a', 0.4)
+    assert router.hedge_delay('a') == 0.3
+    assert router.hedge_delay('a', candidates=['a']) is None # 没有其他候选后端
+    assert InferenceRouter([backend('a'), backend('b')]).hedge_delay('a') is None # 未开启
+
+
+def test_retry_delay_is_bounded():
+    inference = Inference('http://127.0.0.1:9/v1', 'stub', max_retries=3, retry_backoff=0.1, max_backoff=0.25)
+    error = APIConnectionError(request=None)
+    deadline = time.monotonic() + 60
+    for attempt, bound in enumerate((0.1, 0.2, 0.25)):
+        assert all(0 <= inference._retry_delay(attempt, deadline, error) <= bound for _ in range(20))
+    assert inference._retry_delay(3, deadline, error) is None # 重试次数用尽
+    assert inference._retry_delay(0, time.monotonic(), error) is None # 等待会超过截止时间
@@ -0,0 +1,102 @@
+"""
+元任务会话表：会话数满时淘汰最久未用的空闲会话，忙碌的会话不淘汰；会话忙时输入排队，排队满或会话数满时/activate_task返回429
+"""
+import time
+from threading import Event, Lock
+
+import pytest
+
+from XHserver import XingHe
+from conftest import ROOT, completion
+
+
+@pytest.fixture
+def templates(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    return XingHe.TaskTemplate('tasks.yaml', 'Tools')
+
+
+def finish_round(sessions, task):
+    # 模拟调度器结束一轮对话，没有排队的输入时会话变为空闲
+    task.set_response(completion('好的'))
+    task.forward()
+    task.get_reply()
+    return sessions.next_input(task)
+
+
+def chat(sessions, session_id, text='你好'):
+    result, task = sessions.submit('ChatWithUser', session_id, text)
+    assert result == 'start'
+    assert finish_round(sessions, task) is None
+    return task
+
+
+def test_least_recently_used_idle_session_is_evicted(templates):
+    sessions = XingHe.MetaSessions(templates, Lock(), max_sessions=2, idle_timeout=0)
+    chat(sessions, 's1')
+    chat(sessions, 's2')
+    chat(sessions, 's1') # s1成为最近使用
+    chat(sessions, 's3')
+    assert [key[1] for key in sessions.sessions] == ['s1', 's3']
+
+
+def test_busy_sessions_are_not_evicted(templates):
+    sessions = XingHe.MetaSessions(templates, Lock(), max_sessions=2, idle_timeout=0)
+    busy = sessions.submit('ChatWithUser', 's1', '你好')[1]
+    chat(sessions, 's2')
+    assert sessions.submit('ChatWithUser', 's3', '你好')[0] == 'start' # 淘汰空闲的s2
+    assert sessions.submit('ChatWithUser', 's4', '你好') == ('busy', None)
+    assert sessions.get('ChatWithUser', 's1') is busy
+    finish_round(sessions, busy)
+    assert sessions.submit('ChatWithUser', 's4', '你好')[0] == 'start'
+    assert [key[1] for key in sessions.sessions] == ['s3', 's4']
+
+
+def test_idle_sessions_expire(templates):
+    sessions = XingHe.MetaSessions(templates, Lock(), max_sessions=10, idle_timeout=0.05)
+    chat(sessions, 's1')
+    busy = sessions.submit('ChatWithUser', 's2', '你好')[1]
+    time.sleep(0.1)
+    chat(sessions, 's3')
+    assert [key[1] for key in sessions.sessions] == ['s2', 's3']
+    assert sessions.get('ChatWithUser', 's2') is busy
+
+
+def test_evicted_session_is_restored_from_the_log(templates, tmp_path):
+    meta_log = XingHe.MetaTaskLog(str(tmp_path / 'meta_tasks.wal'), fsync=False)
+    sessions = XingHe.MetaSessions(templates, Lock(), meta_log=meta_log, max_sessions=1, idle_timeout=0)
+    first = chat(sessions, 's1', '记住我叫小明')
+    chat(sessions, 's2')
+    assert sessions.get('ChatWithUser', 's1') is None
+    assert meta_log.flush(timeout=5)
+    result, restored = sessions.submit('ChatWithUser', 's1', '我叫什么')
+    assert result == 'start' and restored is not first
+    assert [msg.content for msg in restored.context_ctrl['user_history']] == ['记住我叫小明', '好的', '我叫什么']
+
+
+def test_inputs_queue_while_the_session_is_busy(templates):
+    sessions = XingHe.MetaSessions(templates, Lock(), max_pending=1, idle_timeout=0)
+    result, task = sessions.submit('ChatWithUser', 's1', '第一句', 'r1')
+    assert result == 'start' and task.info['request_id'] == 'r1'
+    assert sessions.submit('ChatWithUser', 's1', '第二句', 'r2') == ('queued', task)
+    assert sessions.submit('ChatWithUser', 's1', '第三句', 'r3') == ('queue_full', task)
+    assert finish_round(sessions, task) == ('第二句', 'r2')
+
+
+def test_full_queue_and_full_session_table_answer_429(start_server):
+    gate = Event()
+
+    def respond(messages, tools):
+        gate.wait(5)
+        return completion('好的')
+    xinghe, client = start_server(respond, sessions={'max_sessions': 1, 'idle_timeout': 0, 'max_pending': 1})
+    try:
+        activate = lambda session_id: client.post('/activate_task', json={'name': 'ChatWithUser', 'input': '你好', 'session_id': session_id})
+        assert [activate('s1').json['result'] for _ in range(2)] == ['start', 'queued']
+        for response, result in [(activate('s1'), 'queue_full'), (activate('s2'), 'busy')]:
+            assert response.status_code == 429
+            assert response.json['result'] == result
+            assert int(response.headers['Retry-After']) >= 1
+        assert xinghe.request_tracker.outstanding() == {'ChatWithUser': 2} # 被拒绝的请求不留结果
+    finally:
+        gate.set()
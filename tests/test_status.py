@@ -0,0 +1,75 @@
+"""
+状态查询：公告板把变化合并成带版本号的快照，since只返回之后变化和删除的条目，/status 按ETag返回304
+"""
+from XingHeFarmworkNew import LLMTask, LLMTools
+from XHserver import XingHe
+from conftest import completion, wait_until
+
+
+def published(board):
+    return wait_until(lambda: board.snapshot['version'] == board.version)
+
+
+def test_view_returns_changes_since_a_version():
+    board = XingHe.StatusBoard(min_interval=0.01)
+    board.put('tasks_list', 'a', {'uuid': 'a', 'status': 'ReUser'})
+    board.put('tasks_list', 'b', {'uuid': 'b', 'status': 'ReUser'})
+    board.put('meta_tasks', ('Chat', 's1'), {'session_id': 's1'})
+    assert published(board)
+    full = board.view(board.snapshot)
+    assert full['full'] and full['version'] == 3
+    assert [entry['uuid'] for entry in full['tasks_list']] == ['a', 'b'] and len(full['meta_tasks']) == 1
+    board.put('tasks_list', 'b', {'uuid': 'b', 'status': 'ToolCall'})
+    board.remove('tasks_list', 'a')
+    board.remove('tasks_list', 'missing') # 不存在的键不产生版本
+    assert published(board)
+    delta = board.view(board.snapshot, since=3)
+    assert (delta['full'], delta['version'], delta['since']) == (False, 5, 3)
+    assert delta['tasks_list'] == [{'uuid': 'b', 'status': 'ToolCall'}] and delta['meta_tasks'] == []
+    assert delta['removed'] == {'meta_tasks': [], 'tasks_list': ['a']}
+    assert board.view(board.snapshot, since=5)['tasks_list'] == []
+    assert board.view(board.snapshot, since=9)['full'] # 客户端的版本比服务端新(服务重启过)，返回完整状态
+
+
+def test_versions_older_than_the_kept_removals_get_full_state():
+    board = XingHe.StatusBoard(min_interval=0.01, max_removed=1)
+    for key in 'abc':
+        board.put('tasks_list', key, {'uuid': key})
+    board.remove('tasks_list', 'a')
+    board.remove('tasks_list', 'b') # 丢弃a的删除记录
+    assert published(board)
+    assert board.view(board.snapshot, since=3)['full']
+    delta = board.view(board.snapshot, since=4)
+    assert not delta['full'] and delta['removed']['tasks_list'] == ['b']
+
+
+def test_task_changes_update_registered_entries_only():
+    board = XingHe.StatusBoard(min_interval=0.01)
+    task = LLMTask('Chat', 3, 'sys', LLMTools())
+    board.task_changed(task)
+    assert board.version == 0
+    board.put('tasks_list', task.info['uuid'], {'uuid': task.info['uuid'], 'status': task.status})
+    task.set_input('你好')
+    task.forward()
+    board.task_changed(task)
+    board.task_changed(task) # 状态没变不产生新版本
+    assert board.version == 2
+    assert published(board)
+    assert board.view(board.snapshot, since=1)['tasks_list'][0]['status'] == 'ReUser'
+
+
+def test_status_endpoint_etag_and_since(start_server):
+    xinghe, client = start_server(lambda messages, tools: completion('好的'))
+    response = client.get('/status')
+    assert response.status_code == 200 and response.json['full']
+    etag, version = response.headers['ETag'], response.json['version']
+    assert client.get('/status', headers={'If-None-Match': etag}).status_code == 304
+    request_id = client.post('/activate_task', json={'name': 'ChatWithUser', 'input': '你好', 'session_id': 'a'}).json['request_id']
+    assert client.get(f'/result/{request_id}?timeout=5').status_code == 200
+    assert published(xinghe.status_board)
+    response = client.get(f'/status?since={version}', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert not response.json['full'] and response.json['since'] == version
+    assert [(entry['session_id'], entry['status']) for entry in response.json['meta_tasks']] == [('a', 'Free')]
+    assert 'task_templates' in response.json
+    assert client.get('/status?since=abc').status_code == 400
@@ -0,0 +1,89 @@
+"""
+流式输出：增量块拼成和非流式相同结构的结果，顶层任务的逐段输出和最终回复推送给订阅者
+"""
+import json
+from types import SimpleNamespace
+
+from XingHeFarmworkNew import LLMTask, LLMTools, StreamAssembler
+from XHserver import XingHe
+from conftest import completion
+
+
+def chunk(content=None, tool_calls=None, finish_reason=None):
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)], usage=None)
+
+
+def tool_delta(index, id=None, name=None, arguments=None):
+    function = SimpleNamespace(name=name, arguments=arguments) if name is not None or arguments is not None else None
+    return SimpleNamespace(index=index, id=id, function=function)
+
+
+def test_text_deltas_are_joined_and_forwarded():
+    tokens = []
+    assembler = StreamAssembler(tokens.append)
+    for part in [chunk('你'), chunk('好'), chunk(None), chunk('呀', finish_reason='stop'),
+                 SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=5, completion_tokens=3))]:
+        assembler.add(part)
+    result = assembler.result()
+    assert tokens == ['你', '好', '呀']
+    message = result.choices[0].message
+    assert (message.role, message.content, message.tool_calls) == ('assistant', '你好呀', None)
+    assert result.choices[0].finish_reason == 'stop'
+    assert result.usage.prompt_tokens == 5
+
+
+def test_tool_call_deltas_are_rebuilt_by_index():
+    assembler = StreamAssembler()
+    # 两个工具调用的名字和参数被拆成多段并交错到达，id只在第一段出现
+    for part in [chunk(tool_calls=[tool_delta(1, 'call_b', 'get_', '')]),
+                 chunk(tool_calls=[tool_delta(0, 'call_a', 'add', '{"a": ')]),
+                 chunk(tool_calls=[tool_delta(1, name='weather', arguments='{"city"')]),
+                 chunk(tool_calls=[tool_delta(0, arguments='1, "b": 2}')]),
+                 chunk(tool_calls=[tool_delta(1, arguments=': "北京"}')]),
+                 chunk(finish_reason='tool_calls')]:
+        assembler.add(part)
+    message = assembler.result().choices[0].message
+    calls = [(call.id, call.type, call.function.name, json.loads(call.function.arguments)) for call in message.tool_calls]
+    assert calls == [('call_a', 'function', 'add', {'a': 1, 'b': 2}), ('call_b', 'function', 'get_weather', {'city': '北京'})]
+    assert message.content == ''
+
+
+def test_assembled_tool_calls_drive_the_task():
+    assembler = StreamAssembler()
+    assembler.add(chunk(tool_calls=[tool_delta(0, 'call_a', 'add', '{"a": 1, "b": 2}')], finish_reason='tool_calls'))
+    task = LLMTask('Chat', 3, 'sys', LLMTools())
+    task.set_input('算一下')
+    task.forward()
+    task.set_response(assembler.result())
+    task.forward()
+    assert task.status == 'ToolCall'
+    assert [call.id for call in task.tools_ctrl['toolcall_queue']] == ['call_a']
+
+
+def test_hub_drops_events_for_slow_subscribers():
+    hub = XingHe.StreamHub(max_queue=2)
+    slow, other = hub.subscribe('Chat/s1'), hub.subscribe('Chat/s2')
+    for index in range(3):
+        hub.publish(hub.topic('Chat', 's1'), {'type': 'token', 'content': str(index)})
+    assert [slow.get_nowait()['content'] for _ in range(slow.qsize())] == ['0', '1']
+    assert other.empty()
+    hub.unsubscribe('Chat/s1', slow)
+    hub.publish('Chat/s1', {'type': 'token'})
+    assert slow.empty() and 'Chat/s1' not in hub.subscribers
+
+
+def test_scheduler_publishes_tokens_then_the_reply(start_scheduler):
+    hub = XingHe.StreamHub()
+    scheduler, tracker, backend = start_scheduler(lambda messages, tools: completion('你好呀'), stream_hub=hub)
+    events = hub.subscribe(hub.topic('Chat'))
+    task = LLMTask('Chat', 3, 'sys', LLMTools())
+    task.info['request_id'] = tracker.create(name='Chat')
+    task.set_input('你好')
+    task.forward()
+    scheduler.add_task(task)
+    assert tracker.get(task.info['request_id'], timeout=5)['reply'] == '你好呀'
+    received = [events.get(timeout=5) for _ in range(4)]
+    assert [event['type'] for event in received] == ['token'] * 3 + ['reply']
+    assert ''.join(event['content'] for event in received[:3]) == '你好呀'
+    assert (received[-1]['content'], received[-1]['request_id']) == ('你好呀', task.info['request_id'])
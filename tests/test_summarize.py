@@ -0,0 +1,54 @@
+"""
+对话超出上下文预算时的摘要压缩：摘要在任务推理期间生成时，等这次推理结束再改写user_history
+"""
+from threading import Event
+
+from XingHeFarmworkNew import LLMTask, LLMTools
+from conftest import completion, wait_until
+
+
+class Templates:
+    # 只提供调度器用到的模板接口：Chat配置了摘要任务Summarize
+    def get_template(self, name):
+        return {'name': name, 'summarizer': 'Summarize'} if name == 'Chat' else {'name': name}
+
+    def get_task(self, name):
+        return LLMTask(name, 6, 'summarize', LLMTools())
+
+
+def test_compaction_waits_until_the_task_is_not_running(start_scheduler):
+    summary_gate, turn_gate, in_second_turn = Event(), Event(), Event()
+
+    def respond(messages, tools):
+        if messages[0]['content'] == 'summarize':
+            summary_gate.wait(5)
+            return completion('SUMMARY')
+        if messages[-1]['content'] == '第二个问题':
+            in_second_turn.set()
+            turn_gate.wait(5)
+        return completion('回答' * 20)
+    scheduler, tracker, backend = start_scheduler(respond, task_templates=Templates())
+    task = LLMTask('Chat', 3, 'sys', LLMTools(), context_budget=60)
+
+    def run_turn(text):
+        task.info['request_id'] = tracker.create(name='Chat')
+        task.set_input(text)
+        task.forward()
+        scheduler.add_task(task)
+        return task.info['request_id']
+
+    assert tracker.get(run_turn('问题' * 20), timeout=5)['state'] == 'done'
+    assert wait_until(lambda: scheduler.summarizing) # 第一轮后超出预算，摘要任务已创建
+    second = run_turn('第二个问题')
+    assert in_second_turn.wait(5)
+    history = list(task.context_ctrl['user_history'])
+    summary_gate.set()
+    assert wait_until(lambda: not scheduler.summarizing)
+    # 任务还在推理，摘要先不压缩进对话
+    assert task.context_ctrl['summary'] is None
+    assert task.context_ctrl['user_history'] == history
+    turn_gate.set()
+    assert tracker.get(second, timeout=5)['state'] == 'done'
+    assert wait_until(lambda: task.context_ctrl['summary'] == 'SUMMARY')
+    assert task.context_ctrl['user_history'][0] is not history[0]
+    assert not scheduler.compactions
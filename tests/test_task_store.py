@@ -0,0 +1,90 @@
+"""
+任务存储的租约：租约过期后其他工作者接手，原持有者迟到的complete作废，同一会话按写入顺序一次只租出一个作业
+"""
+import time
+
+import pytest
+
+from XHserver import XingHe
+
+LEASE = 0.1
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return XingHe.MemoryTaskStore()
+    return XingHe.SQLiteTaskStore(str(tmp_path / 'tasks.sqlite'))
+
+
+def test_expired_lease_is_taken_over(store):
+    request_id = store.enqueue('Chat', 's1', {'text': '你好'})
+    [job] = store.lease('w1', 4, LEASE)
+    assert (job['request_id'], job['input'], job['version']) == (request_id, {'text': '你好'}, 0)
+    assert store.lease('w2', 4, LEASE) == [] # 租约未过期
+    time.sleep(LEASE * 1.5)
+    [job] = store.lease('w2', 4, LEASE)
+    assert job['request_id'] == request_id
+    # w1 处理完时租约已经归w2，结果和会话状态都不写入
+    assert store.complete(request_id, 'w1', 'w1的回复', session_state={'by': 'w1'}) is None
+    assert store.get(request_id)['state'] == 'pending'
+    assert store.load_session('Chat', 's1') == (0, None)
+    assert store.complete(request_id, 'w2', 'w2的回复', session_state={'by': 'w2'}) == 1
+    result = store.get(request_id)
+    assert (result['state'], result['reply']) == ('done', 'w2的回复')
+    assert store.load_session('Chat', 's1') == (1, {'by': 'w2'})
+    # 已完成的作业再次complete也作废
+    assert store.complete(request_id, 'w2', '重复') is None
+    assert store.get(request_id)['reply'] == 'w2的回复'
+
+
+def test_heartbeat_keeps_the_lease(store):
+    lease = 0.4 # 续租间隔留足余量，机器繁忙时睡眠多出的时间不会让租约过期
+    request_id = store.enqueue('Chat', 's1', '你好')
+    store.lease('w1', 4, lease)
+    for _ in range(3): # 总时长超过一个租约
+        time.sleep(lease / 2)
+        store.heartbeat('w1', [request_id], lease)
+        store.heartbeat('w2', [request_id], 0) # 不是持有者的续租不生效
+        assert store.lease('w2', 4, lease) == []
+    assert store.complete(request_id, 'w1', '好的') == 0
+
+
+def test_session_jobs_are_leased_in_order(store):
+    first = store.enqueue('Chat', 's1', '第一句')
+    second = store.enqueue('Chat', 's1', '第二句')
+    other = store.enqueue('Chat', 's2', '另一个会话')
+    assert [job['request_id'] for job in store.lease('w1', 4, 10)] == [first, other]
+    assert store.lease('w2', 4, 10) == []
+    assert store.complete(first, 'w1', '好的', session_state={'turns': 1}) == 1
+    # 下一个作业带着上一个作业写入的会话版本租出
+    [job] = store.lease('w2', 4, 10)
+    assert (job['request_id'], job['version']) == (second, 1)
+
+
+def test_repeatedly_expired_job_fails(tmp_path):
+    for store in (XingHe.MemoryTaskStore(max_attempts=2), XingHe.SQLiteTaskStore(str(tmp_path / 'tasks.sqlite'), max_attempts=2)):
+        request_id = store.enqueue('Chat', 's1', '你好')
+        for worker in ('w1', 'w2'):
+            assert len(store.lease(worker, 4, 0)) == 1 # 工作者拿到作业后崩溃，租约立即过期
+        assert store.lease('w3', 4, LEASE) == []
+        assert store.get(request_id)['state'] == 'failed'
+        assert store.outstanding() == {}
+
+
+def test_max_pending_counts_only_open_jobs_of_the_session(store):
+    first = store.enqueue('Chat', 's1', '第一句', max_pending=1)
+    assert store.enqueue('Chat', 's1', '第二句', max_pending=1) is not None
+    assert store.enqueue('Chat', 's1', '第三句', max_pending=1) is None
+    assert store.enqueue('Chat', 's2', '另一个会话', max_pending=1) is not None
+    store.lease('w1', 4, 10)
+    store.complete(first, 'w1', '好的')
+    assert store.enqueue('Chat', 's1', '第三句', max_pending=1) is not None
+
+
+def test_incomplete_store_fails_when_created():
+    class Incomplete(XingHe.TaskStore):
+        def enqueue(self, name, session_id, input, max_pending=None):
+            return None
+    with pytest.raises(TypeError):
+        Incomplete()
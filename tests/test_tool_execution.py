@@ -0,0 +1,115 @@
+"""
+工具调用的失败路径：卡住的工具超时后不再占住共享线程池，模型给出的参数不合法时记录结构化错误
+"""
+import json, time, asyncio, threading
+from threading import Event, Lock
+
+import pytest
+
+from XingHeFarmworkNew import LLMTask, LLMTools, InferenceRouter, ResponseCache
+from XHserver import XingHe
+from conftest import ROOT, StubInference, completion, tool
+
+
+def make_scheduler(mode, **kwargs):
+    scheduler_class = XingHe.AsyncScheduler if mode == 'async' else XingHe.Scheduler
+    return scheduler_class(None, {}, Lock(), Lock(), router=InferenceRouter([StubInference(lambda messages, tools: completion())]), **kwargs)
+
+
+def run_toolcall(scheduler, tools, calls):
+    """
+    让任务带着一批工具调用进入ToolCall状态，同步执行完这一批
+    :return: 任务实例
+    """
+    llmtools = LLMTools()
+    llmtools.add_tools(tools)
+    task = LLMTask('Chat', 3, 'sys', llmtools)
+    task.set_input('hi')
+    task.forward()
+    task.set_response(completion('', calls))
+    task.forward()
+    with scheduler.tasks_lock:
+        scheduler._register_task(task)
+    if isinstance(scheduler, XingHe.AsyncScheduler):
+        asyncio.run(scheduler.atoolcall(task))
+    else:
+        scheduler.toolcall(task)
+    return task
+
+
+def tool_outputs(task):
+    return [msg.content for msg in task.context_ctrl['tool_history'] if msg.role == 'tool']
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_hung_tools_do_not_block_later_calls(mode):
+    release = Event()
+    hang = tool('hang', lambda: release.wait(30) and 'late')
+    add = tool('add', lambda a, b: a + b)
+    scheduler = make_scheduler(mode, tool_workers=2, tool_timeout=0.3)
+    try:
+        task = run_toolcall(scheduler, [hang, add], [('hang', '{}'), ('hang', '{}')])
+        assert [json.loads(output)['error'] for output in tool_outputs(task)] == ['timeout', 'timeout']
+        # 两个线程都卡着，换掉的共享线程池之后的调用不用排在它们后面
+        start = time.monotonic()
+        task = run_toolcall(scheduler, [hang, add], [('add', '{"a": 3, "b": 1}')])
+        assert tool_outputs(task) == ['4']
+        assert time.monotonic() - start < 0.3
+        assert task.status == 'ReTool'
+        # 卡住的线程是守护线程，不会拖住解释器退出
+        assert all(thread.daemon for thread in threading.enumerate() if thread.name.startswith('tool'))
+    finally:
+        release.set()
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+@pytest.mark.parametrize('arguments', ['{"a": 3, "b"', '[3, 1]', 'null'])
+def test_bad_arguments_are_reported_to_the_model(mode, arguments):
+    add = tool('add', lambda a, b: a + b)
+    scheduler = make_scheduler(mode)
+    task = run_toolcall(scheduler, [add], [('add', arguments), ('add', '{"a": 3, "b": 1}')])
+    outputs = tool_outputs(task)
+    assert json.loads(outputs[0])['error'] == 'bad_arguments'
+    assert outputs[1] == '4'
+    # 任务没有卡在ToolCall，带着错误进入下一轮推理
+    assert task.status == 'ReTool' and not task.events['running'].is_set()
+    assert [msg.tool_call_id for msg in task.context_ctrl['tool_history'] if msg.role == 'tool'] == ['call0', 'call1']
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_tool_cache_ignores_injected_arguments(mode, monkeypatch):
+    calls = []
+
+    def lookup(city, cancel_event=None):
+        calls.append(city)
+        return 'sunny'
+    monkeypatch.chdir(ROOT)
+    templates = XingHe.TaskTemplate('tasks.yaml', 'Tools')
+    templates.tool_caches['weather'] = ResponseCache(max_entries=8)
+    scheduler = make_scheduler(mode, task_templates=templates)
+    weather = tool('weather', lookup)
+    # 每次调用注入的cancel_event都是新的取消令牌，不能进入缓存键
+    outputs = [tool_outputs(run_toolcall(scheduler, [weather], [('weather', '{"city": "北京"}')])) for _ in range(2)]
+    assert outputs == [['sunny'], ['sunny']]
+    assert calls == ['北京']
+
+
+def test_chained_tool_calls_finish(start_scheduler):
+    def respond(messages, tools):
+        # 第一轮调用add，拿到结果后再调用一次add，第二个结果出来后回复
+        results = [msg['content'] for msg in messages if msg['role'] == 'tool']
+        if len(results) < 2:
+            return completion('', [('add', json.dumps({'a': len(results), 'b': 1}))])
+        return completion('结果是' + results[-1])
+    scheduler, tracker, backend = start_scheduler(respond)
+    llmtools = LLMTools()
+    llmtools.add_tools([tool('add', lambda a, b: a + b)])
+    task = LLMTask('Chat', 3, 'sys', llmtools)
+    task.info['request_id'] = tracker.create(name='Chat')
+    task.set_input('算两次')
+    task.forward()
+    scheduler.add_task(task)
+    result = tracker.get(task.info['request_id'], timeout=5)
+    assert (result['state'], result['reply']) == ('done', '结果是2')
+    assert backend.calls == 3
+    assert task.tools_ctrl['toolcall_queue'] == []
@@ -0,0 +1,68 @@
+"""
+工具筛选：按BM25选出和输入最相关的工具，会话当前的工具子集够用时保持不变，被禁用的工具不会被选中
+"""
+from XingHeFarmworkNew import LLMTask, LLMTools, ToolSelector
+from conftest import tool
+
+
+def make_tools():
+    llmtools = LLMTools()
+    llmtools.add_tools([tool('weather_get', lambda city: city, is_meta=False, keywords=['天气', '气温', '下雨']),
+                        tool('email_send', lambda to: to, is_meta=False, keywords=['邮件', '邮箱', '发送']),
+                        tool('flight_book', lambda to: to, is_meta=False, keywords=['航班', '机票', '飞机']),
+                        tool('train_book', lambda to: to, is_meta=False, keywords=['火车', '车票', '高铁']),
+                        tool('help', lambda: '', is_meta=False)])
+    return llmtools
+
+
+def names(llmtools):
+    return sorted(llmtools.available_functions)
+
+
+def test_rank_matches_keywords_and_respects_limits():
+    llmtools = make_tools()
+    selector = ToolSelector(llmtools, top_k=3)
+    assert selector.rank('明天会下雨吗，气温多少') == ['weather_get']
+    assert selector.rank('你好') == [] # 没有匹配的词时不选任何工具
+    assert selector.rank('订一张去上海的机票', allowed={'weather_get', 'email_send'}) == []
+    # 机票和车票都匹配上了"票"，min_ratio把只匹配上一个字的工具筛掉
+    assert selector.rank('订一张去上海的机票') == ['flight_book']
+    assert ToolSelector(llmtools, top_k=3, min_ratio=0.0).rank('订一张去上海的机票') == ['flight_book', 'train_book']
+    assert len(ToolSelector(llmtools, top_k=1, min_ratio=0.0).rank('发送邮件说一下天气和航班')) == 1
+
+
+def test_select_adds_always_and_reuses_subsets():
+    llmtools = make_tools()
+    selector = ToolSelector(llmtools, top_k=2, always=['help', 'missing'])
+    assert selector.always == ['help'] # 不存在的工具不加入
+    weather = selector.select('今天气温多少', llmtools)
+    assert names(weather) == ['help', 'weather_get']
+    assert selector.select('会下雨吗', llmtools) is weather # 同一组工具共用同一个LLMTools
+    # 寒暄或者当前子集已经包含选中的工具时原样保留，工具列表不变
+    assert selector.select('谢谢', llmtools, weather) is weather
+    assert selector.select('明天下雨吗', llmtools, weather) is weather
+    assert names(selector.select('帮我发送邮件', llmtools, weather)) == ['email_send', 'help']
+
+
+def test_subset_cache_is_bounded():
+    llmtools = make_tools()
+    selector = ToolSelector(llmtools, max_subsets=2)
+    first = selector.subset(['weather_get'])
+    selector.subset(['email_send'])
+    selector.subset(['weather_get']) # 刚用过的留下
+    selector.subset(['flight_book'])
+    assert list(selector.subsets) == [frozenset(['weather_get']), frozenset(['flight_book'])]
+    assert selector.subset(['weather_get']) is first
+
+
+def test_task_sends_only_selected_and_allowed_tools():
+    llmtools = make_tools()
+    task = LLMTask('Chat', 3, 'sys', llmtools, tool_selector=ToolSelector(llmtools, top_k=2, always=['help']))
+    task.set_input('明天会下雨吗')
+    task.forward()
+    assert sorted(schema['function']['name'] for schema in task.tool_schema()) == ['help', 'weather_get']
+    task.tool_permission('weather_get', False)
+    assert [schema['function']['name'] for schema in task.tool_schema()] == ['help']
+    assert 'weather_get' in llmtools.available_functions # 模板共享的工具集不受影响
+    task.tool_permission('email_send', False)
+    assert task.tool_selector.select('帮我发送邮件', task.tools_ctrl['tools_filtered']).available_functions.keys() == {'help'}
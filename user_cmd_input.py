@@ -1,18 +1,16 @@
-import socket, json
+import requests
 
 def send_message(name, input_data):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect(('127.0.0.1', 12345))
-        # 创建要发送的字典
-        message_dict = {"name": name, "input": input_data}
-        message = json.dumps(message_dict)
-        # 发送消息
-        client_socket.send(message.encode('utf-8'))
-        # 接收响应
-        response = client_socket.recv(1024).decode('utf-8')
-        response_dict = json.loads(response)
-        print(f"接收到响应: {response_dict}")
-        client_socket.close()
+        # 激活任务，再按请求id长轮询等待回复
+        response_dict = requests.post('http://127.0.0.1:5000/activate_task', json={"name": name, "input": input_data}).json()
+        if response_dict.get("status") != "OK":
+                print(f"接收到响应: {response_dict}")
+                return
+        while True:
+                result = requests.get('http://127.0.0.1:5000/result/' + response_dict["request_id"], params={"timeout": 30})
+                if result.status_code != 202:
+                        break
+        print(f"接收到响应: {result.json()}")
 
 while True:
         user_input = input('Chat with history: ')